@@ -0,0 +1,64 @@
+from benchmarks.common import StatementCounter, create_schema
+from sqlalchemy import insert
+import src.archive as archive
+import src.config as config
+import src.models as models
+import argparse
+import asyncio
+import json
+import time
+
+async def seed_user(db, index: int, products: int) -> int:
+  result = await db.execute(
+    insert(models.User).values(
+      full_name=f"Seller {index}",
+      username=f"seller{index}",
+      phone_number=1000000000 + index,
+      password="x" * 80,
+      token=f"token-{index}",
+    )
+  )
+  user_id = result.inserted_primary_key[0]
+  if products:
+    await db.execute(
+      insert(models.Products),
+      [
+        {
+          "user_id": user_id,
+          "title": f"Product {n}",
+          "description": "benchmark product",
+          "price": n % 500 + 0.99,
+          "image": "assets/product_images/bench.jpg",
+          "available": True,
+        }
+        for n in range(products)
+      ],
+    )
+  await db.commit()
+  return user_id
+
+async def main(sizes: list):
+  engine = await create_schema()
+  counter = StatementCounter(engine)
+  results = []
+  async with config.SessionLocal() as db:
+    for index, products in enumerate(sizes):
+      user_id = await seed_user(db, index, products)
+      counter.count = 0
+      started = time.perf_counter()
+      counts = await archive.archive_users(db, [user_id])
+      await db.commit()
+      results.append({
+        "products": products,
+        "archived": counts["products"],
+        "statements": counter.count,
+        "ms": round((time.perf_counter() - started) * 1000, 2),
+      })
+  await engine.dispose()
+  return results
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time delete_user archival against the product count")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[0, 10, 100, 1000, 10000])
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(main(args.sizes)), indent=2))
@@ -0,0 +1,78 @@
+from benchmarks.common import config  # noqa: F401  (sets the environment up)
+from benchmarks.load import peak_rss_mb, percentile
+import src.search as search
+import argparse
+import itertools
+import json
+import random
+import time
+
+# Zipf-ish vocabulary: a few very common words and a long tail, like real
+# listing text.
+WORDS = [f"w{n}" for n in range(20000)]
+COMMON = ["good", "new", "used", "condition", "sale", "phone", "car", "black", "white", "size"]
+
+def make_vocabulary(rng: random.Random):
+  cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(WORDS))))
+  def words(count: int) -> str:
+    return " ".join(rng.choices(WORDS, cum_weights=cumulative, k=count) + rng.sample(COMMON, 2))
+  return words
+
+def build(products: int, rng: random.Random) -> float:
+  # Only the index inserts are timed, not generating the text.
+  words = make_vocabulary(rng)
+  seconds = 0.0
+  for start in range(1, products + 1, 10000):
+    chunk = [(words(4), words(20)) for _ in range(min(10000, products + 1 - start))]
+    started = time.perf_counter()
+    for product_id, (title, description) in enumerate(chunk, start):
+      search.index.add(product_id, product_id % 5000 + 1, title, description, product_id % 997 + 1, product_id % 4 != 0)
+    seconds += time.perf_counter() - started
+  search.index.ready = True
+  return seconds
+
+def run_queries(name: str, queries: list, repeat: int, **filters) -> dict:
+  latencies = []
+  hits = 0
+  for _ in range(repeat):
+    for query in queries:
+      started = time.perf_counter()
+      hits += len(search.index.search(query, 20, **filters))
+      latencies.append(time.perf_counter() - started)
+  latencies.sort()
+  return {
+    "query": name,
+    "queries": len(latencies),
+    "avg_hits": round(hits / len(latencies), 1),
+    "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+    "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+  }
+
+def main(products: int, repeat: int, seed: int) -> dict:
+  rng = random.Random(seed)
+  seconds = build(products, rng)
+  tail = [f"w{rng.randrange(5000, 20000)}" for _ in range(50)]
+  head = [f"w{rng.randrange(0, 50)}" for _ in range(50)]
+  results = [
+    run_queries("rare word", tail, repeat, prefix=False),
+    run_queries("common word", head, repeat, prefix=False),
+    run_queries("two words", [f"{a} {b}" for a, b in zip(head, tail)], repeat, prefix=False),
+    run_queries("typeahead prefix", [word[:3] for word in tail], repeat),
+    run_queries("common word + filters", head, repeat, prefix=False, min_price=100, max_price=300, available=True),
+    run_queries("very common word", COMMON, repeat, prefix=False),
+  ]
+  return {
+    "products": products,
+    "build_seconds": round(seconds, 2),
+    "peak_rss_mb": peak_rss_mb(),
+    "index": search.index.stats(),
+    "results": results,
+  }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time search index queries against the catalog size")
+  parser.add_argument("--products", type=int, default=100000)
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+  print(json.dumps(main(args.products, args.repeat, args.seed), indent=2))
@@ -0,0 +1,76 @@
+from benchmarks.common import config  # noqa: F401  (sets the environment up)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from collections import namedtuple
+from decimal import Decimal
+import src.images as images
+import src.responses as responses
+import src.schemas as schemas
+import argparse
+import datetime
+import json
+import timeit
+
+FeedRow = namedtuple(
+  "FeedRow",
+  "id title description price image available created_at full_name username profile_img",
+)
+
+def make_rows(count: int) -> list:
+  now = datetime.datetime.now()
+  return [
+    FeedRow(
+      id=n,
+      title=f"Product {n}",
+      description="A reasonably sized description for a second-hand item. " * 3,
+      price=Decimal(f"{n % 900}.99"),
+      image=f"assets/product_images/{n:064x}.jpg",
+      available=n % 3 != 0,
+      created_at=now - datetime.timedelta(minutes=n),
+      full_name="Seller Name",
+      username=f"seller{n % 50}",
+      profile_img="/assets/images/profile_img_male.jpg",
+    )
+    for n in range(count)
+  ]
+
+def before(rows) -> bytes:
+  # The previous path: plain dicts through jsonable_encoder + JSONResponse.
+  content = [
+    {
+      "product_id": row.id,
+      "title": row.title,
+      "description": row.description,
+      "price": row.price,
+      "image": row.image,
+      "image_variants": images.variant_urls(row.image),
+      "available": row.available,
+      "time": row.created_at,
+      "user": {
+        "full_name": row.full_name,
+        "username": row.username,
+        "profile_img": row.profile_img,
+        "profile_img_variants": images.variant_urls(row.profile_img),
+      },
+    }
+    for row in rows
+  ]
+  return JSONResponse(content=jsonable_encoder(content)).body
+
+def after(rows) -> bytes:
+  return responses.FastJSONResponse([schemas.FeedProduct.from_row(row) for row in rows]).body
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Serialization cost of the product feed per 1k rows")
+  parser.add_argument("--rows", type=int, default=1000)
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+
+  rows = make_rows(args.rows)
+  assert json.loads(before(rows)) == json.loads(after(rows))
+  results = {}
+  for name, function in (("jsonable_encoder", before), ("response_models", after)):
+    seconds = min(timeit.repeat(lambda: function(rows), number=1, repeat=args.repeat))
+    results[name] = {"ms_per_1k": round(seconds * 1000 * 1000 / args.rows, 3)}
+  results["speedup"] = round(results["jsonable_encoder"]["ms_per_1k"] / results["response_models"]["ms_per_1k"], 2)
+  print(json.dumps(results, indent=2))
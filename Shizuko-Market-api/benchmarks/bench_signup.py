@@ -0,0 +1,41 @@
+from benchmarks.common import prepare_workdir
+import benchmarks.load as load
+import argparse
+import asyncio
+import json
+import random
+
+# Signups per second against the number of concurrent clients. Every
+# scenario request is a fresh user; the "duplicate" pass retries usernames
+# that are already taken to time the IntegrityError -> 400 path (see
+# load.duplicate_signup).
+
+async def main(levels: list, requests: int, seed: int) -> dict:
+  import httpx
+  import src.config as config
+  from run import app
+
+  data = await load.seed(100, 0, 0, random.Random(seed))
+  results = []
+  transport = httpx.ASGITransport(app=app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+    for concurrency in levels:
+      result = await load.run_scenario(client, data, "signup", requests, concurrency)
+      results.append({"concurrency": concurrency, "signups_per_second": result["throughput_rps"], **result})
+    duplicates = await load.run_scenario(client, data, "duplicate_signup", requests, max(levels))
+
+  await config.engine.dispose()
+  return {
+    "database": config.engine.dialect.name,
+    "signup": results,
+    "duplicate": {"concurrency": max(levels), **duplicates},
+  }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure signups per second under concurrency")
+  parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+  parser.add_argument("--requests", type=int, default=1000)
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+  prepare_workdir()
+  print(json.dumps(asyncio.run(main(args.concurrency, args.requests, args.seed)), indent=2))
@@ -0,0 +1,49 @@
+from sqlalchemy import event
+from pathlib import Path
+import os
+import shutil
+import tempfile
+
+# Benchmarks run against a throwaway SQLite file unless DATABASE_URL is
+# already set; it has to be in place before src.config is imported.
+# BENCH_DIR picks the directory, e.g. one the test runner cleans up.
+BENCH_DIR = Path(os.getenv("BENCH_DIR") or tempfile.mkdtemp(prefix="shizuko-bench-"))
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{BENCH_DIR / 'bench.db'}")
+os.environ.setdefault("ENCRYPTION_PASSWORD", "benchmark-encryption-password")
+# Admission control is off: every simulated client shares one address, and
+# closed-loop workers that ignore Retry-After would turn shed requests into
+# a flood of 503s. Set the ADMISSION_* variables to measure shedding.
+for name in ("ADMISSION_IP_RATE", "ADMISSION_TOKEN_RATE", "ADMISSION_READS", "ADMISSION_WRITES", "ADMISSION_UPLOADS"):
+  os.environ.setdefault(name, "0")
+
+import src.config as config
+import src.models as models
+
+class StatementCounter:
+  def __init__(self, engine):
+    self.count = 0
+    event.listen(engine.sync_engine, "before_cursor_execute", self._count)
+
+  def _count(self, *args):
+    self.count += 1
+
+async def create_schema():
+  # Creates the schema on the configured database.
+  async with config.engine.begin() as conn:
+    await conn.run_sync(models.Base.metadata.drop_all)
+    await conn.run_sync(models.Base.metadata.create_all)
+  return config.engine
+
+def prepare_workdir() -> Path:
+  # The app reads and writes ./assets relative to the working directory, so
+  # load runs happen inside BENCH_DIR and never touch the checkout's assets.
+  # Has to run before src.utiles or run.py are imported.
+  source = Path.cwd() / "assets" / "images"
+  os.chdir(BENCH_DIR)
+  for name in ("images", "product_images", "image_photos"):
+    (BENCH_DIR / "assets" / name).mkdir(parents=True, exist_ok=True)
+  if source.is_dir():
+    for image in source.iterdir():
+      if image.is_file():
+        shutil.copy(image, BENCH_DIR / "assets" / "images" / image.name)
+  return BENCH_DIR
@@ -0,0 +1,428 @@
+from benchmarks.common import BENCH_DIR, create_schema, prepare_workdir
+from sqlalchemy import insert, text
+from PIL import Image
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+# Dataset presets: products, with one seller per PRODUCTS_PER_USER products.
+SIZES = {"1k": 1000, "100k": 100_000, "1m": 1_000_000}
+PRODUCTS_PER_USER = 20
+SEED_BATCH = 10_000
+PASSWORD = "benchmark-password"
+BASE_PHONE = 1_000_000_000
+SIGNUP_PHONE = 2_000_000_000
+
+# Read paths first so the caches are measured warm and cold before any
+# write scenario invalidates them; deletions go last.
+SCENARIOS = (
+  "feed",
+  "feed_pages",
+  "product_detail",
+  "product_batch",
+  "seller_products",
+  "seller_stats",
+  "catalog_stats",
+  "search",
+  "sync",
+  "login",
+  "signup",
+  "update_user",
+  "create_product",
+  "import_products",
+  "export_seller",
+  "cache_stats",
+  "asset",
+  "delete_product",
+  "delete_user",
+)
+HOT_SCENARIOS = ("feed", "login", "create_product", "delete_user")
+
+class Dataset:
+  def __init__(self, rng: random.Random):
+    self.rng = rng
+    self.users = []          # (phone_number, token, user_id)
+    self.deletable = []      # tokens reserved for delete_user
+    self.product_ids = 0
+    self.images = []
+    self.created_products = []
+    self.signups = 0
+    self.upload = b""
+
+  def user(self):
+    return self.rng.choice(self.users)
+
+def make_image(rng: random.Random, width: int = 800, height: int = 600) -> bytes:
+  color = tuple(rng.randrange(256) for _ in range(3))
+  image = Image.new("RGB", (width, height), color)
+  for _ in range(20):
+    x, y = rng.randrange(width), rng.randrange(height)
+    image.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, x + 80, y + 60))
+  buffer = io.BytesIO()
+  image.save(buffer, "JPEG", quality=85)
+  return buffer.getvalue()
+
+# ###################### SEEDING #######################
+async def seed(products: int, images: int, reserved: int, rng: random.Random) -> Dataset:
+  import src.config as config
+  import src.models as models
+  import src.aggregates as aggregates
+  from src.v1 import spe
+
+  data = Dataset(rng)
+  engine = await create_schema()
+  async with engine.begin() as conn:
+    if engine.dialect.name == "sqlite":
+      # Lets the read scenarios run alongside the writers.
+      await conn.execute(text("PRAGMA journal_mode=WAL"))
+
+  for n in range(images):
+    path = BENCH_DIR / "assets" / "product_images" / f"seed-{n}.jpg"
+    path.write_bytes(make_image(rng))
+    data.images.append(f"assets/product_images/{path.name}")
+  data.upload = make_image(rng)
+
+  # Every password is encrypted like a real signup so /checkuser/ does the
+  # same decryption work it does in production.
+  sellers = max(1, products // PRODUCTS_PER_USER)
+  total_users = sellers + reserved
+  now = datetime.datetime.now()
+  async with config.SessionLocal() as db:
+    for start in range(0, total_users, SEED_BATCH):
+      rows = [
+        {
+          "full_name": f"Seller {n}",
+          "username": f"seller{n}",
+          "phone_number": BASE_PHONE + n,
+          "password": spe.encrypt(PASSWORD),
+          "token": f"bench-token-{n}",
+        }
+        for n in range(start, min(start + SEED_BATCH, total_users))
+      ]
+      await db.execute(insert(models.User), rows)
+      await db.commit()
+
+    # Reserved users get products too, so delete_user archives real rows.
+    for start in range(0, products + reserved * 5, SEED_BATCH):
+      rows = []
+      for n in range(start, min(start + SEED_BATCH, products + reserved * 5)):
+        user_index = n % sellers if n < products else sellers + (n - products) // 5
+        rows.append({
+          "user_id": user_index + 1,
+          "title": f"Product {n}",
+          "description": "Second-hand item in good condition, pick-up or delivery. " * 2,
+          "price": n % 900 + 0.99,
+          "image": rng.choice(data.images) if data.images else None,
+          "available": n % 4 != 0,
+          "created_at": now - datetime.timedelta(seconds=n),
+        })
+      await db.execute(insert(models.Products), rows)
+      await db.commit()
+    await aggregates.rebuild(db)
+
+  data.users = [(BASE_PHONE + n, f"bench-token-{n}", n + 1) for n in range(sellers)]
+  data.deletable = [f"bench-token-{n}" for n in range(sellers, total_users)]
+  data.product_ids = products
+  return data
+
+# ###################### SCENARIOS #######################
+API = "/api/v1"
+
+def upload_payload(data: Dataset, index: int) -> bytes:
+  # Bytes after the JPEG end marker are ignored by decoders but change the
+  # content hash, so every upload is stored instead of deduplicated.
+  return data.upload + f"bench-{index}".encode()
+
+async def feed(client, data, index, state):
+  return await client.get(f"{API}/products/", params={"limit": 50})
+
+async def feed_pages(client, data, index, state):
+  # Each worker walks the feed with the cursor and starts over after 20 pages.
+  params = {"limit": 50}
+  if state.get("cursor") and state.get("pages", 0) < 20:
+    params["cursor"] = state["cursor"]
+    state["pages"] = state.get("pages", 0) + 1
+  else:
+    state["pages"] = 0
+  response = await client.get(f"{API}/products/", params=params)
+  state["cursor"] = response.headers.get("x-next-cursor")
+  return response
+
+async def product_detail(client, data, index, state):
+  return await client.get(f"{API}/products/{data.rng.randint(1, max(1, data.product_ids))}/")
+
+async def product_batch(client, data, index, state):
+  # A favourites screen: 30 products in one request.
+  ids = [data.rng.randint(1, max(1, data.product_ids)) for _ in range(30)]
+  return await client.post(f"{API}/products/batch/", json={"ids": ids})
+
+async def seller_products(client, data, index, state):
+  _, token, _ = data.user()
+  return await client.get(f"{API}/products/bytoken/{token}/", params={"limit": 20})
+
+async def seller_stats(client, data, index, state):
+  _, token, _ = data.user()
+  return await client.get(f"{API}/products/bytoken/{token}/stats/")
+
+async def catalog_stats(client, data, index, state):
+  return await client.get(f"{API}/products/stats/")
+
+SEARCH_QUERIES = ("product", "second hand", "good condition", "pick", "deliv", "item in good")
+
+async def search(client, data, index, state):
+  return await client.get(f"{API}/products/search/", params={"q": data.rng.choice(SEARCH_QUERIES), "limit": 20})
+
+async def sync(client, data, index, state):
+  # Each worker pages through a full sync, then keeps polling with its
+  # last token like an up-to-date client would.
+  params = {"limit": 200}
+  if state.get("sync_token"):
+    params["token"] = state["sync_token"]
+  response = await client.get(f"{API}/products/sync/", params=params)
+  if response.status_code == 200:
+    state["sync_token"] = response.json()["sync_token"]
+  return response
+
+async def login(client, data, index, state):
+  phone_number, _, _ = data.user()
+  return await client.post(f"{API}/checkuser/", json={"phone_number": str(phone_number), "password": PASSWORD})
+
+async def signup(client, data, index, state):
+  data.signups += 1
+  n = data.signups
+  return await client.post(f"{API}/adduser/", json={
+    "full_name": f"New User {n}",
+    "username": f"newuser{n}",
+    "phone_number": str(SIGNUP_PHONE + n),
+    "password": PASSWORD,
+  })
+
+async def duplicate_signup(client, data, index, state):
+  # Usernames the signup scenario already took: times the IntegrityError
+  # -> 400 path. Run by bench_signup.py after signup, not in SCENARIOS.
+  n = data.rng.randint(1, max(1, data.signups))
+  return await client.post(f"{API}/adduser/", json={
+    "full_name": f"New User {n}",
+    "username": f"newuser{n}",
+    "phone_number": str(SIGNUP_PHONE + 10_000_000 + index),
+    "password": PASSWORD,
+  })
+
+async def update_user(client, data, index, state):
+  _, token, _ = data.user()
+  return await client.put(f"{API}/updateuser/", data={"token": token, "full_name": f"Renamed {index}", "password": PASSWORD})
+
+async def create_product(client, data, index, state):
+  _, token, _ = data.user()
+  response = await client.post(
+    f"{API}/create-product/",
+    data={
+      "token": token,
+      "title": f"Created {index}",
+      "description": "Created by the load test",
+      "price": "19.99",
+      "available": "true",
+    },
+    files={"image": (f"upload-{index}.jpg", upload_payload(data, index), "image/jpeg")},
+  )
+  if response.status_code == 200:
+    data.created_products.append(response.json()["id"])
+  return response
+
+async def import_products(client, data, index, state):
+  _, token, _ = data.user()
+  rows = "".join(
+    json.dumps({"title": f"Imported {index}-{n}", "description": "bulk", "price": "9.50"}) + "\n"
+    for n in range(100)
+  )
+  return await client.post(
+    f"{API}/products/import/",
+    data={"token": token},
+    files={"file": ("products.ndjson", rows.encode(), "application/x-ndjson")},
+  )
+
+async def export_seller(client, data, index, state):
+  _, _, user_id = data.user()
+  return await client.get(f"{API}/products/export/", params={"user_id": user_id})
+
+async def cache_stats(client, data, index, state):
+  return await client.get(f"{API}/cache/stats/")
+
+async def asset(client, data, index, state):
+  return await client.get("/" + data.rng.choice(data.images))
+
+async def delete_product(client, data, index, state):
+  if data.created_products:
+    product_id = data.created_products.pop()
+  else:
+    product_id = data.rng.randint(1, max(1, data.product_ids))
+  return await client.delete(f"{API}/products/delete/{product_id}")
+
+async def delete_user(client, data, index, state):
+  if not data.deletable:
+    return None
+  return await client.request("DELETE", f"{API}/deleteuser/", json={"token": data.deletable.pop()})
+
+# ###################### RUNNER #######################
+def percentile(sorted_values: list, fraction: float) -> float:
+  if not sorted_values:
+    return 0.0
+  rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+  return sorted_values[rank]
+
+def statement_totals() -> tuple:
+  import src.metrics as metrics
+  statements = sum(state[1] for state in metrics.REQUEST_STATEMENTS._values.values())
+  requests = sum(state[2] for state in metrics.REQUEST_STATEMENTS._values.values())
+  db_seconds = sum(state[1] for state in metrics.REQUEST_DB_SECONDS._values.values())
+  return statements, requests, db_seconds
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+  # ru_maxrss is KiB on Linux and bytes on macOS.
+  peak = resource.getrusage(who).ru_maxrss
+  return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+async def run_scenario(client, data: Dataset, name: str, requests: int, concurrency: int) -> dict:
+  scenario = globals()[name]
+  latencies, statuses = [], {}
+  errors = 0
+  counter = iter(range(requests))
+
+  async def worker():
+    nonlocal errors
+    state = {}
+    for index in counter:
+      started = time.perf_counter()
+      try:
+        response = await scenario(client, data, index, state)
+      except Exception:
+        errors += 1
+        statuses["exception"] = statuses.get("exception", 0) + 1
+        continue
+      if response is None:
+        continue
+      await response.aread()
+      latencies.append(time.perf_counter() - started)
+      statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+      if response.status_code >= 400:
+        errors += 1
+
+  before = statement_totals()
+  started = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - started
+  statements, served, db_seconds = (after - prior for after, prior in zip(statement_totals(), before))
+
+  latencies.sort()
+  return {
+    "requests": len(latencies),
+    "errors": errors,
+    "status": statuses,
+    "seconds": round(elapsed, 3),
+    "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+    "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+    "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    "statements_per_request": round(statements / served, 2) if served else 0.0,
+    "db_ms_per_request": round(db_seconds / served * 1000, 2) if served else 0.0,
+    "peak_rss_mb": peak_rss_mb(),
+  }
+
+def git_revision():
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+      cwd=sys.path[0] or None,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+async def main(args) -> dict:
+  import httpx
+  import sqlalchemy
+  import src.config as config
+  import src.images as images
+  import src.tasks as tasks
+  from src.search import index as search_index
+  from run import app
+
+  rng = random.Random(args.seed)
+  products = args.products or SIZES[args.size]
+  started = time.perf_counter()
+  data = await seed(products, args.images, args.requests, rng)
+  seed_seconds = time.perf_counter() - started
+  # httpx does not run the lifespan, so the index is built here.
+  started = time.perf_counter()
+  await search_index.build()
+  search_seconds = time.perf_counter() - started
+
+  report = {
+    "meta": {
+      "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+      "revision": git_revision(),
+      "python": platform.python_version(),
+      "sqlalchemy": sqlalchemy.__version__,
+      "database": config.engine.dialect.name,
+      "products": products,
+      "users": len(data.users) + len(data.deletable),
+      "images": len(data.images),
+      "requests": args.requests,
+      "concurrency": args.concurrency,
+      "seed": args.seed,
+      "seed_seconds": round(seed_seconds, 2),
+      "search_build_seconds": round(search_seconds, 2),
+    },
+    "scenarios": {},
+  }
+
+  transport = httpx.ASGITransport(app=app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+    for name in args.scenarios:
+      report["scenarios"][name] = await run_scenario(client, data, name, args.requests, args.concurrency)
+      print(f"{name}: {json.dumps(report['scenarios'][name])}", file=sys.stderr)
+
+  # Variant renders scheduled by the uploads still belong to this run.
+  await images.drain()
+  await tasks.queue.drain(60)
+  images.shutdown_pool()
+  await config.engine.dispose()
+  if config.read_engine is not None:
+    await config.read_engine.dispose()
+  report["peak_rss_mb"] = peak_rss_mb()
+  report["children_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+  return report
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Seed a synthetic catalog and load-test every API route in-process")
+  parser.add_argument("--size", choices=sorted(SIZES), default="1k", help="dataset preset (products)")
+  parser.add_argument("--products", type=int, help="exact product count, overrides --size")
+  parser.add_argument("--images", type=int, default=20, help="distinct seeded product images")
+  parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+  parser.add_argument("--hot", action="store_true", help=f"only run {', '.join(HOT_SCENARIOS)}")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout, help="JSON report path")
+  parser.add_argument("--keep", action="store_true", help=f"keep the database and assets in {BENCH_DIR}")
+  args = parser.parse_args()
+  if args.hot:
+    args.scenarios = list(HOT_SCENARIOS)
+
+  prepare_workdir()
+  try:
+    report = asyncio.run(main(args))
+  finally:
+    if not args.keep:
+      shutil.rmtree(BENCH_DIR, ignore_errors=True)
+  json.dump(report, args.output, indent=2)
+  args.output.write("\n")
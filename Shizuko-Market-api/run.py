@@ -1,21 +1,32 @@
 from fastapi import FastAPI
 from src.v1 import APIV1
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from src.assets import AssetFiles
+import src.admission as admission
+import src.config as config
+import src.metrics as metrics
+import src.lifecycle as lifecycle
 
-app = FastAPI()
+app = FastAPI(lifespan=lifecycle.lifespan)
 api_v1 = APIV1()
 
-app.mount("/assets", StaticFiles(directory="assets"), name="public")
+app.mount("/assets", AssetFiles(directory="assets"), name="public")
 app.include_router(api_v1.router)
+app.add_api_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+# Innermost: shed requests still get CORS headers and show up in metrics.
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(config.WriteMarkerMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Last-Write"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 if __name__ == "__main__":
-  import uvicorn
-  uvicorn.run(app, host="0.0.0.0")
\ No newline at end of file
+  # python run.py --workers 4: one preloaded parent, forked workers.
+  import src.server as server
+  server.main(app)
\ No newline at end of file
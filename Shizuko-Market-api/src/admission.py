@@ -0,0 +1,219 @@
+from fastapi import HTTPException
+from collections import OrderedDict
+import src.metrics as metrics
+import src.responses as responses
+import asyncio
+import math
+import os
+import time
+
+# Requests never reach the pool faster than it can serve them: each client
+# gets a token bucket, and each route class a cap on requests in flight
+# with a short, bounded wait queue. Whatever does not fit is answered at
+# once with 429 (this client is over its rate) or 503 (the server is full),
+# both with Retry-After, instead of queueing on the pool.
+
+def _setting(name: str, default: str) -> float:
+  return float(os.getenv(name, default))
+
+# Cheap paths that never touch the database, and the scraper.
+EXEMPT_PREFIXES = ("/assets/", "/metrics", "/docs", "/redoc", "/openapi.json")
+
+# ###################### RATE LIMITS #######################
+class RateLimiter:
+  # Token buckets keyed by client, in an LRU bounded by maxsize. A key
+  # evicted while idle comes back with a full bucket, which is what it
+  # would have refilled to anyway. rate <= 0 disables the limiter.
+  def __init__(self, name: str, rate: float, burst: float, maxsize: int = 100000):
+    self.name = name
+    self.rate = rate
+    self.burst = max(burst, 1.0)
+    self.maxsize = maxsize
+    self.rejected = 0
+    self._buckets = OrderedDict()
+
+  def acquire(self, key: str) -> float:
+    # 0 when the request may go ahead, otherwise seconds until it could.
+    if self.rate <= 0:
+      return 0.0
+    now = time.monotonic()
+    tokens, updated = self._buckets.pop(key, (self.burst, now))
+    tokens = min(self.burst, tokens + (now - updated) * self.rate)
+    wait = 0.0
+    if tokens >= 1:
+      tokens -= 1
+    else:
+      wait = (1 - tokens) / self.rate
+      self.rejected += 1
+      REJECTED.inc(limiter=self.name)
+    self._buckets[key] = (tokens, now)
+    if len(self._buckets) > self.maxsize:
+      self._buckets.popitem(last=False)
+    return wait
+
+  def clear(self):
+    self._buckets.clear()
+
+  def stats(self) -> dict:
+    return {"size": len(self._buckets), "maxsize": self.maxsize, "rejected": self.rejected}
+
+# ###################### CONCURRENCY #######################
+class ConcurrencyLimit:
+  # At most `limit` requests of a class run at once; up to `queue` more
+  # wait for a slot for at most `timeout` seconds. limit <= 0 disables it.
+  def __init__(self, name: str, limit: int, queue: int, timeout: float):
+    self.name = name
+    self.limit = limit
+    self.queue = queue
+    self.timeout = timeout
+    self.in_flight = 0
+    self.waiting = 0
+    self.rejected = 0
+    self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+
+  async def acquire(self) -> bool:
+    if self._semaphore is None:
+      return True
+    if not self._semaphore.locked():
+      await self._semaphore.acquire()
+      self.in_flight += 1
+      return True
+    if self.waiting >= self.queue or self.timeout <= 0:
+      return self._reject()
+    self.waiting += 1
+    started = time.perf_counter()
+    try:
+      await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+    except asyncio.TimeoutError:
+      return self._reject()
+    finally:
+      self.waiting -= 1
+      QUEUE_SECONDS.observe(time.perf_counter() - started, route_class=self.name)
+    self.in_flight += 1
+    return True
+
+  def release(self):
+    if self._semaphore is not None:
+      self.in_flight -= 1
+      self._semaphore.release()
+
+  def _reject(self) -> bool:
+    self.rejected += 1
+    REJECTED.inc(limiter=self.name)
+    return False
+
+  def stats(self) -> dict:
+    return {
+      "limit": self.limit,
+      "in_flight": self.in_flight,
+      "waiting": self.waiting,
+      "rejected": self.rejected,
+    }
+
+# ###################### METRICS #######################
+REJECTED = metrics.Counter("shizuko_admission_rejected_total", "Requests refused by admission control", ("limiter",))
+ADMITTED = metrics.Counter("shizuko_admission_admitted_total", "Requests let through admission control", ("route_class",))
+QUEUE_SECONDS = metrics.Histogram(
+  "shizuko_admission_queue_seconds", "Time spent waiting for a concurrency slot", ("route_class",)
+)
+
+def _limit_samples(field: str):
+  def collect():
+    for name, limit in LIMITS.items():
+      yield (name,), getattr(limit, field)
+  return collect
+
+metrics.Gauge("shizuko_admission_in_flight", "Admitted requests still running", ("route_class",), collect=_limit_samples("in_flight"))
+metrics.Gauge("shizuko_admission_queued", "Requests waiting for a concurrency slot", ("route_class",), collect=_limit_samples("waiting"))
+metrics.Gauge("shizuko_admission_limit", "Concurrency cap per route class", ("route_class",), collect=_limit_samples("limit"))
+
+# ###################### LIMITERS #######################
+ip_limiter = RateLimiter(
+  "ip",
+  _setting("ADMISSION_IP_RATE", "50"),
+  _setting("ADMISSION_IP_BURST", "100"),
+  int(_setting("ADMISSION_MAX_CLIENTS", "100000")),
+)
+token_limiter = RateLimiter(
+  "token",
+  _setting("ADMISSION_TOKEN_RATE", "20"),
+  _setting("ADMISSION_TOKEN_BURST", "40"),
+  int(_setting("ADMISSION_MAX_CLIENTS", "100000")),
+)
+
+QUEUE_TIMEOUT = _setting("ADMISSION_QUEUE_SECONDS", "0.5")
+
+def _concurrency(name: str, limit: str) -> ConcurrencyLimit:
+  limit = int(_setting(f"ADMISSION_{name.upper()}", limit))
+  return ConcurrencyLimit(name, limit, int(_setting(f"ADMISSION_{name.upper()}_QUEUE", str(limit))), QUEUE_TIMEOUT)
+
+# Writes and uploads hold a pooled connection for most of their run, so
+# they are capped close to the default pool (5 + 10 overflow). Reads are
+# mostly served from the response cache.
+LIMITS = {
+  "reads": _concurrency("reads", "64"),
+  "writes": _concurrency("writes", "16"),
+  "uploads": _concurrency("uploads", "8"),
+}
+
+for _name, _limiter in (("ip", ip_limiter), ("token", token_limiter)):
+  metrics.register_cache(f"admission_{_name}", _limiter.stats, counters=(), gauges=("size",))
+
+def route_class(scope) -> str:
+  if scope["method"] in ("GET", "HEAD", "OPTIONS"):
+    return "reads"
+  for name, value in scope.get("headers", ()):
+    if name == b"content-type":
+      return "uploads" if value.startswith(b"multipart/form-data") else "writes"
+  return "writes"
+
+def retry_after(seconds: float) -> str:
+  return str(max(1, math.ceil(seconds)))
+
+def check_token(token: str):
+  # Called by the write handlers before they resolve the caller's token:
+  # tokens travel in form fields and JSON bodies, which the middleware does
+  # not read. Public pages keyed by a seller's token are not charged to it.
+  wait = token_limiter.acquire(token)
+  if wait:
+    raise HTTPException(status_code=429, detail="Too many requests for this token", headers={"Retry-After": retry_after(wait)})
+
+def stats() -> dict:
+  return {
+    "ip": ip_limiter.stats(),
+    "token": token_limiter.stats(),
+    **{name: limit.stats() for name, limit in LIMITS.items()},
+  }
+
+class AdmissionMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PREFIXES):
+      return await self.app(scope, receive, send)
+
+    client = scope.get("client")
+    wait = ip_limiter.acquire(client[0] if client else "unknown")
+    if wait:
+      return await reject(send, 429, "Too many requests", retry_after(wait))
+
+    name = route_class(scope)
+    limit = LIMITS[name]
+    if not await limit.acquire():
+      return await reject(send, 503, "Server is busy, try again shortly", retry_after(limit.timeout))
+    ADMITTED.inc(route_class=name)
+    try:
+      await self.app(scope, receive, send)
+    finally:
+      limit.release()
+
+async def reject(send, status: int, detail: str, retry: str):
+  body = responses.dumps({"detail": detail})
+  headers = [
+    (b"content-type", b"application/json"),
+    (b"content-length", str(len(body)).encode()),
+    (b"retry-after", retry.encode()),
+  ]
+  await send({"type": "http.response.start", "status": status, "headers": headers})
+  await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,239 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import case, delete, func, insert, literal, update
+from decimal import Decimal
+from typing import NamedTuple, Optional
+import src.models as models
+import src.config as config
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+
+# Seller and catalog aggregates (counts, price range, newest listing) in
+# seller_stats, so dashboards read a row or two instead of a seller's
+# products. Writers call add_products/remove_products before committing.
+# Sums and counts are plain increments; a removal that takes away a
+# seller's minimum, maximum or newest listing recomputes it from products
+# in the same UPDATE.
+#
+# The catalog's counts live in CATALOG_SHARDS rows (user_ids -1..-N) and
+# each write adds to one of them at random, so concurrent writers do not
+# queue on a single row lock; reads sum the shards. The catalog's price
+# range and newest listing are read off the seller rows' indexes instead.
+CATALOG_SHARDS = max(1, int(os.getenv("AGGREGATE_SHARDS", "16")))
+CENTS = Decimal("0.01")
+
+class Delta(NamedTuple):
+  count: int
+  available: int
+  price_sum: Decimal
+  min_price: Optional[Decimal]
+  max_price: Optional[Decimal]
+  last_listed_at: Optional[datetime.datetime]
+
+def delta(products) -> Delta:
+  # products: (price, available, created_at) of the rows added or removed.
+  count = available = 0
+  price_sum = Decimal(0)
+  min_price = max_price = last_listed_at = None
+  for price, is_available, created_at in products:
+    # Rounded to cents like the Numeric(10, 2) column stores it.
+    price = Decimal(str(price)).quantize(CENTS)
+    count += 1
+    available += 1 if is_available else 0
+    price_sum += price
+    min_price = price if min_price is None else min(min_price, price)
+    max_price = price if max_price is None else max(max_price, price)
+    if created_at is not None:
+      last_listed_at = created_at if last_listed_at is None else max(last_listed_at, created_at)
+  return Delta(count, available, price_sum, min_price, max_price, last_listed_at)
+
+def _shard() -> int:
+  return -random.randint(1, CATALOG_SHARDS)
+
+def _dialect(db: AsyncSession) -> str:
+  return db.get_bind().dialect.name
+
+def _least(dialect: str, a, b):
+  # SQLite spells the two-argument forms min()/max().
+  return func.min(a, b) if dialect == "sqlite" else func.least(a, b)
+
+def _greatest(dialect: str, a, b):
+  return func.max(a, b) if dialect == "sqlite" else func.greatest(a, b)
+
+def _shard_row(count: int, available: int, price_sum: Decimal) -> dict:
+  return {
+    "user_id": _shard(),
+    "product_count": count,
+    "available_count": available,
+    "price_sum": price_sum,
+    "min_price": None,
+    "max_price": None,
+    "last_listed_at": None,
+  }
+
+async def _upsert(db: AsyncSession, rows: list):
+  # Adds the rows' counts to existing rows and widens their ranges. Shard
+  # rows carry NULL ranges, which keeps theirs NULL.
+  dialect = _dialect(db)
+  table = models.SellerStats.__table__
+  if dialect == "mysql":
+    from sqlalchemy.dialects.mysql import insert as upsert
+  elif dialect == "postgresql":
+    from sqlalchemy.dialects.postgresql import insert as upsert
+  else:
+    from sqlalchemy.dialects.sqlite import insert as upsert
+  statement = upsert(table).values(rows)
+  new = statement.inserted if dialect == "mysql" else statement.excluded
+  changes = {
+    "product_count": table.c.product_count + new.product_count,
+    "available_count": table.c.available_count + new.available_count,
+    "price_sum": table.c.price_sum + new.price_sum,
+    "min_price": _least(dialect, func.coalesce(table.c.min_price, new.min_price), new.min_price),
+    "max_price": _greatest(dialect, func.coalesce(table.c.max_price, new.max_price), new.max_price),
+    "last_listed_at": _greatest(
+      dialect, func.coalesce(table.c.last_listed_at, new.last_listed_at), new.last_listed_at
+    ),
+  }
+  if dialect == "mysql":
+    statement = statement.on_duplicate_key_update(**changes)
+  else:
+    statement = statement.on_conflict_do_update(index_elements=["user_id"], set_=changes)
+  await db.execute(statement)
+
+async def add_products(db: AsyncSession, user_id: int, change: Delta):
+  # One upsert for the seller row and a catalog shard.
+  if not change.count:
+    return
+  seller = {
+    "user_id": user_id,
+    "product_count": change.count,
+    "available_count": change.available,
+    "price_sum": change.price_sum,
+    "min_price": change.min_price,
+    "max_price": change.max_price,
+    "last_listed_at": change.last_listed_at,
+  }
+  await _upsert(db, [seller, _shard_row(change.count, change.available, change.price_sum)])
+
+def _removal(user_id: int, change: Delta) -> dict:
+  # SET clause taking `change` away from a seller row.
+  table = models.SellerStats.__table__
+
+  def recompute(column, aggregate, still_valid):
+    # Keeps the stored value unless the removed rows may have held it.
+    subquery = select(aggregate).where(models.Products.user_id == user_id).scalar_subquery()
+    return case((still_valid, column), else_=subquery)
+
+  values = {
+    "product_count": table.c.product_count - change.count,
+    "available_count": table.c.available_count - change.available,
+    "price_sum": table.c.price_sum - change.price_sum,
+  }
+  if change.min_price is not None:
+    values["min_price"] = recompute(table.c.min_price, func.min(models.Products.price), table.c.min_price < change.min_price)
+    values["max_price"] = recompute(table.c.max_price, func.max(models.Products.price), table.c.max_price > change.max_price)
+  if change.last_listed_at is not None:
+    values["last_listed_at"] = recompute(
+      table.c.last_listed_at, func.max(models.Products.created_at), table.c.last_listed_at > change.last_listed_at
+    )
+  return values
+
+async def _remove_from_catalog(db: AsyncSession, change: Delta):
+  # Any shard will do, even one not written yet: only the sum over the
+  # shards means anything.
+  await _upsert(db, [_shard_row(-change.count, -change.available, -change.price_sum)])
+
+async def remove_products(db: AsyncSession, user_id: int, change: Delta):
+  # Run after the products are deleted, so the recomputations skip them.
+  if not change.count:
+    return
+  await db.execute(
+    update(models.SellerStats).where(models.SellerStats.user_id == user_id).values(**_removal(user_id, change))
+  )
+  await _remove_from_catalog(db, change)
+
+async def sellers_delta(db: AsyncSession, user_ids: list) -> Delta:
+  # What a set of seller rows adds up to, read before their products go.
+  result = await db.execute(
+    select(
+      func.coalesce(func.sum(models.SellerStats.product_count), 0),
+      func.coalesce(func.sum(models.SellerStats.available_count), 0),
+      func.coalesce(func.sum(models.SellerStats.price_sum), 0),
+    ).where(models.SellerStats.user_id.in_(user_ids))
+  )
+  count, available, price_sum = result.one()
+  return Delta(int(count), int(available), Decimal(str(price_sum)), None, None, None)
+
+async def remove_sellers(db: AsyncSession, user_ids: list, change: Delta):
+  # Run after the sellers' products are deleted.
+  await db.execute(delete(models.SellerStats).where(models.SellerStats.user_id.in_(user_ids)))
+  if change.count:
+    await _remove_from_catalog(db, change)
+
+async def read(db: AsyncSession, user_id: Optional[int] = None):
+  # One seller's row, or the catalog when user_id is None.
+  if user_id is not None:
+    result = await db.execute(select(models.SellerStats).where(models.SellerStats.user_id == user_id))
+    return result.scalars().first()
+  stats = models.SellerStats
+  sellers = stats.user_id > 0
+  result = await db.execute(
+    select(
+      func.coalesce(func.sum(stats.product_count), 0).label("product_count"),
+      func.coalesce(func.sum(stats.available_count), 0).label("available_count"),
+      func.coalesce(func.sum(stats.price_sum), 0).label("price_sum"),
+      select(func.min(stats.min_price)).where(sellers).scalar_subquery().label("min_price"),
+      select(func.max(stats.max_price)).where(sellers).scalar_subquery().label("max_price"),
+      select(func.max(stats.last_listed_at)).where(sellers).scalar_subquery().label("last_listed_at"),
+    ).where(stats.user_id < 0)
+  )
+  return result.one()
+
+# ###################### REBUILD #######################
+async def rebuild(db: AsyncSession) -> dict:
+  # Recomputes every row from products in one transaction: run it after
+  # first deploying seller_stats or whenever the rows are in doubt. The
+  # catalog totals go to a single shard.
+  columns = ["user_id", "product_count", "available_count", "price_sum", "min_price", "max_price", "last_listed_at"]
+  counts = (
+    func.count(),
+    func.coalesce(func.sum(case((models.Products.available == True, 1), else_=0)), 0),  # noqa: E712
+    func.coalesce(func.sum(models.Products.price), 0),
+  )
+  await db.execute(delete(models.SellerStats))
+  sellers = await db.execute(
+    insert(models.SellerStats).from_select(
+      columns,
+      select(
+        models.Products.user_id,
+        *counts,
+        func.min(models.Products.price),
+        func.max(models.Products.price),
+        func.max(models.Products.created_at),
+      ).group_by(models.Products.user_id),
+    )
+  )
+  await db.execute(insert(models.SellerStats).from_select(columns[:4], select(literal(-1), *counts)))
+  await db.commit()
+  return {"sellers": sellers.rowcount}
+
+async def main() -> dict:
+  started = time.perf_counter()
+  try:
+    async with config.SessionLocal() as db:
+      totals = await rebuild(db)
+  finally:
+    await config.dispose_engines()
+  totals["seconds"] = round(time.perf_counter() - started, 3)
+  return totals
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Rebuild seller and catalog aggregates from products")
+  parser.add_argument("command", choices=["rebuild"])
+  parser.parse_args()
+  print(json.dumps(asyncio.run(main())))
@@ -0,0 +1,107 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import DateTime, and_, delete, insert, literal
+import src.aggregates as aggregates
+import src.models as models
+import src.config as config
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+BATCH_SIZE = 500
+
+async def archive_users(db: AsyncSession, user_ids: list) -> dict:
+  # Moves the users and all of their products into users_d/products_d with
+  # a fixed number of set-based statements, whatever the number of products. Nothing is
+  # committed here, so callers get all-or-nothing by committing once.
+  if not user_ids:
+    return {"users": 0, "products": 0}
+
+  # DATETIME columns drop sub-second precision on MySQL, and the stamp is
+  # used below to find the rows this call inserted.
+  deleted_at = datetime.datetime.now().replace(microsecond=0)
+  stamp = literal(deleted_at, DateTime)
+
+  users = await db.execute(
+    insert(models.UserD).from_select(
+      ["full_name", "username", "phone_number", "password", "token", "profile_img", "deleted_at"],
+      select(
+        models.User.full_name,
+        models.User.username,
+        models.User.phone_number,
+        models.User.password,
+        models.User.token,
+        models.User.profile_img,
+        stamp,
+      ).where(models.User.id.in_(user_ids)),
+    )
+  )
+
+  # users_d gets fresh ids, so archived products are linked back through
+  # the (token, deleted_at) pair of the row inserted just above.
+  products = await db.execute(
+    insert(models.ProductsD).from_select(
+      ["user_id", "title", "description", "price", "image", "available", "deleted_at"],
+      select(
+        models.UserD.id,
+        models.Products.title,
+        models.Products.description,
+        models.Products.price,
+        models.Products.image,
+        models.Products.available,
+        stamp,
+      )
+      .join(models.User, models.User.id == models.Products.user_id)
+      .join(
+        models.UserD,
+        and_(models.UserD.token == models.User.token, models.UserD.deleted_at == stamp),
+      )
+      .where(models.User.id.in_(user_ids)),
+    )
+  )
+
+  # Delta sync clients learn about the removed products from tombstones.
+  await db.execute(
+    insert(models.ProductTombstone).from_select(
+      ["product_id", "user_id", "deleted_at"],
+      select(models.Products.id, models.Products.user_id, stamp).where(models.Products.user_id.in_(user_ids)),
+    )
+  )
+  removed = await aggregates.sellers_delta(db, user_ids)
+  await db.execute(delete(models.Products).where(models.Products.user_id.in_(user_ids)))
+  await aggregates.remove_sellers(db, user_ids, removed)
+  await db.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+  return {"users": users.rowcount, "products": products.rowcount}
+
+async def archive_batch(user_ids: list, batch_size: int = BATCH_SIZE) -> dict:
+  # Admin mode: every batch is archived in its own transaction.
+  totals = {"users": 0, "products": 0}
+  async with config.SessionLocal() as db:
+    for start in range(0, len(user_ids), batch_size):
+      batch = user_ids[start:start + batch_size]
+      try:
+        counts = await archive_users(db, batch)
+        await db.commit()
+      except Exception:
+        await db.rollback()
+        raise
+      totals["users"] += counts["users"]
+      totals["products"] += counts["products"]
+  return totals
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Archive user accounts and their products")
+  parser.add_argument("user_ids", type=int, nargs="*", help="ids of the users to archive")
+  parser.add_argument("--file", type=argparse.FileType("r"), help="file with one user id per line")
+  parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+  args = parser.parse_args()
+
+  user_ids = list(args.user_ids)
+  if args.file:
+    user_ids += [int(line) for line in args.file if line.strip()]
+  started = time.perf_counter()
+  totals = asyncio.run(archive_batch(user_ids, args.batch_size))
+  totals["seconds"] = round(time.perf_counter() - started, 3)
+  print(json.dumps(totals))
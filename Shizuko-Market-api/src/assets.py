@@ -0,0 +1,228 @@
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import NamedTuple, Optional
+import aiofiles
+import mimetypes
+import os
+import time
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Checked in order of preference when the client accepts them.
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+class AssetMeta(NamedTuple):
+  path: str
+  size: int
+  etag: str
+  last_modified: str
+  mtime: int
+  content_type: str
+  encoded: tuple  # ((encoding, path, size), ...)
+
+class AssetFiles:
+  # Serves the upload directories. Uploaded files are never rewritten in
+  # place (they are named by content hash or uuid), so responses are marked
+  # immutable and per-file metadata is cached instead of stat-ed per hit.
+  def __init__(self, directory: str, meta_cache_size: int = 10000, meta_ttl: float = 300.0):
+    self.directory = Path(directory).resolve()
+    self.meta_cache_size = meta_cache_size
+    self.meta_ttl = meta_ttl
+    self._meta = OrderedDict()
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return
+    if scope["method"] not in ("GET", "HEAD"):
+      return await self._send_empty(send, 405, [(b"allow", b"GET, HEAD")])
+
+    request_path = _route_path(scope)
+    meta = self.lookup(request_path)
+    if meta is None:
+      return await self._send_empty(send, 404)
+
+    headers = _request_headers(scope)
+    # Ranges are only served from the identity file.
+    path, size, encoding = meta.path, meta.size, None
+    range_header = headers.get("range")
+    if range_header and not _if_range_matches(headers.get("if-range"), meta):
+      range_header = None
+    if not range_header:
+      path, size, encoding = _pick_encoding(headers.get("accept-encoding", ""), meta)
+
+    etag = _representation_etag(meta, encoding)
+    base_headers = [
+      (b"etag", etag.encode()),
+      (b"last-modified", meta.last_modified.encode()),
+      (b"cache-control", IMMUTABLE_CACHE_CONTROL.encode()),
+      (b"accept-ranges", b"bytes"),
+    ]
+    if meta.encoded:
+      base_headers.append((b"vary", b"Accept-Encoding"))
+
+    if _not_modified(headers, meta, etag):
+      return await self._send_empty(send, 304, base_headers)
+
+    status, start, end = 200, 0, size - 1
+    if range_header:
+      parsed = _parse_range(range_header, size)
+      if parsed == "invalid":
+        return await self._send_empty(
+          send, 416, base_headers + [(b"content-range", f"bytes */{size}".encode())]
+        )
+      if parsed is not None:
+        status, (start, end) = 206, parsed
+
+    response_headers = base_headers + [
+      (b"content-type", meta.content_type.encode()),
+      (b"content-length", str(max(end - start + 1, 0)).encode()),
+    ]
+    if encoding:
+      response_headers.append((b"content-encoding", encoding.encode()))
+    if status == 206:
+      response_headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+
+    try:
+      f = await aiofiles.open(path, "rb")
+    except FileNotFoundError:
+      # Removed since it was cached, e.g. by the asset garbage collector.
+      self.invalidate(request_path)
+      return await self._send_empty(send, 404)
+
+    try:
+      await send({"type": "http.response.start", "status": status, "headers": response_headers})
+      if scope["method"] == "HEAD":
+        return await send({"type": "http.response.body", "body": b""})
+      await f.seek(start)
+      remaining = end - start + 1
+      while remaining > 0:
+        chunk = await f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+      if remaining > 0:
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+      await f.close()
+
+  def lookup(self, request_path: str) -> Optional[AssetMeta]:
+    entry = self._meta.get(request_path)
+    if entry is not None:
+      meta, expires_at = entry
+      if expires_at >= time.monotonic():
+        self._meta.move_to_end(request_path)
+        return meta
+      del self._meta[request_path]
+
+    meta = self._stat(request_path)
+    if meta is not None:
+      self._meta[request_path] = (meta, time.monotonic() + self.meta_ttl)
+      while len(self._meta) > self.meta_cache_size:
+        self._meta.popitem(last=False)
+    return meta
+
+  def invalidate(self, request_path: str):
+    self._meta.pop(request_path, None)
+
+  def _stat(self, request_path: str) -> Optional[AssetMeta]:
+    relative = request_path.lstrip("/")
+    if not relative:
+      return None
+    full_path = (self.directory / relative).resolve()
+    if self.directory not in full_path.parents or full_path.name.startswith("."):
+      return None
+    try:
+      stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+      return None
+    if not os.path.isfile(full_path):
+      return None
+
+    encoded = []
+    for encoding, suffix in PRECOMPRESSED:
+      sibling = str(full_path) + suffix
+      try:
+        encoded.append((encoding, sibling, os.stat(sibling).st_size))
+      except FileNotFoundError:
+        pass
+
+    content_type = mimetypes.guess_type(full_path.name)[0] or "application/octet-stream"
+    return AssetMeta(
+      path=str(full_path),
+      size=stat.st_size,
+      etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+      last_modified=formatdate(stat.st_mtime, usegmt=True),
+      mtime=int(stat.st_mtime),
+      content_type=content_type,
+      encoded=tuple(encoded),
+    )
+
+  async def _send_empty(self, send, status: int, headers: Optional[list] = None):
+    await send({"type": "http.response.start", "status": status, "headers": headers or []})
+    await send({"type": "http.response.body", "body": b""})
+
+def _route_path(scope) -> str:
+  # Mounted apps get the full path with the mount prefix in root_path on
+  # current Starlette, and the already stripped path on older releases.
+  path, root_path = scope["path"], scope.get("root_path", "")
+  if root_path and path.startswith(root_path):
+    return path[len(root_path):]
+  return path
+
+def _request_headers(scope) -> dict:
+  return {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+
+def _representation_etag(meta: AssetMeta, encoding: Optional[str]) -> str:
+  # Strong validators differ per encoding, so a cache never answers a
+  # request for one encoding with the bytes of another.
+  if encoding is None:
+    return meta.etag
+  return f'{meta.etag[:-1]}-{encoding}"'
+
+def _not_modified(headers: dict, meta: AssetMeta, etag: str) -> bool:
+  if_none_match = headers.get("if-none-match")
+  if if_none_match is not None:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+  if_modified_since = headers.get("if-modified-since")
+  if if_modified_since:
+    try:
+      return meta.mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+      return False
+  return False
+
+def _if_range_matches(if_range: Optional[str], meta: AssetMeta) -> bool:
+  if if_range is None:
+    return True
+  return if_range.strip() in (meta.etag, meta.last_modified)
+
+def _pick_encoding(accept_encoding: str, meta: AssetMeta) -> tuple:
+  accepted = {part.split(";")[0].strip() for part in accept_encoding.split(",")}
+  for encoding, path, size in meta.encoded:
+    if encoding in accepted:
+      return path, size, encoding
+  return meta.path, meta.size, None
+
+def _parse_range(value: str, size: int):
+  # Only single byte ranges are honoured; anything else falls back to a
+  # full 200 response, which RFC 9110 allows.
+  unit, _, spec = value.partition("=")
+  if unit.strip() != "bytes" or "," in spec:
+    return None
+  first, _, last = spec.strip().partition("-")
+  try:
+    if first == "":
+      length = int(last)
+      if length <= 0:
+        return "invalid"
+      return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+  except ValueError:
+    return None
+  if start >= size or end < start:
+    return "invalid"
+  return start, min(end, size - 1)
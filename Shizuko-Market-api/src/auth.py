@@ -0,0 +1,91 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import src.models as models
+import src.metrics as metrics
+import os
+import time
+
+class AuthUser(NamedTuple):
+  id: int
+  full_name: str
+  username: str
+  profile_img: Optional[str]
+
+class TokenCache:
+  # Bounded LRU with a TTL so a token revoked by another worker cannot stay
+  # valid here forever. Misses are not cached, unknown tokens always hit the DB.
+  def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    # Set with several workers, see lifecycle.configure_workers.
+    self.verify_writes = False
+    self._entries = OrderedDict()
+
+  def get(self, token: str) -> Optional[AuthUser]:
+    entry = self._entries.get(token)
+    if entry is None:
+      self.misses += 1
+      return None
+    user, expires_at = entry
+    if expires_at < time.monotonic():
+      del self._entries[token]
+      self.misses += 1
+      return None
+    self._entries.move_to_end(token)
+    self.hits += 1
+    return user
+
+  def set(self, token: str, user: AuthUser):
+    self._entries[token] = (user, time.monotonic() + self.ttl)
+    self._entries.move_to_end(token)
+    while len(self._entries) > self.maxsize:
+      self._entries.popitem(last=False)
+
+  def invalidate(self, token: str):
+    self._entries.pop(token, None)
+
+  def clear(self):
+    self._entries.clear()
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    return {
+      "size": len(self._entries),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / total if total else 0.0,
+    }
+
+token_cache = TokenCache(
+  maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+  ttl=float(os.getenv("AUTH_CACHE_TTL", "300")),
+)
+
+metrics.register_cache("auth_cache", token_cache.stats)
+
+async def resolve_user(db: AsyncSession, token: str) -> Optional[AuthUser]:
+  # Another worker may have just deleted or changed this account, so write
+  # paths look the token up again when caches are per worker.
+  if not (token_cache.verify_writes and db.info.get("write")):
+    user = token_cache.get(token)
+    if user is not None:
+      return user
+  result = await db.execute(
+    select(
+      models.User.id,
+      models.User.full_name,
+      models.User.username,
+      models.User.profile_img,
+    ).filter(models.User.token == token)
+  )
+  row = result.first()
+  if row is None:
+    return None
+  user = AuthUser(*row)
+  token_cache.set(token, user)
+  return user
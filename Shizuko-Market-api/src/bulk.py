@@ -0,0 +1,214 @@
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert
+from pydantic import ValidationError
+from pathlib import PurePosixPath
+from typing import Optional
+import src.models as models
+import src.schemas as schemas
+import src.utiles as utiles
+import src.cache as cache
+import src.search as search
+import src.aggregates as aggregates
+import codecs
+import csv
+import datetime
+import itertools
+import json
+import zipfile
+
+DEFAULT_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ("ndjson", "csv")
+
+class ArchiveImage:
+  # Lets utiles.save_image stream a zip member exactly like an upload.
+  def __init__(self, archive: zipfile.ZipFile, info: zipfile.ZipInfo):
+    self.filename = PurePosixPath(info.filename).name
+    self.size = info.file_size
+    self._member = archive.open(info)
+
+  async def read(self, size: int = -1) -> bytes:
+    return await run_in_threadpool(self._member.read, size)
+
+  def close(self):
+    self._member.close()
+
+def detect_format(file: UploadFile, format: Optional[str]) -> str:
+  if format:
+    if format not in FORMATS:
+      raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    return format
+  name = (file.filename or "").lower()
+  content_type = file.content_type or ""
+  if name.endswith(".csv") or "csv" in content_type:
+    return "csv"
+  if name.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type or "jsonl" in content_type:
+    return "ndjson"
+  raise HTTPException(status_code=400, detail="Could not detect the file format, pass format=ndjson or format=csv")
+
+def iter_rows(file: UploadFile, format: str):
+  # Yields (row_number, data_or_error). Reads the spooled upload lazily, so
+  # only the current batch is ever held in memory.
+  file.file.seek(0)
+  text = codecs.getreader("utf-8")(file.file, errors="replace")
+  if format == "csv":
+    reader = csv.DictReader(text)
+    for row_number, row in enumerate(reader, start=1):
+      yield row_number, {key: value for key, value in row.items() if key is not None}
+    return
+  for row_number, line in enumerate(text, start=1):
+    if not line.strip():
+      continue
+    try:
+      data = json.loads(line)
+    except ValueError as e:
+      yield row_number, e
+      continue
+    if not isinstance(data, dict):
+      data = ValueError("Each line must be a JSON object")
+    yield row_number, data
+
+class ImportReport:
+  def __init__(self):
+    self.inserted = 0
+    self.failed = 0
+    self.errors = []
+
+  def error(self, row_number: int, message: str):
+    self.failed += 1
+    if len(self.errors) < MAX_REPORTED_ERRORS:
+      self.errors.append({"row": row_number, "error": message})
+
+  def as_dict(self) -> dict:
+    return {
+      "inserted": self.inserted,
+      "failed": self.failed,
+      "errors": self.errors,
+      "errors_truncated": self.failed > len(self.errors),
+    }
+
+def _validation_message(error: ValidationError) -> str:
+  return "; ".join(
+    f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors()
+  )
+
+async def _prepare_row(
+  row_number: int,
+  data,
+  user_id: int,
+  archive: Optional[zipfile.ZipFile],
+  saved_images: dict,
+  report: ImportReport,
+) -> Optional[dict]:
+  if isinstance(data, Exception):
+    report.error(row_number, f"Invalid row: {str(data)}")
+    return None
+  try:
+    row = schemas.ProductImport.model_validate(data)
+  except ValidationError as e:
+    report.error(row_number, _validation_message(e))
+    return None
+
+  image_path = None
+  if row.image:
+    if archive is None:
+      report.error(row_number, "Row references an image but no image archive was uploaded")
+      return None
+    image_path = saved_images.get(row.image)
+    if image_path is None:
+      try:
+        info = archive.getinfo(row.image)
+      except KeyError:
+        report.error(row_number, f"Image not found in archive: {row.image}")
+        return None
+      member = ArchiveImage(archive, info)
+      try:
+        image_path = await utiles.save_image(member, 1)
+      except HTTPException as e:
+        report.error(row_number, e.detail)
+        return None
+      finally:
+        member.close()
+      saved_images[row.image] = image_path
+
+  return {
+    "user_id": user_id,
+    "title": row.title,
+    "description": row.description,
+    "price": row.price,
+    "image": image_path,
+    "available": row.available,
+  }
+
+async def import_products(
+  db: AsyncSession,
+  user_id: int,
+  file: UploadFile,
+  format: str,
+  images: Optional[UploadFile] = None,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+) -> dict:
+  report = ImportReport()
+  archive = None
+  if images is not None:
+    try:
+      archive = zipfile.ZipFile(images.file)
+    except zipfile.BadZipFile:
+      raise HTTPException(status_code=400, detail="Image archive is not a valid zip file")
+
+  # Archive member name -> stored path, so rows sharing a picture store it once.
+  saved_images = {}
+  # Batch created_at stamps, to find the new rows again for the search index.
+  inserted_at = []
+  rows = iter_rows(file, format)
+  try:
+    while True:
+      chunk = await run_in_threadpool(lambda: list(itertools.islice(rows, batch_size)))
+      if not chunk:
+        break
+      batch, batch_rows = [], []
+      for row_number, data in chunk:
+        values = await _prepare_row(row_number, data, user_id, archive, saved_images, report)
+        if values is not None:
+          batch.append(values)
+          batch_rows.append(row_number)
+      if not batch:
+        continue
+      # One stamp per batch, so the aggregates see the rows' own created_at.
+      now = datetime.datetime.now()
+      for values in batch:
+        values["created_at"] = values["updated_at"] = now
+      try:
+        # A list of parameter sets runs as one executemany INSERT.
+        await db.execute(insert(models.Products), batch)
+        await aggregates.add_products(
+          db, user_id, aggregates.delta((values["price"], values["available"], now) for values in batch)
+        )
+        await db.commit()
+        report.inserted += len(batch)
+        inserted_at.append(now)
+      except Exception as e:
+        await db.rollback()
+        for row_number in batch_rows:
+          report.error(row_number, f"Database error: {str(e)}")
+  finally:
+    if archive is not None:
+      archive.close()
+
+  if report.inserted:
+    cache.response_cache.invalidate("products", f"seller:{user_id}")
+    # executemany does not return the new ids: the rows are found again by
+    # seller and stamp, a second either way for DATETIME columns that drop
+    # the fraction. Other products caught by the window are indexed anyway.
+    second = datetime.timedelta(seconds=1)
+    for stamp in inserted_at:
+      await search.index.load(
+        db,
+        models.Products.user_id == user_id,
+        models.Products.created_at >= stamp - second,
+        models.Products.created_at <= stamp + second,
+      )
+  return report.as_dict()
@@ -0,0 +1,195 @@
+from fastapi import Request, Response
+from collections import OrderedDict
+from typing import Awaitable, Callable, NamedTuple, Optional
+from urllib.parse import urlencode
+import src.responses as responses
+import src.metrics as metrics
+import src.config as config
+import hashlib
+import os
+import time
+
+class CacheEntry(NamedTuple):
+  body: bytes
+  etag: str
+  headers: dict
+  tags: frozenset
+  expires_at: float
+
+class ResponseCache:
+  # Serialized response bodies bounded by total size, evicted LRU. Writers
+  # invalidate by tag ("products", "product:<id>", "seller:<user_id>"); the
+  # TTL bounds how long another worker's writes can go unnoticed.
+  def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 30.0):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.generation = 0
+    self._entries = OrderedDict()
+    self._tags = {}
+
+  def get(self, key: str) -> Optional[CacheEntry]:
+    entry = self._entries.get(key)
+    if entry is None or entry.expires_at < time.monotonic():
+      if entry is not None:
+        self._remove(key)
+      self.misses += 1
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return entry
+
+  def set(
+    self,
+    key: str,
+    body: bytes,
+    tags=(),
+    headers: Optional[dict] = None,
+    generation: Optional[int] = None,
+  ) -> CacheEntry:
+    entry = CacheEntry(
+      body=body,
+      etag=make_etag(body, headers),
+      headers=headers or {},
+      tags=frozenset(tags),
+      expires_at=time.monotonic() + self.ttl,
+    )
+    # A write committed while this body was being built may have made it
+    # stale already, so only store it if nothing was invalidated meanwhile.
+    if len(body) > self.max_bytes or (generation is not None and generation != self.generation):
+      return entry
+    self._remove(key)
+    self._entries[key] = entry
+    self.bytes += len(body)
+    for tag in entry.tags:
+      self._tags.setdefault(tag, set()).add(key)
+    while self.bytes > self.max_bytes:
+      self._remove(next(iter(self._entries)))
+      self.evictions += 1
+    return entry
+
+  def invalidate(self, *tags: str):
+    self.generation += 1
+    for tag in tags:
+      for key in list(self._tags.get(tag, ())):
+        self._remove(key)
+
+  def clear(self):
+    self._entries.clear()
+    self._tags.clear()
+    self.bytes = 0
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    return {
+      "entries": len(self._entries),
+      "bytes": self.bytes,
+      "max_bytes": self.max_bytes,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "hit_ratio": self.hits / total if total else 0.0,
+    }
+
+  def _remove(self, key: str):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return
+    self.bytes -= len(entry.body)
+    for tag in entry.tags:
+      keys = self._tags.get(tag)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._tags[tag]
+
+response_cache = ResponseCache(
+  max_bytes=int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024))),
+  ttl=float(os.getenv("RESPONSE_CACHE_TTL", "30")),
+)
+
+metrics.register_cache(
+  "response_cache",
+  response_cache.stats,
+  counters=("hits", "misses", "evictions"),
+  gauges=("entries", "bytes", "max_bytes"),
+)
+
+def make_etag(body: bytes, headers: Optional[dict] = None) -> str:
+  # Cached headers (e.g. X-Next-Cursor) are part of the representation.
+  digest = hashlib.blake2b(body, digest_size=16)
+  for name, value in sorted((headers or {}).items()):
+    digest.update(f"\n{name}:{value}".encode())
+  return '"' + digest.hexdigest() + '"'
+
+def request_key(request: Request) -> str:
+  query = urlencode(sorted(request.query_params.multi_items()))
+  return f"{request.url.path}?{query}"
+
+def serialize(content) -> bytes:
+  return responses.dumps(content)
+
+def etag_matches(request: Request, etag: str) -> bool:
+  if_none_match = request.headers.get("if-none-match")
+  if not if_none_match:
+    return False
+  tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+  return "*" in tags or etag in tags
+
+def entry_response(request: Request, entry: CacheEntry) -> Response:
+  headers = {**entry.headers, "ETag": entry.etag, "Cache-Control": "no-cache"}
+  if etag_matches(request, entry.etag):
+    return Response(status_code=304, headers=headers)
+  return Response(content=entry.body, media_type="application/json", headers=headers)
+
+def body_response(request: Request, body: bytes, headers: Optional[dict] = None) -> Response:
+  # For bodies assembled from cached parts rather than stored whole.
+  return entry_response(request, CacheEntry(body, make_etag(body, headers), headers or {}, frozenset(), 0.0))
+
+async def cached_response(
+  request: Request,
+  tags,
+  build: Callable[[], Awaitable[tuple]],
+  key: Optional[str] = None,
+) -> Response:
+  # build() returns (content, headers) and may raise HTTPException; errors
+  # are never cached. tags may be a callable when they depend on the content.
+  # A client that has just written skips the cache both ways: it reads
+  # from the primary, and what it reads may not have reached the replica
+  # yet, so it must not be stored for everyone else.
+  if config.wrote_recently(request):
+    content, headers = await build()
+    return body_response(request, serialize(content), headers)
+  key = key or request_key(request)
+  entry = response_cache.get(key)
+  if entry is None:
+    generation = response_cache.generation
+    content, headers = await build()
+    if callable(tags):
+      tags = tags(content)
+    entry = response_cache.set(key, serialize(content), tags, headers, generation)
+  return entry_response(request, entry)
+
+async def cached_items(request: Request, keys: dict, build: Callable[[list], Awaitable[dict]]) -> dict:
+  # Per-item counterpart of cached_response. keys maps each item id to its
+  # cache key; build(missing_ids) loads every miss at once and returns
+  # {id: (content, tags)}. Returns {id: serialized body} for the items
+  # that exist.
+  if config.wrote_recently(request):
+    return {item_id: serialize(content) for item_id, (content, tags) in (await build(list(keys))).items()}
+  bodies = {}
+  missing = []
+  for item_id, key in keys.items():
+    entry = response_cache.get(key)
+    if entry is None:
+      missing.append(item_id)
+    else:
+      bodies[item_id] = entry.body
+  if missing:
+    generation = response_cache.generation
+    for item_id, (content, tags) in (await build(missing)).items():
+      bodies[item_id] = response_cache.set(keys[item_id], serialize(content), tags, generation=generation).body
+  return bodies
@@ -0,0 +1,200 @@
+from sqlalchemy.future import select
+from pathlib import Path
+import src.models as models
+import src.config as config
+import src.images as images
+import src.metrics as metrics
+import src.utiles as utiles
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import random
+import time
+
+# Uploaded images are content addressed and can be shared by several rows,
+# so a file is only removed once no products/users row (archived ones
+# included) points at it. Files younger than the grace period are always
+# kept, and so are files with a marker that young: save_image marks a file
+# it reuses (see utiles.pending_marker), and its row may not have committed
+# yet.
+GRACE_SECONDS = float(os.getenv("IMAGE_GC_GRACE_SECONDS", "3600"))
+# How often each worker sweeps (see sweep_periodically); 0 turns it off for
+# deployments that run `python -m src.cleanup` from cron instead.
+SWEEP_INTERVAL = float(os.getenv("IMAGE_GC_INTERVAL_SECONDS", "3600"))
+BATCH_SIZE = 5000
+MANAGED_DIRS = (utiles.UPLOAD_DIR, utiles.UPLOAD_DIR_PROFILE)
+REFERENCES = (
+  models.Products.image,
+  models.ProductsD.image,
+  models.User.profile_img,
+  models.UserD.profile_img,
+)
+
+REMOVED = metrics.Counter("shizuko_images_removed_total", "Unreferenced image files deleted", ("source",))
+RECLAIMED = metrics.Counter("shizuko_images_reclaimed_bytes_total", "Bytes freed by deleting unreferenced images", ("source",))
+
+def normalize(value: str) -> str:
+  # Rows hold "assets/...", "./assets/..." or "/assets/..."
+  return posixpath.normpath(value.strip().lstrip("/"))
+
+def is_managed(path: str) -> bool:
+  return any(path.startswith(normalize(str(directory)) + "/") for directory in MANAGED_DIRS)
+
+def _key(value: str) -> int:
+  # 8-byte digests keep the reference set small on big catalogs. A
+  # collision only ever keeps a file that could have gone.
+  return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+def is_pending(path: Path, cutoff: float) -> bool:
+  try:
+    return utiles.pending_marker(path).stat().st_mtime >= cutoff
+  except FileNotFoundError:
+    return False
+
+def remove_file(path: Path, cutoff: float) -> int:
+  # Returns the bytes freed, 0 if the file is gone or too recent.
+  try:
+    stat = path.stat()
+  except FileNotFoundError:
+    return 0
+  if stat.st_mtime >= cutoff or is_pending(path, cutoff):
+    return 0
+  path.unlink(missing_ok=True)
+  return stat.st_size
+
+# ###################### AFTER A DELETE #######################
+async def referenced_among(db, paths: set) -> set:
+  spellings = [spelling for path in paths for spelling in (path, "./" + path, "/" + path)]
+  referenced = set()
+  for column in REFERENCES:
+    result = await db.execute(select(column).where(column.in_(spellings)))
+    referenced.update(normalize(value) for value in result.scalars())
+  return referenced
+
+async def release_images(paths: list):
+  # Runs on the task queue once the row that used the images is gone.
+  # Files still inside the grace period are left for the next sweep.
+  candidates = {normalize(path) for path in paths if path}
+  candidates = {path for path in candidates if is_managed(path)}
+  if not candidates:
+    return
+  async with config.SessionLocal() as db:
+    unreferenced = candidates - await referenced_among(db, candidates)
+  cutoff = time.time() - GRACE_SECONDS
+  for path in unreferenced:
+    freed = remove_file(Path(path), cutoff)
+    if not freed:
+      continue
+    for formats in images.variant_paths(path).values():
+      for variant in formats.values():
+        freed += remove_file(Path(variant), cutoff)
+    REMOVED.inc(source="release")
+    RECLAIMED.inc(freed, source="release")
+
+# ###################### SWEEP #######################
+async def load_references(batch_size: int) -> set:
+  referenced = set()
+  async with config.SessionLocal() as db:
+    for column in REFERENCES:
+      result = await db.stream(select(column).where(column.isnot(None)).execution_options(yield_per=batch_size))
+      async for values in result.scalars().partitions(batch_size):
+        referenced.update(_key(normalize(value)) for value in values)
+  return referenced
+
+def sweep_directory(directory: Path, referenced: set, cutoff: float, dry_run: bool, stats: dict):
+  # Originals first; the variants of every original that is not kept are
+  # removed in the second pass, along with variants left by earlier deletes.
+  kept = set()
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      if not entry.is_file():
+        continue
+      stats["files"] += 1
+      stem = entry.name.rsplit(".", 1)[0] if "." in entry.name[1:] else entry.name
+      # Dot files are .part leftovers of interrupted uploads and .pending
+      # markers.
+      dot_file = entry.name.startswith(".")
+      if not dot_file and _key(normalize(str(directory / entry.name))) in referenced:
+        stats["referenced"] += 1
+        kept.add(_key(stem))
+        continue
+      stat = entry.stat()
+      if stat.st_mtime >= cutoff or (not dot_file and is_pending(Path(entry.path), cutoff)):
+        stats["recent"] += 1
+        kept.add(_key(stem))
+        continue
+      if not dry_run:
+        Path(entry.path).unlink(missing_ok=True)
+      stats["orphaned"] += 1
+      stats["reclaimed_bytes"] += stat.st_size
+
+  variants = directory / images.VARIANT_DIR
+  if not variants.is_dir():
+    return
+  with os.scandir(variants) as entries:
+    for entry in entries:
+      if not entry.is_file() or _key(entry.name.rsplit("_", 1)[0]) in kept:
+        continue
+      stat = entry.stat()
+      if stat.st_mtime >= cutoff:
+        continue
+      if not dry_run:
+        Path(entry.path).unlink(missing_ok=True)
+      stats["variants_orphaned"] += 1
+      stats["reclaimed_bytes"] += stat.st_size
+
+async def collect(dry_run: bool = False, grace: float = GRACE_SECONDS, batch_size: int = BATCH_SIZE) -> dict:
+  # References are loaded before the directories are listed, so a file
+  # written after that is younger than the cutoff and survives.
+  started = time.perf_counter()
+  cutoff = time.time() - grace
+  referenced = await load_references(batch_size)
+  stats = {
+    "dry_run": dry_run,
+    "references": len(referenced),
+    "files": 0,
+    "referenced": 0,
+    "recent": 0,
+    "orphaned": 0,
+    "variants_orphaned": 0,
+    "reclaimed_bytes": 0,
+  }
+  for directory in MANAGED_DIRS:
+    if directory.is_dir():
+      await asyncio.to_thread(sweep_directory, directory, referenced, cutoff, dry_run, stats)
+  if not dry_run:
+    REMOVED.inc(stats["orphaned"] + stats["variants_orphaned"], source="sweep")
+    RECLAIMED.inc(stats["reclaimed_bytes"], source="sweep")
+  stats["seconds"] = round(time.perf_counter() - started, 3)
+  logging.info(f"Image sweep: {json.dumps(stats)}")
+  return stats
+
+async def sweep_periodically(interval: float = SWEEP_INTERVAL):
+  # Started by the lifespan. Picks up what release_images had to leave and
+  # whatever the task queue dropped. The first run is jittered so workers
+  # started together do not sweep together.
+  await asyncio.sleep(random.uniform(0, interval))
+  while True:
+    try:
+      await collect()
+    except Exception as e:
+      logging.error(f"Image sweep failed: {str(e)}")
+    await asyncio.sleep(interval)
+
+async def main(args) -> dict:
+  try:
+    return await collect(args.dry_run, args.grace_seconds, args.batch_size)
+  finally:
+    await config.dispose_engines()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Delete uploaded images that no row references")
+  parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+  parser.add_argument("--grace-seconds", type=float, default=GRACE_SECONDS, help="never delete files younger than this")
+  parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(main(args))))
@@ -1,7 +1,13 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import event, text
+from fastapi import Request
 from dotenv import load_dotenv
+import src.metrics as metrics
+import asyncio
+import math
 import os
+import time
 
 class Config:
   def __init__(self):
@@ -11,31 +17,156 @@ class Config:
     self.username = os.getenv("USERNAME")
     self.password = os.getenv("PASSWORD")
     self.database = os.getenv("DB_NAME")
-    self.database_url = self._create_database_url()
-    self.engine = self._create_engine()
-    self.session = self._create_session()
+    # DATABASE_URL / READ_DATABASE_URL take any SQLAlchemy async URL, e.g.
+    # sqlite+aiosqlite:///primary.db for local runs.
+    self.database_url = os.getenv("DATABASE_URL") or self._create_database_url()
+    self.read_database_url = os.getenv("READ_DATABASE_URL")
+    self.read_your_writes_seconds = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+    self.engine = self._create_engine(self.database_url, "primary", "DB_")
+    self.session = self._create_session(self.engine)
+    if self.read_database_url:
+      self.read_engine = self._create_engine(self.read_database_url, "replica", "READ_DB_")
+      self.read_session = self._create_session(self.read_engine)
+    else:
+      self.read_engine = None
+      self.read_session = self.session
 
   def _create_database_url(self):
     return f"mysql+aiomysql://{self.username}:{self.password}@{self.host}:{self.port}/{self.database}"
 
-  
-  def _create_engine(self):
-    return create_async_engine(self.database_url, echo=True, future=True)
+  def _pool_options(self, prefix: str) -> dict:
+    # READ_DB_* falls back to the DB_* value, which falls back to the default.
+    def setting(name: str, default: str) -> str:
+      return os.getenv(prefix + name) or os.getenv("DB_" + name) or default
 
+    return {
+      "pool_size": int(setting("POOL_SIZE", "5")),
+      "max_overflow": int(setting("MAX_OVERFLOW", "10")),
+      "pool_timeout": float(setting("POOL_TIMEOUT", "30")),
+      "pool_recycle": int(setting("POOL_RECYCLE", "1800")),
+      "pool_pre_ping": setting("POOL_PRE_PING", "1") == "1",
+    }
 
-  def _create_session(self):
-    return sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+  def _create_engine(self, url: str, name: str, prefix: str):
+    # Statement echo is opt-in (SQL_ECHO=1); slow statements are logged by
+    # the metrics instrumentation instead.
+    engine = create_async_engine(
+      url,
+      echo=os.getenv("SQL_ECHO") == "1",
+      future=True,
+      poolclass=metrics.TimedQueuePool,
+      **self._pool_options(prefix),
+    )
+    metrics.instrument_engine(engine, name)
+    return engine
 
+  def _create_session(self, engine):
+    return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# Read-your-writes: a commit through get_db stamps the response with the
+# commit time, as a cookie and an X-Last-Write header. Clients send either
+# back, so their reads go to the primary for a few seconds whichever worker
+# answers and whatever address they come from. A forged stamp only moves
+# that client's own reads to the primary.
+WRITE_MARKER_COOKIE = "last_write"
+WRITE_MARKER_HEADER = "x-last-write"
+
+@event.listens_for(Session, "after_commit")
+def _mark_writer(session):
+  # Marked at commit time, before the response goes out, so the client's
+  # very next read already sees it.
+  request = session.info.get("request")
+  if request is not None:
+    request.state.last_write = time.time()
+
+def wrote_recently(request: Request) -> bool:
+  value = request.cookies.get(WRITE_MARKER_COOKIE) or request.headers.get(WRITE_MARKER_HEADER)
+  try:
+    written_at = float(value)
+  except (TypeError, ValueError):
+    return False
+  return abs(time.time() - written_at) < config.read_your_writes_seconds
+
+class WriteMarkerMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or read_engine is None:
+      return await self.app(scope, receive, send)
+
+    async def send_with_marker(message):
+      written_at = scope.get("state", {}).get("last_write")
+      if message["type"] == "http.response.start" and written_at is not None:
+        value = f"{written_at:.3f}"
+        cookie = f"{WRITE_MARKER_COOKIE}={value}; Max-Age={math.ceil(config.read_your_writes_seconds)}; Path=/; HttpOnly; SameSite=Lax"
+        message = {
+          **message,
+          "headers": [
+            *message.get("headers", []),
+            (b"set-cookie", cookie.encode()),
+            (WRITE_MARKER_HEADER.encode(), value.encode()),
+          ],
+        }
+      await send(message)
+
+    await self.app(scope, receive, send_with_marker)
+
+async def warm_pool(engine, connections: int):
+  # Opens the connections concurrently so each one is a distinct checkout;
+  # they go back to the pool idle and the first requests skip the connect.
+  async def touch():
+    async with engine.connect() as conn:
+      await conn.execute(text("SELECT 1"))
+
+  await asyncio.gather(*(touch() for _ in range(connections)))
+
+async def warm_pools():
+  for engine in (config.engine, config.read_engine):
+    if engine is not None:
+      size = engine.sync_engine.pool.size()
+      await warm_pool(engine, int(os.getenv("DB_POOL_WARM", str(size))))
+
+async def dispose_engines(close: bool = True):
+  # close=False after a fork: drop the parent's pool state without closing
+  # connections that belong to the parent.
+  for engine in (config.engine, config.read_engine):
+    if engine is not None:
+      await engine.dispose(close=close)
 
 load_dotenv()
 encryption_password = os.getenv("ENCRYPTION_PASSWORD")
+encryption_derived_key = os.getenv("ENCRYPTION_DERIVED_KEY")
+# The retired key during a rotation, see src/rotate.py.
+encryption_previous_password = os.getenv("ENCRYPTION_PREVIOUS_PASSWORD")
+encryption_previous_derived_key = os.getenv("ENCRYPTION_PREVIOUS_DERIVED_KEY")
+max_upload_bytes = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
 
 config = Config()
 SessionLocal = config.session
+ReadSessionLocal = config.read_session
 engine = config.engine
+read_engine = config.read_engine
 
-async def get_db():
+async def get_db(request: Request):
   async with SessionLocal() as db:
+    db.info["write"] = True
+    if read_engine is not None:
+      db.info["request"] = request
+    try:
+      yield db
+    finally:
+      await db.close()
+
+async def get_read_db(request: Request):
+  # GET handlers go to the replica when one is configured, unless this
+  # client has just written through get_db.
+  if read_engine is None or wrote_recently(request):
+    session_factory = SessionLocal
+  else:
+    session_factory = ReadSessionLocal
+  async with session_factory() as db:
     try:
       yield db
     finally:
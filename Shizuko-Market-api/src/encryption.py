@@ -3,18 +3,103 @@ from cryptography.hazmat.primitives.hashes import SHA512
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.fernet import Fernet
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import asyncio
+import argparse
 import base64
 import os
 import hmac
 import hashlib
+import threading
+
+KEY_ID_SEPARATOR = ":"
+
+_executor = None
+_derive_lock = threading.Lock()
+_derived_keys = {}
+
+def get_executor() -> ThreadPoolExecutor:
+  # Bounded so a login burst queues here instead of starving the default
+  # executor that run_in_threadpool and aiofiles share.
+  global _executor
+  if _executor is None:
+    _executor = ThreadPoolExecutor(
+      max_workers=int(os.getenv("CRYPTO_WORKERS", str(min(4, os.cpu_count() or 1)))),
+      thread_name_prefix="spe",
+    )
+  return _executor
+
+def shutdown_executor():
+  global _executor
+  if _executor is not None:
+    _executor.shutdown(wait=True)
+    _executor = None
+
+def keyring(
+  password: Optional[str],
+  derived_key: Optional[str] = None,
+  previous_password: Optional[str] = None,
+  previous_derived_key: Optional[str] = None,
+) -> "SPE":
+  # Either setting of a key is enough; the derived key wins when both are set.
+  previous = [SPE(previous_password, previous_derived_key)] if previous_password or previous_derived_key else []
+  return SPE(password, derived_key, previous)
 
 class SPE:  # Shizuko Platform Encryption
-  def __init__(self, password: str):
-    self.password = password.encode()
-    self.salt = self.generate_salt_from_password(self.password)
-    self.key = self.derive_key(self.password, self.salt)
-    self.hmac_key = self.key[:16]
-    self.encryption_key = self.key[16:]
+  def __init__(self, password: Optional[str] = None, derived_key: Optional[str] = None, previous=()):
+    # PBKDF2 runs on first use, not at import. derived_key is the base64
+    # output of export_key(), so workers started with ENCRYPTION_DERIVED_KEY
+    # skip the derivation entirely and need no password. previous holds
+    # retired SPE keys that are still accepted by decrypt() while a rotation
+    # is in progress.
+    if not password and not derived_key:
+      raise ValueError("Encryption needs a password or a derived key")
+    self.password = password.encode() if password else None
+    self.salt = self.generate_salt_from_password(self.password) if self.password else None
+    self.previous = list(previous)
+    self._key = base64.b64decode(derived_key) if derived_key else None
+    self._key_id = None
+    if self._key is not None and len(self._key) != 32:
+      raise ValueError("Derived key must be 32 bytes")
+
+  @property
+  def key(self) -> bytes:
+    if self._key is None:
+      # Derived once per process and password, even when several threads
+      # or SPE instances ask at the same time.
+      with _derive_lock:
+        key = _derived_keys.get(self.password)
+        if key is None:
+          key = _derived_keys[self.password] = self.derive_key(self.password, self.salt)
+      self._key = key
+    return self._key
+
+  @property
+  def hmac_key(self) -> bytes:
+    return self.key[:16]
+
+  @property
+  def encryption_key(self) -> bytes:
+    return self.key[16:]
+
+  @property
+  def key_id(self) -> str:
+    # Ciphertexts are written as "<key_id>:<base64>"; ":" never occurs in
+    # base64, and unprefixed values are from before key ids existed.
+    if self._key_id is None:
+      digest = hashlib.sha256(b"spe-key-id" + self.key).digest()
+      self._key_id = base64.urlsafe_b64encode(digest[:3]).decode()
+    return self._key_id
+
+  def keys(self) -> list:
+    return [self, *self.previous]
+
+  def is_current(self, value: str) -> bool:
+    return value.startswith(self.key_id + KEY_ID_SEPARATOR)
+
+  def export_key(self) -> str:
+    return base64.b64encode(self.key).decode()
 
   def generate_salt_from_password(self, password: bytes) -> bytes:
     return hashlib.sha256(password).digest()
@@ -42,9 +127,24 @@ class SPE:  # Shizuko Platform Encryption
     signature = hmac.new(self.hmac_key, ciphertext, digestmod="sha256").digest()
 
     encrypted_message = base64.b64encode(iv + signature + ciphertext).decode()
-    return encrypted_message
+    return self.key_id + KEY_ID_SEPARATOR + encrypted_message
+
+  def decrypt(self, value: str) -> str:
+    key_id, separator, encrypted_base64 = value.rpartition(KEY_ID_SEPARATOR)
+    if separator:
+      for spe in self.keys():
+        if spe.key_id == key_id:
+          return spe.decrypt_with_key(encrypted_base64)
+      raise ValueError(f"Unknown encryption key id: {key_id}")
+    # Legacy values carry no key id; the HMAC tells which key wrote them.
+    for spe in self.keys():
+      try:
+        return spe.decrypt_with_key(encrypted_base64)
+      except ValueError:
+        continue
+    raise ValueError("Signature mismatch! Message integrity compromised.")
 
-  def decrypt(self, encrypted_base64: str) -> str:
+  def decrypt_with_key(self, encrypted_base64: str) -> str:
     encrypted_data = base64.b64decode(encrypted_base64.encode())
 
     iv = encrypted_data[:16]
@@ -67,6 +167,19 @@ class SPE:  # Shizuko Platform Encryption
 
     return plaintext.decode()
 
+  async def encrypt_async(self, message: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), self.encrypt, message)
+
+  async def decrypt_async(self, encrypted_base64: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), self.decrypt, encrypted_base64)
+
+  async def warm(self):
+    # Derives the key off the event loop ahead of the first request.
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_executor(), lambda: self.key)
+
 # مثال على الاستخدام
 # password = "_BIM8o0oRI4uttmSyp67VnQZQp7-megO7r48Uzi8Apo="  # كلمة المرور
 # tpe = TPE(password)
@@ -81,3 +194,13 @@ class SPE:  # Shizuko Platform Encryption
 #     print("Decrypted:", decrypted)
 # except ValueError as e:
 #     print("Decryption failed:", e)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Print the derived key for ENCRYPTION_DERIVED_KEY")
+  parser.add_argument("--previous", action="store_true", help="derive ENCRYPTION_PREVIOUS_PASSWORD instead")
+  args = parser.parse_args()
+  name = "ENCRYPTION_PREVIOUS_PASSWORD" if args.previous else "ENCRYPTION_PASSWORD"
+  password = os.getenv(name)
+  if not password:
+    raise SystemExit(f"{name} is not set")
+  print(SPE(password).export_key())
@@ -0,0 +1,66 @@
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.future import select
+from typing import Optional
+import src.models as models
+import src.config as config
+import src.pagination as pagination
+import json
+import zlib
+
+CHUNK_ROWS = 1000
+
+def _row_json(row) -> str:
+  return json.dumps({
+    "product_id": row.id,
+    "user_id": row.user_id,
+    "title": row.title,
+    "description": row.description,
+    "price": float(row.price) if row.price is not None else None,
+    "image": row.image,
+    "available": row.available,
+    "time": row.created_at.isoformat() if row.created_at else None,
+  }, ensure_ascii=False, separators=(",", ":"))
+
+async def iter_ndjson(query, chunk_rows: int = CHUNK_ROWS):
+  # The session lives inside the generator because the response body is
+  # produced after the endpoint has returned. db.stream() uses a server-side
+  # cursor, so only one chunk of rows is in memory at a time.
+  async with config.ReadSessionLocal() as db:
+    result = await db.stream(query.execution_options(yield_per=chunk_rows))
+    async for rows in result.partitions(chunk_rows):
+      yield ("\n".join(_row_json(row) for row in rows) + "\n").encode()
+
+async def gzip_chunks(chunks):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  async for chunk in chunks:
+    # Sync-flush so every chunk reaches the client as soon as it is read.
+    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  yield compressor.flush()
+
+def export_response(
+  request: Request,
+  min_price: Optional[float] = None,
+  max_price: Optional[float] = None,
+  available: Optional[bool] = None,
+  user_id: Optional[int] = None,
+) -> StreamingResponse:
+  query = select(
+    models.Products.id,
+    models.Products.user_id,
+    models.Products.title,
+    models.Products.description,
+    models.Products.price,
+    models.Products.image,
+    models.Products.available,
+    models.Products.created_at,
+  ).order_by(models.Products.id)
+  query = pagination.filter_products(query, min_price, max_price, available, user_id)
+
+  body = iter_ndjson(query)
+  headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-store"}
+  accepted = {part.split(";")[0].strip() for part in request.headers.get("accept-encoding", "").split(",")}
+  if "gzip" in accepted:
+    body = gzip_chunks(body)
+    headers["Content-Encoding"] = "gzip"
+  return StreamingResponse(body, media_type="application/x-ndjson", headers=headers)
@@ -0,0 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageOps
+from pathlib import Path
+from typing import Optional
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+
+# Longest edge in pixels for each variant. Every variant is written as WebP
+# plus a JPEG fallback for clients without WebP support.
+VARIANTS = {"thumb": 200, "medium": 600, "full": 1600}
+FORMATS = {
+  "webp": ("WEBP", {"quality": 80, "method": 4}),
+  "jpg": ("JPEG", {"quality": 85, "progressive": True, "optimize": True}),
+}
+VARIANT_DIR = "variants"
+SOURCE_DIRS = (Path("./assets/product_images/"), Path("./assets/image_photos/"), Path("./assets/images/"))
+SOURCE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pending = set()
+
+@functools.lru_cache(maxsize=65536)
+def variant_paths(image_path: str) -> dict:
+  # Deterministic, so responses can expose the URLs without touching disk.
+  # Plain string handling: this runs for every product of every feed page.
+  directory, _, filename = image_path.rpartition("/")
+  stem = filename.rsplit(".", 1)[0] if "." in filename[1:] else filename
+  prefix = f"{directory}/{VARIANT_DIR}/{stem}" if directory else f"{VARIANT_DIR}/{stem}"
+  return {name: {fmt: f"{prefix}_{name}.{fmt}" for fmt in FORMATS} for name in VARIANTS}
+
+def variant_urls(image_path: Optional[str]) -> Optional[dict]:
+  if not image_path:
+    return None
+  return variant_paths(image_path)
+
+def render_variants(image_path: str, force: bool = False) -> int:
+  # Runs inside the process pool. Returns how many files were written, so
+  # re-running over an already processed image is a cheap no-op.
+  source = Path(image_path.lstrip("/"))
+  targets = variant_paths(str(source))
+  missing = [
+    (name, fmt, Path(path))
+    for name, formats in targets.items()
+    for fmt, path in formats.items()
+    if force or not Path(path).exists()
+  ]
+  if not missing:
+    return 0
+
+  (source.parent / VARIANT_DIR).mkdir(parents=True, exist_ok=True)
+  written = 0
+  with Image.open(source) as original:
+    image = ImageOps.exif_transpose(original)
+    if image.mode not in ("RGB", "L"):
+      image = image.convert("RGB")
+    for name, fmt, target in missing:
+      resized = image.copy()
+      resized.thumbnail((VARIANTS[name], VARIANTS[name]), Image.LANCZOS)
+      pil_format, options = FORMATS[fmt]
+      temp = target.with_name(f".{target.name}.{os.getpid()}.part")
+      resized.save(temp, pil_format, **options)
+      os.replace(temp, target)
+      written += 1
+  return written
+
+def get_pool() -> ProcessPoolExecutor:
+  global _pool
+  if _pool is None:
+    _pool = ProcessPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", "2")))
+  return _pool
+
+def shutdown_pool():
+  global _pool
+  if _pool is not None:
+    _pool.shutdown(wait=True)
+    _pool = None
+
+async def generate_variants(image_path: str, force: bool = False) -> int:
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(get_pool(), render_variants, image_path, force)
+
+def schedule_variants(image_path: str):
+  # Fire and forget: the upload response never waits on resizing.
+  async def run():
+    try:
+      await generate_variants(image_path)
+    except Exception as e:
+      logging.error(f"Failed to build variants for {image_path}: {str(e)}")
+
+  task = asyncio.get_running_loop().create_task(run())
+  _pending.add(task)
+  task.add_done_callback(_pending.discard)
+
+async def drain(timeout: Optional[float] = None) -> int:
+  # Waits for scheduled variants, up to timeout. Returns how many are still
+  # running.
+  if not _pending:
+    return 0
+  _, running = await asyncio.wait(set(_pending), timeout=timeout)
+  return len(running)
+
+# ###################### BACKFILL #######################
+def iter_sources(directories=SOURCE_DIRS):
+  for directory in directories:
+    if not directory.is_dir():
+      continue
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        if entry.is_file() and not entry.name.startswith(".") and Path(entry.name).suffix.lower() in SOURCE_SUFFIXES:
+          yield str(directory / entry.name)
+
+def backfill(workers: int, force: bool = False, checkpoint: Optional[Path] = None) -> dict:
+  # Already rendered variants are skipped, and the checkpoint file lets an
+  # interrupted run skip whole sources without even checking their variants.
+  done = set()
+  if checkpoint and checkpoint.exists() and not force:
+    done = set(checkpoint.read_text().splitlines())
+  stats = {"processed": 0, "skipped": 0, "written": 0, "failed": 0}
+  started = time.perf_counter()
+  log = open(checkpoint, "a") if checkpoint else None
+  try:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      in_flight = {}
+      sources = iter(iter_sources())
+      while True:
+        while len(in_flight) < workers * 4:
+          source = next(sources, None)
+          if source is None:
+            break
+          if source in done:
+            stats["skipped"] += 1
+            continue
+          in_flight[pool.submit(render_variants, source, force)] = source
+        if not in_flight:
+          break
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+          source = in_flight.pop(future)
+          try:
+            stats["written"] += future.result()
+            stats["processed"] += 1
+            if log:
+              log.write(source + "\n")
+              log.flush()
+          except Exception as e:
+            stats["failed"] += 1
+            logging.error(f"Failed to build variants for {source}: {str(e)}")
+  finally:
+    if log:
+      log.close()
+  stats["seconds"] = round(time.perf_counter() - started, 3)
+  return stats
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Build resized image variants for the asset directories")
+  parser.add_argument("command", choices=["backfill"])
+  parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+  parser.add_argument("--force", action="store_true", help="rebuild variants that already exist")
+  parser.add_argument("--checkpoint", type=Path, default=Path("./.variants-backfill"))
+  args = parser.parse_args()
+  print(json.dumps(backfill(args.workers, args.force, args.checkpoint)))
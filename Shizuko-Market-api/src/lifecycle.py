@@ -0,0 +1,90 @@
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+import src.config as config
+import src.metrics as metrics
+import src.images as images
+import src.encryption as encryption
+import src.cache as cache
+import src.auth as auth
+import src.search as search
+import src.tasks as tasks
+import src.cleanup as cleanup
+import asyncio
+import logging
+import os
+import time
+
+log = logging.getLogger("shizuko.lifecycle")
+
+DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "10"))
+# Response and token cache lifetime when several workers run.
+SHARED_CACHE_TTL = float(os.getenv("MULTI_WORKER_CACHE_TTL", "2"))
+
+# Fallback for startup time where the process start is not in /proc.
+imported_at = time.perf_counter()
+
+async def build_search_index():
+  try:
+    await search.index.build()
+  except Exception as e:
+    logging.error(f"Failed to build the search index: {str(e)}")
+
+def configure_workers(workers: int):
+  # Caches are per process and invalidation only reaches the worker that
+  # handled the write, so with several workers a stale entry lives at most
+  # SHARED_CACHE_TTL and write paths re-check tokens against the database.
+  if workers <= 1:
+    return
+  cache.response_cache.ttl = min(cache.response_cache.ttl, SHARED_CACHE_TTL)
+  auth.token_cache.ttl = min(auth.token_cache.ttl, SHARED_CACHE_TTL)
+  auth.token_cache.verify_writes = True
+
+def format_mib(value) -> str:
+  return "n/a" if value is None else f"{value / (1024 * 1024):.1f} MiB"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  from src.v1 import spe
+
+  # Engines, caches and executors are module singletons created lazily, and
+  # a preloading parent disposes its connections before forking; close=False
+  # still drops any pool state inherited through fork without touching the
+  # parent's.
+  await config.dispose_engines(close=False)
+  cache.response_cache.clear()
+  auth.token_cache.clear()
+  configure_workers(int(os.getenv("WEB_CONCURRENCY", "1")))
+  await asyncio.gather(config.warm_pools(), spe.warm())
+  # Built in the background unless the launcher preloaded it; search
+  # answers 503 until it is ready.
+  search_build = None
+  if not search.index.ready:
+    search_build = asyncio.create_task(build_search_index())
+  image_sweep = None
+  if cleanup.SWEEP_INTERVAL > 0:
+    image_sweep = asyncio.create_task(cleanup.sweep_periodically())
+
+  startup = metrics.process_uptime()
+  if startup is None:
+    startup = time.perf_counter() - imported_at
+  metrics.STARTUP_SECONDS.set(startup)
+  memory = metrics.process_memory()
+  log.info(
+    f"Worker {os.getpid()} ready in {startup:.3f}s, rss {format_mib(memory['rss'])}, private {format_mib(memory['private'])}"
+  )
+  try:
+    yield
+  finally:
+    if search_build is not None and not search_build.done():
+      search_build.cancel()
+    if image_sweep is not None:
+      image_sweep.cancel()
+      await asyncio.gather(image_sweep, return_exceptions=True)
+    # Uvicorn has already drained in-flight requests; finish queued image
+    # variants and post-commit tasks before the pools go away.
+    await images.drain(DRAIN_SECONDS)
+    await tasks.queue.drain(DRAIN_SECONDS)
+    images.shutdown_pool()
+    encryption.shutdown_executor()
+    await config.dispose_engines()
+    log.info(f"Worker {os.getpid()} stopped")
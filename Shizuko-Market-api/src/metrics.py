@@ -0,0 +1,307 @@
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event
+from fastapi import Response
+from contextvars import ContextVar
+from typing import Callable, Optional
+import logging
+import os
+import random
+import sys
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+slow_query_log = logging.getLogger("shizuko.sql.slow")
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_MS", "200")) / 1000
+SLOW_QUERY_SAMPLE = float(os.getenv("SLOW_QUERY_SAMPLE", "1.0"))
+
+# ###################### METRIC TYPES #######################
+class Metric:
+  type = "untyped"
+
+  def __init__(self, name: str, help: str, labelnames=(), collect: Optional[Callable] = None):
+    # collect() returns [(label_values, value), ...] at scrape time for
+    # values that live elsewhere (pool sizes, cache counters).
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.collect = collect
+    self._values = {}
+    REGISTRY.append(self)
+
+  def _key(self, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+  def samples(self):
+    if self.collect is not None:
+      for label_values, value in self.collect():
+        yield self.name, tuple(label_values), value
+      return
+    for key, value in self._values.items():
+      yield self.name, key, value
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+    for name, label_values, value in self.samples():
+      lines.append(f"{name}{_labels(self.labelnames, label_values)} {_number(value)}")
+    return lines
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+  type = "gauge"
+
+  def set(self, value: float, **labels):
+    self._values[self._key(labels)] = value
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    self._values[key] = self._values.get(key, 0) + amount
+
+  def dec(self, amount: float = 1, **labels):
+    self.inc(-amount, **labels)
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, help, labelnames)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    state = self._values.get(key)
+    if state is None:
+      state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+    for index, bound in enumerate(self.buckets):
+      if value <= bound:
+        state[0][index] += 1
+    state[1] += value
+    state[2] += 1
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+    names = self.labelnames + ("le",)
+    for key, (counts, total, count) in self._values.items():
+      for bound, bucket_count in zip(self.buckets, counts):
+        lines.append(f"{self.name}_bucket{_labels(names, key + (_number(bound),))} {bucket_count}")
+      lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {count}")
+      lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+      lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+    return lines
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple) -> str:
+  if not names:
+    return ""
+  return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+def _number(value) -> str:
+  if isinstance(value, bool):
+    return "1" if value else "0"
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return str(value)
+
+REGISTRY = []
+ENGINES = {}
+
+def render() -> str:
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.render())
+  return "\n".join(lines) + "\n"
+
+async def metrics_endpoint():
+  return Response(content=render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ###################### HTTP #######################
+REQUEST_LATENCY = Histogram(
+  "shizuko_http_request_duration_seconds", "HTTP request latency by route template",
+  ("method", "route", "status"),
+)
+REQUEST_STATEMENTS = Histogram(
+  "shizuko_http_request_db_statements", "SQL statements executed per HTTP request",
+  ("route",), STATEMENT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+  "shizuko_http_request_db_seconds", "Cumulative SQL execution time per HTTP request",
+  ("route",),
+)
+
+class RequestStats:
+  __slots__ = ("statements", "db_seconds")
+
+  def __init__(self):
+    self.statements = 0
+    self.db_seconds = 0.0
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+def route_label(scope) -> str:
+  # Route templates, never raw paths: ids and tokens would explode the
+  # label cardinality.
+  route = scope.get("route")
+  if route is not None and getattr(route, "path", None):
+    return route.path
+  if scope.get("root_path"):
+    return scope["root_path"]
+  return "unmatched"
+
+class MetricsMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+
+    stats = RequestStats()
+    token = current_request.set(stats)
+    status = {"code": 500}
+
+    async def send_wrapper(message):
+      if message["type"] == "http.response.start":
+        status["code"] = message["status"]
+      await send(message)
+
+    started = time.perf_counter()
+    try:
+      await self.app(scope, receive, send_wrapper)
+    finally:
+      elapsed = time.perf_counter() - started
+      current_request.reset(token)
+      route = route_label(scope)
+      REQUEST_LATENCY.observe(elapsed, method=scope["method"], route=route, status=status["code"])
+      REQUEST_STATEMENTS.observe(stats.statements, route=route)
+      REQUEST_DB_SECONDS.observe(stats.db_seconds, route=route)
+
+# ###################### DATABASE #######################
+DB_STATEMENTS = Counter("shizuko_db_statements_total", "SQL statements executed", ("engine",))
+DB_SECONDS = Counter("shizuko_db_seconds_total", "Time spent executing SQL", ("engine",))
+DB_SLOW_STATEMENTS = Counter("shizuko_db_slow_statements_total", "SQL statements slower than SLOW_QUERY_MS", ("engine",))
+POOL_WAIT_SECONDS = Histogram("shizuko_db_pool_wait_seconds", "Time spent waiting for a pooled connection", ("engine",))
+POOL_WAITING = Gauge("shizuko_db_pool_waiting", "Tasks currently waiting for a pooled connection", ("engine",))
+
+def _pool_samples(attribute: str):
+  def collect():
+    for name, engine in ENGINES.items():
+      pool = engine.sync_engine.pool
+      method = getattr(pool, attribute, None)
+      if method is not None:
+        yield (name,), method()
+  return collect
+
+Gauge("shizuko_db_pool_size", "Configured pool size", ("engine",), collect=_pool_samples("size"))
+Gauge("shizuko_db_pool_checked_out", "Connections currently checked out", ("engine",), collect=_pool_samples("checkedout"))
+Gauge("shizuko_db_pool_overflow", "Connections open beyond the pool size", ("engine",), collect=_pool_samples("overflow"))
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+  # _do_get is where QueuePool blocks when every connection is checked out.
+  metrics_name = "primary"
+
+  def _do_get(self):
+    POOL_WAITING.inc(engine=self.metrics_name)
+    started = time.perf_counter()
+    try:
+      return super()._do_get()
+    finally:
+      POOL_WAITING.dec(engine=self.metrics_name)
+      POOL_WAIT_SECONDS.observe(time.perf_counter() - started, engine=self.metrics_name)
+
+def instrument_engine(engine, name: str):
+  ENGINES[name] = engine
+  pool = engine.sync_engine.pool
+  if isinstance(pool, TimedQueuePool):
+    pool.metrics_name = name
+  sync_engine = engine.sync_engine
+
+  @event.listens_for(sync_engine, "before_cursor_execute")
+  def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+  @event.listens_for(sync_engine, "after_cursor_execute")
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    DB_STATEMENTS.inc(engine=name)
+    DB_SECONDS.inc(elapsed, engine=name)
+    stats = current_request.get()
+    if stats is not None:
+      stats.statements += 1
+      stats.db_seconds += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+      DB_SLOW_STATEMENTS.inc(engine=name)
+      if random.random() < SLOW_QUERY_SAMPLE:
+        slow_query_log.warning("%.1f ms on %s: %s", elapsed * 1000, name, " ".join(statement.split()))
+
+  @event.listens_for(sync_engine, "handle_error")
+  def handle_error(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+      started.pop()
+
+# ###################### UPLOADS #######################
+UPLOAD_BYTES = Histogram("shizuko_upload_bytes", "Size of stored image uploads", ("kind",), BYTES_BUCKETS)
+UPLOAD_SECONDS = Histogram("shizuko_upload_seconds", "Time spent streaming an image upload to disk", ("kind",))
+UPLOAD_REJECTED = Counter("shizuko_upload_rejected_total", "Uploads rejected for exceeding MAX_UPLOAD_BYTES", ("kind",))
+
+# ###################### PROCESS #######################
+def process_memory() -> dict:
+  # rss counts pages shared with the preloading parent; private is what this
+  # worker alone costs. Falls back to peak RSS where /proc is unavailable.
+  memory = {}
+  try:
+    with open("/proc/self/smaps_rollup") as f:
+      for line in f:
+        name, _, value = line.partition(":")
+        if name in ("Rss", "Private_Clean", "Private_Dirty"):
+          memory[name] = int(value.split()[0]) * 1024
+  except OSError:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"rss": peak if sys.platform == "darwin" else peak * 1024, "private": None}
+  return {"rss": memory.get("Rss", 0), "private": memory.get("Private_Clean", 0) + memory.get("Private_Dirty", 0)}
+
+def process_uptime() -> Optional[float]:
+  # Seconds since this process started (for a forked worker, since the
+  # fork). None where /proc is unavailable.
+  try:
+    with open("/proc/self/stat") as f:
+      start_ticks = int(f.read().rpartition(")")[2].split()[19])
+    with open("/proc/uptime") as f:
+      uptime = float(f.read().split()[0])
+  except (OSError, ValueError, IndexError):
+    return None
+  return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+def _memory_samples(field: str):
+  def collect():
+    value = process_memory()[field]
+    if value is not None:
+      yield (), value
+  return collect
+
+Gauge("shizuko_process_resident_memory_bytes", "Resident memory of this worker", collect=_memory_samples("rss"))
+Gauge("shizuko_process_private_memory_bytes", "Memory not shared with other workers", collect=_memory_samples("private"))
+STARTUP_SECONDS = Gauge("shizuko_worker_startup_seconds", "Time from worker start until it accepted requests")
+
+# ###################### CACHES #######################
+def _cache_samples(get_stats: Callable, field: str):
+  def collect():
+    yield (), get_stats()[field]
+  return collect
+
+def register_cache(name: str, get_stats: Callable, counters=("hits", "misses"), gauges=("size",)):
+  for field in counters:
+    Counter(f"shizuko_{name}_{field}_total", f"{name} {field}", collect=_cache_samples(get_stats, field))
+  for field in gauges:
+    Gauge(f"shizuko_{name}_{field}", f"{name} {field}", collect=_cache_samples(get_stats, field))
@@ -1,20 +1,23 @@
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Boolean, Numeric, ForeignKey, DateTime, Text
-from config import engine
+from sqlalchemy import Column, Integer, String, Boolean, Numeric, ForeignKey, DateTime, Text, Index, inspect, text
+from src.config import engine
 import datetime
 import asyncio
 
 Base = declarative_base()
 
+DEFAULT_PROFILE_IMG = "/assets/images/profile_img_male.jpg"
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, autoincrement=True)
     full_name = Column(String(100), nullable=False)
     username = Column(String(50), nullable=False, unique=True)
     phone_number = Column(Integer, nullable=False, unique=True)
-    password = Column(String(100), nullable=False)
-    token = Column(String(100), nullable=False)
-    profile_img = Column(String(255), default="/assets/images/profile_img_male.jpg")
+    # "<key id>:<base64>" ciphertexts, see schemas.PASSWORD_MAX_LENGTH.
+    password = Column(String(255), nullable=False)
+    token = Column(String(100), nullable=False, index=True, unique=True)
+    profile_img = Column(String(255), default=DEFAULT_PROFILE_IMG)
 
 class Products(Base):
     __tablename__ = "products"
@@ -25,7 +28,22 @@ class Products(Base):
     price = Column(Numeric(10, 2), nullable=False)
     image = Column(String(300), nullable=True)
     available = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.datetime.now())
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    # Keyset pagination walks (created_at, id); the prefixed variants keep
+    # filtered pages as cheap as the first one. Delta sync walks
+    # (updated_at, id).
+    __table_args__ = (
+        Index("ix_products_created_at_id", "created_at", "id"),
+        Index("ix_products_user_id_created_at_id", "user_id", "created_at", "id"),
+        Index("ix_products_available_created_at_id", "available", "created_at", "id"),
+        Index("ix_products_updated_at_id", "updated_at", "id"),
+        # Image cleanup checks whether a file is still used.
+        Index("ix_products_image", "image"),
+        # Catalog price range after a delete, see src/aggregates.py.
+        Index("ix_products_price", "price"),
+    )
 
 
 class UserD(Base):
@@ -34,10 +52,13 @@ class UserD(Base):
     full_name = Column(String(100))
     username = Column(String(50))
     phone_number = Column(Integer)
-    password = Column(String(100))
+    password = Column(String(255))
     token = Column(String(100))
     profile_img = Column(String(255), default="/assets/images/profile_img_male.jpg")
-    deleted_at = Column(DateTime, default=datetime.datetime.now())
+    deleted_at = Column(DateTime, default=datetime.datetime.now)
+
+    # archive.archive_users links products_d rows back through the token.
+    __table_args__ = (Index("ix_users_d_token_deleted_at", "token", "deleted_at"),)
 
 class ProductsD(Base):
     __tablename__ = "products_d"
@@ -51,11 +72,101 @@ class ProductsD(Base):
     price = Column(Numeric(10, 2))
     image = Column(String(300))
     available = Column(Boolean, default=True)
-    deleted_at = Column(DateTime, default=datetime.datetime.now())
+    deleted_at = Column(DateTime, default=datetime.datetime.now)
+
+    # Retention exports and restores archived products per user.
+    __table_args__ = (
+        Index("ix_products_d_image", "image"),
+        Index("ix_products_d_user_id", "user_id"),
+    )
+
+class ProductTombstone(Base):
+    # One row per deleted product, read by the delta sync endpoint. Products
+    # archived into products_d get new ids, so the original id is kept here.
+    __tablename__ = "product_tombstones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.datetime.now)
+
+    __table_args__ = (Index("ix_product_tombstones_deleted_at_id", "deleted_at", "id"),)
+
+class SellerStats(Base):
+    # Product aggregates per seller, kept current by src/aggregates.py in
+    # the same transactions that change products. Negative user_ids are the
+    # catalog's count shards, which leave the price range and last listing
+    # empty.
+    __tablename__ = "seller_stats"
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    product_count = Column(Integer, nullable=False, default=0)
+    available_count = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Numeric(18, 2), nullable=False, default=0)
+    min_price = Column(Numeric(10, 2))
+    max_price = Column(Numeric(10, 2))
+    last_listed_at = Column(DateTime)
+
+    # The catalog's price range and last listing are index lookups over the
+    # seller rows.
+    __table_args__ = (
+        Index("ix_seller_stats_min_price", "min_price"),
+        Index("ix_seller_stats_max_price", "max_price"),
+        Index("ix_seller_stats_last_listed_at", "last_listed_at"),
+    )
 
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_columns)
+        await conn.run_sync(widen_columns)
+        await conn.run_sync(create_indexes)
+
+def add_columns(conn):
+    # create_all does not alter existing tables either. Columns added after
+    # the first deploy are added as nullable and backfilled.
+    existing = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"] for column in existing.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                conn.execute(text(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(conn.dialect)}"
+                ))
+                if table.name == "products" and column.name == "updated_at":
+                    conn.execute(text("UPDATE products SET updated_at = created_at WHERE updated_at IS NULL"))
+
+def widen_columns(conn):
+    # add_columns never changes a column type; VARCHARs that have since grown
+    # (users.password, users_d.password) are widened in place. SQLite does
+    # not enforce VARCHAR lengths.
+    if conn.dialect.name == "sqlite":
+        return
+    existing = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        lengths = {column["name"]: getattr(column["type"], "length", None) for column in existing.get_columns(table.name)}
+        for column in table.columns:
+            length = lengths.get(column.name)
+            if not isinstance(column.type, String) or length is None or column.type.length is None:
+                continue
+            if length >= column.type.length:
+                continue
+            column_type = column.type.compile(conn.dialect)
+            if conn.dialect.name == "mysql":
+                null = "" if column.nullable else " NOT NULL"
+                conn.execute(text(f"ALTER TABLE {table.name} MODIFY {column.name} {column_type}{null}"))
+            else:
+                conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {column_type}"))
+
+def create_indexes(conn):
+    # create_all skips tables that already exist, so indexes added after the
+    # first deploy have to be created one by one. An index that has since
+    # become unique (ix_users_token) is rebuilt.
+    existing = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        unique = {index["name"]: bool(index["unique"]) for index in existing.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in unique and unique[index.name] != bool(index.unique):
+                index.drop(conn)
+            index.create(conn, checkfirst=True)
 
 async def main():
     await create_tables()
@@ -0,0 +1,64 @@
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+from typing import Optional
+import src.models as models
+import base64
+import datetime
+import json
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+def encode_cursor(created_at: datetime.datetime, product_id: int) -> str:
+  payload = json.dumps([created_at.isoformat(), product_id], separators=(",", ":"))
+  return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_at, product_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return datetime.datetime.fromisoformat(created_at), int(product_id)
+  except (ValueError, TypeError):
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def filter_products(
+  query,
+  min_price: Optional[float] = None,
+  max_price: Optional[float] = None,
+  available: Optional[bool] = None,
+  user_id: Optional[int] = None,
+):
+  if min_price is not None:
+    query = query.where(models.Products.price >= min_price)
+  if max_price is not None:
+    query = query.where(models.Products.price <= max_price)
+  if available is not None:
+    query = query.where(models.Products.available == available)
+  if user_id is not None:
+    query = query.where(models.Products.user_id == user_id)
+  return query
+
+def paginate_products(query, cursor: Optional[str], limit: int):
+  # Newest first. The expanded OR form (rather than a row-value comparison)
+  # lets MySQL seek straight into the (created_at, id) indexes.
+  if cursor:
+    created_at, product_id = decode_cursor(cursor)
+    query = query.where(
+      or_(
+        models.Products.created_at < created_at,
+        and_(
+          models.Products.created_at == created_at,
+          models.Products.id < product_id,
+        ),
+      )
+    )
+  # One extra row tells us whether another page exists.
+  return query.order_by(
+    models.Products.created_at.desc(), models.Products.id.desc()
+  ).limit(limit + 1)
+
+def next_cursor(rows: list, limit: int) -> Optional[str]:
+  if len(rows) <= limit:
+    return None
+  last = rows[limit - 1]
+  return encode_cursor(last.created_at, last.id)
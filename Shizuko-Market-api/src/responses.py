@@ -0,0 +1,12 @@
+from fastapi.responses import JSONResponse
+from pydantic_core import to_json
+
+class FastJSONResponse(JSONResponse):
+  # pydantic-core's Rust serializer writes response models (including ones
+  # built with model_construct), datetimes and nested dicts straight to
+  # bytes, skipping jsonable_encoder's per-field Python walk.
+  def render(self, content) -> bytes:
+    return to_json(content)
+
+def dumps(content) -> bytes:
+  return to_json(content)
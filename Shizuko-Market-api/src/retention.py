@@ -0,0 +1,338 @@
+from sqlalchemy.future import select
+from sqlalchemy import DateTime, Numeric, delete
+from pathlib import Path
+import src.models as models
+import src.config as config
+import src.cleanup as cleanup
+import src.images as images
+import src.responses as responses
+import src.sync as sync
+import argparse
+import asyncio
+import datetime
+import decimal
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Moves users_d/products_d rows older than the retention age out of the
+# database into gzipped NDJSON chunks on local disk. Each batch of archived
+# users is written together with all of their products, the files are
+# synced and listed in the manifest, and only then are the rows deleted in
+# the same transaction, so every user can be restored from the files alone.
+# Uploaded images the rows point at are copied under images/ first: once
+# the rows are gone the image sweep reclaims the originals.
+# A run that dies between the manifest and the commit leaves rows that the
+# next run exports again; restore keeps one copy per id.
+COLD_DIR = Path(os.getenv("ARCHIVE_COLD_DIR", "./cold-archive"))
+RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+BATCH_SIZE = 1000
+CHUNK_ROWS = 50000
+MANIFEST = "manifest.ndjson"
+IMAGE_DIR = "images"
+TABLES = {"users_d": models.UserD, "products_d": models.ProductsD}
+
+# ###################### FILES #######################
+def encode_row(row) -> bytes:
+  return responses.dumps(dict(row._mapping)) + b"\n"
+
+def decode_row(table, values: dict) -> dict:
+  # Back to column types: JSON has no datetimes or decimals.
+  row = {}
+  for column in table.columns:
+    value = values.get(column.name)
+    if value is not None and isinstance(column.type, DateTime):
+      value = datetime.datetime.fromisoformat(value)
+    elif value is not None and isinstance(column.type, Numeric):
+      value = decimal.Decimal(str(value))
+    row[column.name] = value
+  return row
+
+class ChunkWriter:
+  # One gzipped NDJSON file, written under a temporary name and renamed
+  # once synced. Tracks the id and user id ranges restore looks up.
+  def __init__(self, directory: Path, table: str):
+    self.directory = directory / table
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.table = table
+    self.rows = 0
+    self.first_id = self.last_id = None
+    self.min_user_id = self.max_user_id = None
+    self.temp = self.directory / f".{os.getpid()}-{time.time_ns()}.part"
+    self.file = gzip.open(self.temp, "wb", compresslevel=6)
+
+  def write(self, row, user_id: int):
+    self.file.write(encode_row(row))
+    self.rows += 1
+    if self.first_id is None:
+      self.first_id = row.id
+    self.last_id = row.id
+    self.min_user_id = user_id if self.min_user_id is None else min(self.min_user_id, user_id)
+    self.max_user_id = user_id if self.max_user_id is None else max(self.max_user_id, user_id)
+
+  def close(self) -> dict:
+    self.file.close()
+    digest = hashlib.sha256()
+    with open(self.temp, "rb") as f:
+      while block := f.read(1024 * 1024):
+        digest.update(block)
+      os.fsync(f.fileno())
+    name = f"{self.table}-{self.first_id:012d}-{self.last_id:012d}.ndjson.gz"
+    path = self.directory / name
+    os.replace(self.temp, path)
+    return {
+      "table": self.table,
+      "file": f"{self.table}/{name}",
+      "rows": self.rows,
+      "first_id": self.first_id,
+      "last_id": self.last_id,
+      "min_user_id": self.min_user_id,
+      "max_user_id": self.max_user_id,
+      "bytes": path.stat().st_size,
+      "sha256": digest.hexdigest(),
+      "written_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+  def discard(self):
+    self.file.close()
+    self.temp.unlink(missing_ok=True)
+
+def append_manifest(directory: Path, entries: list):
+  with open(directory / MANIFEST, "a") as f:
+    for entry in entries:
+      f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_manifest(directory: Path):
+  path = directory / MANIFEST
+  if not path.exists():
+    return
+  with open(path) as f:
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+def copy_file(source: Path, target: Path):
+  target.parent.mkdir(parents=True, exist_ok=True)
+  temp = target.with_name(f".{target.name}.{os.getpid()}.part")
+  shutil.copyfile(source, temp)
+  with open(temp, "rb") as f:
+    os.fsync(f.fileno())
+  os.replace(temp, target)
+
+def managed_paths(values) -> set:
+  paths = {cleanup.normalize(value) for value in values if value}
+  return {path for path in paths if cleanup.is_managed(path)}
+
+def archive_images(directory: Path, paths: set, user_ids: list) -> dict:
+  # Names are content hashes, so a copy already in cold storage is reused.
+  stored = []
+  copied = 0
+  for path in sorted(paths):
+    target = directory / IMAGE_DIR / path
+    if not target.exists():
+      if not Path(path).is_file():
+        continue
+      copy_file(Path(path), target)
+      copied += target.stat().st_size
+    stored.append(path)
+  return {
+    "table": IMAGE_DIR,
+    "paths": stored,
+    "min_user_id": min(user_ids),
+    "max_user_id": max(user_ids),
+    "bytes": copied,
+    "written_at": datetime.datetime.now().isoformat(timespec="seconds"),
+  }
+
+def restore_images(directory: Path, paths: set) -> int:
+  # Puts back the files the restored rows point at, with their variants.
+  restored = 0
+  for path in sorted(paths):
+    source = directory / IMAGE_DIR / path
+    if Path(path).exists() or not source.is_file():
+      continue
+    copy_file(source, Path(path))
+    images.render_variants(path)
+    restored += 1
+  return restored
+
+# ###################### COMPACT #######################
+async def compact_batch(db, users: list, directory: Path, chunk_rows: int) -> dict:
+  user_ids = [row.id for row in users]
+  entries = []
+  writers = []
+  paths = managed_paths(row.profile_img for row in users)
+  try:
+    writer = ChunkWriter(directory, "users_d")
+    writers.append(writer)
+    for row in users:
+      writer.write(row, row.id)
+    entries.append(writer.close())
+
+    products = 0
+    writer = None
+    result = await db.stream(
+      select(models.ProductsD.__table__)
+      .where(models.ProductsD.user_id.in_(user_ids))
+      .order_by(models.ProductsD.id)
+      .execution_options(yield_per=BATCH_SIZE)
+    )
+    async for rows in result.partitions(BATCH_SIZE):
+      for row in rows:
+        if writer is None:
+          writer = ChunkWriter(directory, "products_d")
+          writers.append(writer)
+        writer.write(row, row.user_id)
+        paths.update(managed_paths([row.image]))
+        if writer.rows >= chunk_rows:
+          entries.append(writer.close())
+          products += writer.rows
+          writer = None
+    if writer is not None:
+      entries.append(writer.close())
+      products += writer.rows
+    stored = archive_images(directory, paths, user_ids)
+    if stored["paths"]:
+      entries.append(stored)
+  except BaseException:
+    for writer in writers:
+      writer.discard()
+    raise
+
+  append_manifest(directory, entries)
+  await db.execute(delete(models.ProductsD).where(models.ProductsD.user_id.in_(user_ids)))
+  await db.execute(delete(models.UserD).where(models.UserD.id.in_(user_ids)))
+  await db.commit()
+  return {
+    "users": len(users),
+    "products": products,
+    "images": len(stored["paths"]),
+    "bytes": sum(entry["bytes"] for entry in entries),
+  }
+
+async def compact(
+  older_than: datetime.timedelta,
+  directory: Path = COLD_DIR,
+  batch_size: int = BATCH_SIZE,
+  chunk_rows: int = CHUNK_ROWS,
+) -> dict:
+  # Walks users_d by primary key; memory stays at one batch of users plus
+  # one partition of products, whatever the archive size.
+  cutoff = datetime.datetime.now() - older_than
+  directory.mkdir(parents=True, exist_ok=True)
+  totals = {"users": 0, "products": 0, "images": 0, "bytes": 0, "batches": 0}
+  started = time.perf_counter()
+  last_id = 0
+  async with config.SessionLocal() as db:
+    while True:
+      result = await db.execute(
+        select(models.UserD.__table__)
+        .where(models.UserD.id > last_id, models.UserD.deleted_at < cutoff)
+        .order_by(models.UserD.id)
+        .limit(batch_size)
+      )
+      users = result.all()
+      if not users:
+        break
+      last_id = users[-1].id
+      try:
+        counts = await compact_batch(db, users, directory, chunk_rows)
+      except Exception:
+        await db.rollback()
+        raise
+      totals["batches"] += 1
+      for field in ("users", "products", "images", "bytes"):
+        totals[field] += counts[field]
+  totals["tombstones"] = await prune_tombstones(batch_size)
+  totals["cutoff"] = cutoff.isoformat(timespec="seconds")
+  totals["seconds"] = round(time.perf_counter() - started, 3)
+  return totals
+
+async def prune_tombstones(batch_size: int) -> int:
+  # Delta sync refuses tokens older than TOKEN_MAX_AGE, so older
+  # tombstones can no longer be asked for.
+  cutoff = datetime.datetime.now() - sync.TOKEN_MAX_AGE
+  pruned = 0
+  async with config.SessionLocal() as db:
+    while True:
+      result = await db.execute(
+        select(models.ProductTombstone.id)
+        .where(models.ProductTombstone.deleted_at < cutoff)
+        .order_by(models.ProductTombstone.id)
+        .limit(batch_size)
+      )
+      ids = result.scalars().all()
+      if not ids:
+        return pruned
+      await db.execute(delete(models.ProductTombstone).where(models.ProductTombstone.id.in_(ids)))
+      await db.commit()
+      pruned += len(ids)
+
+# ###################### RESTORE #######################
+def read_chunk(directory: Path, entry: dict):
+  with gzip.open(directory / entry["file"], "rb") as f:
+    for line in f:
+      yield json.loads(line)
+
+def find_user(directory: Path, user_id: int) -> tuple:
+  # The manifest narrows the search to the chunks whose ranges cover the
+  # user; only those files are read, one line at a time.
+  user = None
+  products = {}
+  for entry in read_manifest(directory):
+    if entry["table"] == "users_d" and user is None and entry["first_id"] <= user_id <= entry["last_id"]:
+      user = next((row for row in read_chunk(directory, entry) if row["id"] == user_id), None)
+    elif entry["table"] == "products_d" and entry["min_user_id"] <= user_id <= entry["max_user_id"]:
+      for row in read_chunk(directory, entry):
+        if row["user_id"] == user_id:
+          products[row["id"]] = row
+  return user, list(products.values())
+
+async def restore(user_id: int, directory: Path = COLD_DIR) -> dict:
+  # Puts one archived user and their products back into users_d/products_d
+  # under their original ids, and their images back in place.
+  user, products = find_user(directory, user_id)
+  if user is None:
+    raise LookupError(f"Archived user {user_id} is not in {directory}")
+  async with config.SessionLocal() as db:
+    existing = await db.execute(select(models.UserD.id).where(models.UserD.id == user_id))
+    if existing.first() is not None:
+      raise ValueError(f"Archived user {user_id} is already in users_d")
+    paths = managed_paths([user["profile_img"], *(row["image"] for row in products)])
+    restored_images = await asyncio.to_thread(restore_images, directory, paths)
+    await db.execute(models.UserD.__table__.insert(), [decode_row(models.UserD.__table__, user)])
+    if products:
+      await db.execute(
+        models.ProductsD.__table__.insert(),
+        [decode_row(models.ProductsD.__table__, row) for row in products],
+      )
+    await db.commit()
+  return {"user_id": user_id, "products": len(products), "images": restored_images}
+
+async def main(args) -> dict:
+  try:
+    if args.command == "compact":
+      return await compact(
+        datetime.timedelta(days=args.older_than_days), args.dir, args.batch_size, args.chunk_rows
+      )
+    return await restore(args.user_id, args.dir)
+  finally:
+    await config.dispose_engines()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Move old archive rows to compressed files, or restore one user")
+  parser.add_argument("--dir", type=Path, default=COLD_DIR, help="cold storage directory")
+  commands = parser.add_subparsers(dest="command", required=True)
+  compact_parser = commands.add_parser("compact", help="export and delete users_d/products_d rows past retention")
+  compact_parser.add_argument("--older-than-days", type=int, default=RETENTION_DAYS)
+  compact_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="archived users per transaction")
+  compact_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="products per file at most")
+  restore_parser = commands.add_parser("restore", help="put one archived user back into users_d/products_d")
+  restore_parser.add_argument("user_id", type=int, help="users_d id")
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(main(args))))
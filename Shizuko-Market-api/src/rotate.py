@@ -0,0 +1,156 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from pathlib import Path
+from typing import Optional
+from sqlalchemy.future import select
+from sqlalchemy import bindparam, update
+from src.encryption import SPE, keyring
+import src.models as models
+import src.config as config
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+BATCH_SIZE = 1000
+TABLES = {"users": models.User, "users_d": models.UserD}
+
+# ###################### WORKERS #######################
+_worker_spe = None
+
+def _init_worker(password: Optional[str], derived_key: str, previous_password: Optional[str], previous_derived_key: Optional[str]):
+  # Workers get the derived keys, not just the passwords, so none of them
+  # runs PBKDF2 again.
+  global _worker_spe
+  _worker_spe = keyring(password, derived_key, previous_password, previous_derived_key)
+
+def reencrypt(rows: list) -> tuple:
+  # rows are (id, password); returns the bulk update parameters and the ids
+  # that could not be decrypted with any known key.
+  updates, failed = [], []
+  for row_id, value in rows:
+    try:
+      plaintext = _worker_spe.decrypt(value)
+    except ValueError:
+      failed.append(row_id)
+      continue
+    updates.append({"b_id": row_id, "b_old": value, "b_password": _worker_spe.encrypt(plaintext)})
+  return updates, failed
+
+# ###################### JOB #######################
+def load_checkpoint(path: Optional[Path], key_id: str) -> dict:
+  # Progress is only reused for the same target key.
+  if path is None or not path.exists():
+    return {}
+  state = json.loads(path.read_text())
+  return state.get("tables", {}) if state.get("key_id") == key_id else {}
+
+def save_checkpoint(path: Optional[Path], key_id: str, tables: dict):
+  if path is None:
+    return
+  temp = path.with_name(path.name + ".part")
+  temp.write_text(json.dumps({"key_id": key_id, "tables": tables}))
+  os.replace(temp, path)
+
+async def rotate_table(db, pool, spe: SPE, name: str, last_id: int, batch_size: int, in_flight: int, progress: dict, checkpoint: Optional[Path]) -> dict:
+  model = TABLES[name]
+  table = model.__table__
+  stats = {"rows": 0, "rotated": 0, "current": 0, "failed": 0, "conflicts": 0}
+  # Guarded on the old value, so a password changed by the user while the
+  # job runs is never overwritten with the re-encrypted old one.
+  statement = (
+    update(table)
+    .where(table.c.id == bindparam("b_id"), table.c.password == bindparam("b_old"))
+    .values(password=bindparam("b_password"))
+  )
+  loop = asyncio.get_running_loop()
+  pending = deque()
+  exhausted = False
+
+  while pending or not exhausted:
+    # Keep the pool busy while earlier batches are being written back.
+    while not exhausted and len(pending) < in_flight:
+      result = await db.execute(
+        select(model.id, model.password)
+        .where(model.id > last_id)
+        .order_by(model.id)
+        .limit(batch_size)
+      )
+      rows = result.all()
+      if not rows:
+        exhausted = True
+        break
+      last_id = rows[-1].id
+      stats["rows"] += len(rows)
+      stale = [(row.id, row.password) for row in rows if row.password and not spe.is_current(row.password)]
+      stats["current"] += len(rows) - len(stale)
+      pending.append((last_id, loop.run_in_executor(pool, reencrypt, stale) if stale else None))
+
+    if not pending:
+      break
+    batch_last_id, future = pending.popleft()
+    if future is not None:
+      updates, failed = await future
+      if updates:
+        connection = await db.connection()
+        result = await connection.execute(statement, updates)
+        stats["rotated"] += result.rowcount
+        stats["conflicts"] += len(updates) - result.rowcount
+      for row_id in failed:
+        logging.error(f"Could not decrypt {name}.password for id {row_id} with any known key")
+      stats["failed"] += len(failed)
+    await db.commit()
+    # Batches complete in order, so everything up to here is written.
+    progress[name] = batch_last_id
+    save_checkpoint(checkpoint, spe.key_id, progress)
+  return stats
+
+async def rotate(workers: int, batch_size: int = BATCH_SIZE, checkpoint: Optional[Path] = None, tables=tuple(TABLES)) -> dict:
+  if not (config.encryption_password or config.encryption_derived_key):
+    raise SystemExit("ENCRYPTION_PASSWORD or ENCRYPTION_DERIVED_KEY (the new key) is not set")
+  spe = keyring(
+    config.encryption_password,
+    config.encryption_derived_key,
+    config.encryption_previous_password,
+    config.encryption_previous_derived_key,
+  )
+  previous = spe.previous[0] if spe.previous else None
+  progress = load_checkpoint(checkpoint, spe.key_id)
+  started = time.perf_counter()
+  report = {"key_id": spe.key_id, "tables": {}}
+
+  with ProcessPoolExecutor(
+    max_workers=workers,
+    initializer=_init_worker,
+    initargs=(
+      config.encryption_password,
+      spe.export_key(),
+      config.encryption_previous_password,
+      previous.export_key() if previous else None,
+    ),
+  ) as pool:
+    async with config.SessionLocal() as db:
+      for name in tables:
+        report["tables"][name] = await rotate_table(
+          db, pool, spe, name, progress.get(name, 0), batch_size, workers * 2, progress, checkpoint
+        )
+
+  seconds = time.perf_counter() - started
+  rows = sum(stats["rows"] for stats in report["tables"].values())
+  report["seconds"] = round(seconds, 3)
+  report["rows_per_second"] = round(rows / seconds, 1) if seconds else 0.0
+  await config.engine.dispose()
+  return report
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description="Re-encrypt stored passwords from ENCRYPTION_PREVIOUS_PASSWORD to ENCRYPTION_PASSWORD"
+  )
+  parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+  parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+  parser.add_argument("--tables", nargs="+", choices=sorted(TABLES), default=list(TABLES))
+  parser.add_argument("--checkpoint", type=Path, default=Path("./.rotate-checkpoint"))
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(rotate(args.workers, args.batch_size, args.checkpoint, args.tables))))
@@ -1,6 +1,22 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PlainSerializer, field_validator
 from fastapi import Form
-from typing import Optional
+from typing import Annotated, Optional
+from decimal import Decimal
+import src.images as images
+import datetime
+
+# Passwords are stored encrypted in a VARCHAR(255): the key id, IV and HMAC
+# take 53 characters and base64 grows the rest by a third, so the limit is
+# on UTF-8 bytes. 128 bytes encrypt to 241 characters.
+PASSWORD_MAX_LENGTH = 128
+
+def password_fits(value: str) -> bool:
+  return len(value.encode()) <= PASSWORD_MAX_LENGTH
+
+def check_password_length(value):
+  if value is not None and not password_fits(value):
+    raise ValueError(f"Password must be at most {PASSWORD_MAX_LENGTH} bytes")
+  return value
 
 class UserCreate(BaseModel):
   full_name: str = Field(
@@ -17,15 +33,20 @@ class UserCreate(BaseModel):
     ..., min_length=10, max_length=11, description="Number phone of the user"
   )
   password: str = Field(
-    ..., min_length=8, description="Password with at least 8 characters"
+    ...,
+    min_length=8,
+    max_length=PASSWORD_MAX_LENGTH,
+    description="Password with at least 8 characters",
   )
 
+  _password_fits = field_validator("password")(check_password_length)
+
   class Config:
     from_attributes = True
 
 class UserCheck(BaseModel):
   phone_number: str = Field(..., description="A valid phone number")
-  password: str = Field(..., description="Password with at least 8 characters")
+  password: str = Field(..., max_length=PASSWORD_MAX_LENGTH, description="Password with at least 8 characters")
 
   class Config:
     from_attributes = True
@@ -49,9 +70,179 @@ class UserUpdate(BaseModel):
     description="Unique username",
   )
   password: Optional[str] = Form(
-    None, min_length=8, description="Password with at least 8 characters"
+    None,
+    min_length=8,
+    max_length=PASSWORD_MAX_LENGTH,
+    description="Password with at least 8 characters",
   )
   image: Optional[str] = Form(None, description="Image of the user")
 
+  _password_fits = field_validator("password")(check_password_length)
+
   class Config:
-    from_attributes = True
\ No newline at end of file
+    from_attributes = True
+
+class ProductImport(BaseModel):
+  title: str = Field(..., min_length=1, max_length=100, description="Title of the product")
+  description: str = Field(..., min_length=1, max_length=600, description="Description of the product")
+  price: Decimal = Field(..., ge=0, max_digits=10, decimal_places=2, description="Price of the product")
+  available: bool = Field(True, description="Whether the product is still available")
+  image: Optional[str] = Field(None, description="Name of the image inside the uploaded archive")
+
+  @field_validator("image", mode="before")
+  @classmethod
+  def empty_image_is_none(cls, value):
+    return value or None
+
+  @field_validator("available", mode="before")
+  @classmethod
+  def empty_available_is_true(cls, value):
+    return True if value in (None, "") else value
+
+# ###################### RESPONSES #######################
+# Built with model_construct from trusted row tuples (no validation pass)
+# and serialized by responses.FastJSONResponse.
+
+# Decimal columns keep going out as JSON numbers, like jsonable_encoder did.
+Price = Annotated[Decimal, PlainSerializer(float, return_type=float, when_used="json")]
+
+class UserOut(BaseModel):
+  id: int
+  full_name: str
+  username: str
+  phone_number: int
+  token: str
+  profile_img: Optional[str] = None
+  profile_img_variants: Optional[dict] = None
+
+  @classmethod
+  def from_row(cls, row):
+    return cls.model_construct(
+      id=row.id,
+      full_name=row.full_name,
+      username=row.username,
+      phone_number=row.phone_number,
+      token=row.token,
+      profile_img=row.profile_img,
+      profile_img_variants=images.variant_urls(row.profile_img),
+    )
+
+class UserLogin(BaseModel):
+  full_name: str
+  username: str
+  phone_number: int
+  token: str
+  profile_img: Optional[str] = None
+  profile_img_variants: Optional[dict] = None
+
+  @classmethod
+  def from_row(cls, row):
+    return cls.model_construct(
+      full_name=row.full_name,
+      username=row.username,
+      phone_number=row.phone_number,
+      token=row.token,
+      profile_img=row.profile_img,
+      profile_img_variants=images.variant_urls(row.profile_img),
+    )
+
+class ProductOut(BaseModel):
+  id: int
+  user_id: int
+  title: str
+  description: str
+  price: Price
+  image: Optional[str] = None
+  image_variants: Optional[dict] = None
+  available: Optional[bool] = None
+  created_at: Optional[datetime.datetime] = None
+
+  @classmethod
+  def from_row(cls, row):
+    return cls.model_construct(
+      id=row.id,
+      user_id=row.user_id,
+      title=row.title,
+      description=row.description,
+      price=row.price,
+      image=row.image,
+      image_variants=images.variant_urls(row.image),
+      available=row.available,
+      created_at=row.created_at,
+    )
+
+class SellerOut(BaseModel):
+  full_name: str
+  username: str
+  profile_img: Optional[str] = None
+  profile_img_variants: Optional[dict] = None
+
+class FeedProduct(BaseModel):
+  product_id: int
+  title: str
+  description: str
+  price: Price
+  image: Optional[str] = None
+  image_variants: Optional[dict] = None
+  available: Optional[bool] = None
+  time: Optional[datetime.datetime] = None
+  user: SellerOut
+
+  @classmethod
+  def from_row(cls, row):
+    return cls.model_construct(
+      product_id=row.id,
+      title=row.title,
+      description=row.description,
+      price=row.price,
+      image=row.image,
+      image_variants=images.variant_urls(row.image),
+      available=row.available,
+      time=row.created_at,
+      user=SellerOut.model_construct(
+        full_name=row.full_name,
+        username=row.username,
+        profile_img=row.profile_img,
+        profile_img_variants=images.variant_urls(row.profile_img),
+      ),
+    )
+
+class SyncOut(BaseModel):
+  products: list[FeedProduct]
+  deleted: list[int]
+  sync_token: str
+  has_more: bool
+
+MAX_BATCH_IDS = 500
+
+class ProductBatchIn(BaseModel):
+  ids: list[int] = Field(..., min_length=1, max_length=MAX_BATCH_IDS, description="Product ids, in display order")
+
+class ProductBatchOut(BaseModel):
+  # products[i] is the product for ids[i], or null when it does not exist.
+  products: list[Optional[FeedProduct]]
+  missing: list[int]
+
+class CatalogStats(BaseModel):
+  product_count: int
+  available_count: int
+  unavailable_count: int
+  min_price: Optional[Price] = None
+  max_price: Optional[Price] = None
+  avg_price: Optional[Price] = None
+  last_listed_at: Optional[datetime.datetime] = None
+
+  @classmethod
+  def from_row(cls, row):
+    # No row yet means nothing was ever listed.
+    if row is None or not row.product_count:
+      return cls.model_construct(product_count=0, available_count=0, unavailable_count=0)
+    return cls.model_construct(
+      product_count=row.product_count,
+      available_count=row.available_count,
+      unavailable_count=row.product_count - row.available_count,
+      min_price=row.min_price,
+      max_price=row.max_price,
+      avg_price=(Decimal(row.price_sum) / row.product_count).quantize(Decimal("0.01")),
+      last_listed_at=row.last_listed_at,
+    )
@@ -0,0 +1,364 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from array import array
+from typing import Optional
+import src.models as models
+import src.config as config
+import src.metrics as metrics
+import src.sync as sync
+import asyncio
+import bisect
+import heapq
+import logging
+import math
+import os
+import re
+import time
+
+TOKEN_RE = re.compile(r"\w+")
+TITLE_WEIGHT = 3
+TF_MASK = 0xFFFF
+TF_BITS = 16
+BUILD_CHUNK_ROWS = 1000
+
+# Work caps per query. Candidates are visited newest first, so a query
+# matching half the catalog ranks the most recent matches instead of
+# scoring every posting.
+MAX_SCAN = int(os.getenv("SEARCH_MAX_SCAN", "5000"))
+MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", "500"))
+MAX_EXPANSIONS = 10
+EXPANSION_CANDIDATES = 200
+REFRESH_SECONDS = float(os.getenv("SEARCH_REFRESH_SECONDS", "5"))
+
+K1 = 1.2
+B = 0.75
+
+# Document states, indexed by product id.
+ABSENT, AVAILABLE, UNAVAILABLE = 0, 1, 2
+
+def tokenize(text: Optional[str]) -> list:
+  return [token for token in TOKEN_RE.findall((text or "").casefold()) if len(token) > 1 or token.isdigit()]
+
+class SearchIndex:
+  # Inverted index over product titles and descriptions. Each term maps to
+  # an array of (product_id << 16 | weighted tf) kept in product id order,
+  # so membership is a bisect and new products are plain appends. Per
+  # product data lives in flat arrays indexed by id, which also keeps the
+  # index shared copy-on-write between forked workers.
+  def __init__(self):
+    self.postings = {}
+    self.vocabulary = []
+    self.states = bytearray()
+    self.prices = array("d")
+    self.lengths = array("H")
+    self.sellers = {}
+    self.documents = 0
+    self.deleted = 0
+    self.total_length = 0
+    # Rows stamped up to here are indexed; see refresh().
+    self.refreshed_to = None
+    self.queries = 0
+    self.ready = False
+    self.last_refresh = 0.0
+    self._building = False
+    self._deferred = []
+    self._sorted = True
+
+  # ###################### WRITES #######################
+  def _grow(self, product_id: int):
+    missing = product_id + 1 - len(self.states)
+    if missing > 0:
+      missing = max(missing, len(self.states) // 4, 1024)
+      self.states.extend(bytes(missing))
+      self.prices.extend(array("d", bytes(8 * missing)))
+      self.lengths.extend(array("H", bytes(2 * missing)))
+
+  def add(self, product_id: int, user_id: int, title: str, description: str, price, available: Optional[bool]):
+    if self._building:
+      self._deferred.append(("add", (product_id, user_id, title, description, price, available)))
+      return
+    self._add(product_id, user_id, title, description, price, available)
+
+  def _add(self, product_id: int, user_id: int, title: str, description: str, price, available: Optional[bool]):
+    self._grow(product_id)
+    if self.states[product_id] != ABSENT:
+      return
+    # Title and description lengths are capped by their columns, so the
+    # weighted tf always fits in TF_BITS.
+    weights = {}
+    for token in tokenize(title):
+      weights[token] = weights.get(token, 0) + TITLE_WEIGHT
+    for token in tokenize(description):
+      weights[token] = weights.get(token, 0) + 1
+    base = product_id << TF_BITS
+    postings_by_term = self.postings
+    for term, weight in weights.items():
+      value = base | weight
+      postings = postings_by_term.get(term)
+      if postings is None:
+        postings_by_term[term] = array("Q", (value,))
+        if self._sorted:
+          bisect.insort(self.vocabulary, term)
+      elif postings[-1] < value:
+        postings.append(value)
+      else:
+        # Out of order, e.g. a replica that had not caught up at build time.
+        bisect.insort(postings, value)
+    length = min(sum(weights.values()), 0xFFFF)
+    self.states[product_id] = UNAVAILABLE if available is False else AVAILABLE
+    self.prices[product_id] = float(price)
+    self.lengths[product_id] = length
+    self.sellers.setdefault(user_id, array("Q")).append(product_id)
+    self.documents += 1
+    self.total_length += length
+
+  def remove(self, product_id: int):
+    if self._building:
+      self._deferred.append(("remove", (product_id,)))
+      return
+    if product_id >= len(self.states) or self.states[product_id] == ABSENT:
+      return
+    # Postings are dropped lazily: the state check hides the product and
+    # compact() rewrites the arrays once enough of them are dead.
+    self.states[product_id] = ABSENT
+    self.documents -= 1
+    self.deleted += 1
+    self.total_length -= self.lengths[product_id]
+    if self.deleted > max(10000, self.documents // 4):
+      self.compact()
+
+  def remove_seller(self, user_id: int):
+    if self._building:
+      self._deferred.append(("remove_seller", (user_id,)))
+      return
+    for product_id in self.sellers.pop(user_id, ()):
+      self.remove(product_id)
+
+  def compact(self):
+    states = self.states
+    for term in list(self.postings):
+      live = array("Q", (value for value in self.postings[term] if states[value >> TF_BITS] != ABSENT))
+      if live:
+        self.postings[term] = live
+      else:
+        del self.postings[term]
+    for user_id in list(self.sellers):
+      live = array("Q", (product_id for product_id in self.sellers[user_id] if states[product_id] != ABSENT))
+      if live:
+        self.sellers[user_id] = live
+      else:
+        del self.sellers[user_id]
+    self.vocabulary = sorted(self.postings)
+    self.deleted = 0
+
+  # ###################### BUILD #######################
+  async def build(self, session_factory=None):
+    # Streams the whole table in id order. Writes that arrive meanwhile are
+    # queued and replayed afterwards, so postings stay sorted.
+    session_factory = session_factory or config.ReadSessionLocal
+    started = time.perf_counter()
+    horizon = sync.sync_horizon()
+    self._building = True
+    self._sorted = False
+    try:
+      async with session_factory() as db:
+        result = await db.stream(_documents_query().execution_options(yield_per=BUILD_CHUNK_ROWS))
+        async for rows in result.partitions(BUILD_CHUNK_ROWS):
+          for row in rows:
+            self._add(row.id, row.user_id, row.title, row.description, row.price, row.available)
+          # Bounded stalls: give other requests a turn between chunks.
+          await asyncio.sleep(0)
+    finally:
+      self.vocabulary = sorted(self.postings)
+      self._sorted = True
+      self._building = False
+      deferred, self._deferred = self._deferred, []
+      for operation, args in deferred:
+        getattr(self, operation)(*args)
+    self.refreshed_to = horizon
+    self.ready = True
+    self.last_refresh = time.monotonic()
+    logging.info(
+      f"Search index built: {self.documents} products, {len(self.postings)} terms in {time.perf_counter() - started:.1f}s"
+    )
+
+  async def refresh(self):
+    # Picks up products inserted by other workers. Ids do not commit in
+    # order, so rows are found by updated_at like delta sync does: anything
+    # stamped before the settle horizon has committed, and each refresh
+    # reads (refreshed_to, horizon]. Re-reading an indexed product is a
+    # no-op. Reads the primary, so replica lag cannot skip rows. Deletions
+    # elsewhere are caught when a hit fails to load, see forget_missing().
+    # Before the first build there is nothing to catch up on.
+    if not self.ready:
+      return
+    self.last_refresh = time.monotonic()
+    horizon = sync.sync_horizon()
+    async with config.SessionLocal() as db:
+      await self.load(db, models.Products.updated_at > self.refreshed_to, models.Products.updated_at <= horizon)
+    self.refreshed_to = horizon
+
+  async def load(self, db: AsyncSession, *conditions):
+    # Indexes the products matching conditions.
+    result = await db.execute(_documents_query().where(*conditions))
+    for row in result.all():
+      self.add(row.id, row.user_id, row.title, row.description, row.price, row.available)
+
+  def needs_refresh(self) -> bool:
+    return self.ready and time.monotonic() - self.last_refresh > REFRESH_SECONDS
+
+  def forget(self, product_ids):
+    for product_id in product_ids:
+      self.remove(product_id)
+
+  async def forget_missing(self, db: AsyncSession, product_ids: list):
+    # Hits that did not load. A lagging replica may just not have them yet,
+    # and refresh only looks at recent changes, so anything forgotten by
+    # mistake would be gone from this worker for good: only ids the primary
+    # no longer has are dropped.
+    if not product_ids:
+      return
+    if config.read_engine is not None and db.get_bind() is not config.engine.sync_engine:
+      async with config.SessionLocal() as primary:
+        result = await primary.execute(select(models.Products.id).where(models.Products.id.in_(product_ids)))
+        present = set(result.scalars())
+      product_ids = [product_id for product_id in product_ids if product_id not in present]
+    self.forget(product_ids)
+
+  # ###################### QUERIES #######################
+  def expand(self, prefix: str) -> list:
+    # Completions of the last query word, the most common ones first.
+    start = bisect.bisect_left(self.vocabulary, prefix)
+    candidates = []
+    for term in self.vocabulary[start:start + EXPANSION_CANDIDATES]:
+      if not term.startswith(prefix):
+        break
+      candidates.append(term)
+    return heapq.nlargest(MAX_EXPANSIONS, candidates, key=lambda term: len(self.postings[term]))
+
+  def search(
+    self,
+    query: str,
+    limit: int,
+    offset: int = 0,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    available: Optional[bool] = None,
+    prefix: bool = True,
+  ) -> list:
+    # Every query word must match (the last one as a prefix for
+    # typeahead); matches are ranked with BM25. Returns product ids.
+    self.queries += 1
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or not self.documents:
+      return []
+    groups = []
+    for position, term in enumerate(terms):
+      if prefix and position == len(terms) - 1:
+        expansions = self.expand(term)
+      else:
+        expansions = [term] if term in self.postings else []
+      if not expansions:
+        return []
+      groups.append([self.postings[term] for term in expansions])
+
+    sizes = [sum(len(postings) for postings in group) for group in groups]
+    driver = min(range(len(groups)), key=sizes.__getitem__)
+    idfs = [math.log(1 + (self.documents - size + 0.5) / (size + 0.5)) for size in sizes]
+    others = [(groups[index], idfs[index]) for index in range(len(groups)) if index != driver]
+    driver_idf = idfs[driver]
+    average_length = self.total_length / self.documents if self.documents else 1.0
+
+    wanted = AVAILABLE if available is True else UNAVAILABLE if available is False else None
+    states, prices, lengths = self.states, self.prices, self.lengths
+    top = []
+    needed = min(offset + limit, MAX_MATCHES)
+    scanned = matched = 0
+
+    for product_id, tf in _descending(groups[driver]):
+      scanned += 1
+      if scanned > MAX_SCAN or matched >= MAX_MATCHES:
+        break
+      state = states[product_id]
+      if state == ABSENT or (wanted is not None and state != wanted):
+        continue
+      price = prices[product_id]
+      if (min_price is not None and price < min_price) or (max_price is not None and price > max_price):
+        continue
+      norm = K1 * (1 - B + B * lengths[product_id] / average_length)
+      score = driver_idf * tf * (K1 + 1) / (tf + norm)
+      for group, idf in others:
+        tf = 0
+        for postings in group:
+          tf += _lookup(postings, product_id)
+        if not tf:
+          break
+        score += idf * tf * (K1 + 1) / (tf + norm)
+      else:
+        matched += 1
+        # Ties go to the newer product.
+        if len(top) < needed:
+          heapq.heappush(top, (score, product_id))
+        elif (score, product_id) > top[0]:
+          heapq.heapreplace(top, (score, product_id))
+
+    ranked = sorted(top, reverse=True)
+    return [product_id for _, product_id in ranked[offset:offset + limit]]
+
+  def stats(self) -> dict:
+    return {
+      "ready": self.ready,
+      "documents": self.documents,
+      "deleted": self.deleted,
+      "terms": len(self.postings),
+      "postings": sum(len(postings) for postings in self.postings.values()),
+      "queries": self.queries,
+    }
+
+def _lookup(postings, product_id: int) -> int:
+  index = bisect.bisect_left(postings, product_id << TF_BITS)
+  if index < len(postings) and postings[index] >> TF_BITS == product_id:
+    return postings[index] & TF_MASK
+  return 0
+
+def _descending(group: list):
+  # Yields (product_id, tf) newest first, summing the tf of a product that
+  # matches several completions of a prefix.
+  if len(group) == 1:
+    for value in reversed(group[0]):
+      yield value >> TF_BITS, value & TF_MASK
+    return
+  current, total = None, 0
+  for value in heapq.merge(*(reversed(postings) for postings in group), reverse=True):
+    product_id = value >> TF_BITS
+    if product_id != current:
+      if current is not None:
+        yield current, total
+      current, total = product_id, 0
+    total += value & TF_MASK
+  if current is not None:
+    yield current, total
+
+def _documents_query():
+  return select(
+    models.Products.id,
+    models.Products.user_id,
+    models.Products.title,
+    models.Products.description,
+    models.Products.price,
+    models.Products.available,
+  ).order_by(models.Products.id)
+
+index = SearchIndex()
+
+metrics.register_cache(
+  "search_index",
+  index.stats,
+  counters=("queries",),
+  gauges=("documents", "deleted", "terms", "postings"),
+)
+
+async def preload():
+  # Run by the pre-fork launcher so the workers share one built index.
+  await index.build(config.ReadSessionLocal)
+  await config.dispose_engines()
@@ -0,0 +1,145 @@
+import src.lifecycle as lifecycle
+import src.metrics as metrics
+import src.search as search
+import asyncio
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+import uvicorn
+
+log = logging.getLogger("shizuko.server")
+
+RESTART_DELAY = 1.0
+KILL_GRACE = 5.0
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+  family = socket.AF_INET6 if ":" in host else socket.AF_INET
+  sock = socket.socket(family, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((host, port))
+  sock.listen(backlog)
+  sock.set_inheritable(True)
+  return sock
+
+def serve(app, sock: socket.socket, args):
+  server = uvicorn.Server(uvicorn.Config(
+    app,
+    lifespan="on",
+    backlog=args.backlog,
+    timeout_graceful_shutdown=args.graceful_timeout,
+    timeout_keep_alive=args.keep_alive,
+    log_level=args.log_level,
+  ))
+  server.run(sockets=[sock])
+
+def spawn(app, sock: socket.socket, args) -> int:
+  pid = os.fork()
+  if pid:
+    return pid
+  # Own process group: a terminal Ctrl-C reaches only the parent, which
+  # sends exactly one SIGTERM, so uvicorn drains instead of force-exiting.
+  os.setpgrp()
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  code = 0
+  try:
+    serve(app, sock, args)
+  except BaseException:
+    log.exception("Worker crashed")
+    code = 1
+  finally:
+    os._exit(code)
+
+def supervise(app, sock: socket.socket, args):
+  # Pre-fork: the app is imported once here and the workers share its
+  # memory copy-on-write. Dead workers are replaced until SIGTERM/SIGINT,
+  # which is forwarded once; workers still running after the graceful
+  # timeout are killed.
+  children = {}
+  state = {"stopping": False, "deadline": None}
+
+  def stop(signum, frame):
+    if state["stopping"]:
+      return
+    state["stopping"] = True
+    state["deadline"] = time.monotonic() + args.graceful_timeout + KILL_GRACE
+    log.info(f"Received {signal.Signals(signum).name}, draining {len(children)} workers")
+    for pid in list(children):
+      os.kill(pid, signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  for index in range(args.workers):
+    children[spawn(app, sock, args)] = index
+
+  while children:
+    pid, status = os.waitpid(-1, os.WNOHANG)
+    if pid == 0:
+      if state["deadline"] is not None and time.monotonic() > state["deadline"]:
+        for child in list(children):
+          log.warning(f"Worker {child} did not drain in time, killing it")
+          os.kill(child, signal.SIGKILL)
+        state["deadline"] = None
+      time.sleep(0.1)
+      continue
+    index = children.pop(pid, None)
+    if index is None or state["stopping"]:
+      continue
+    log.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+    time.sleep(RESTART_DELAY)
+    children[spawn(app, sock, args)] = index
+  log.info("All workers stopped")
+
+def main(app):
+  parser = argparse.ArgumentParser(description="Run the Shizuko Market API")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+  parser.add_argument("--graceful-timeout", type=int, default=30, help="seconds to drain in-flight requests on SIGTERM")
+  parser.add_argument("--keep-alive", type=int, default=5)
+  parser.add_argument("--backlog", type=int, default=2048)
+  parser.add_argument("--log-level", default="info")
+  args = parser.parse_args()
+  # Read back by every worker's lifespan, forked or spawned.
+  os.environ["WEB_CONCURRENCY"] = str(args.workers)
+
+  logging.basicConfig(
+    level=args.log_level.upper(),
+    format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s",
+  )
+  logging.getLogger("sqlalchemy").setLevel(logging.WARNING)
+  # The app was imported before main() runs; derive the key once here so
+  # every forked worker inherits it.
+  from src.v1 import spe
+  spe.key
+  if args.workers > 1 and os.getenv("SEARCH_PRELOAD", "1") == "1":
+    # Built once here instead of once per worker; the arrays are shared
+    # copy-on-write after the fork.
+    asyncio.run(search.preload())
+  memory = metrics.process_memory()
+  preload = metrics.process_uptime()
+  log.info(
+    f"Preloaded in {'n/a' if preload is None else f'{preload:.3f}s'}, rss {lifecycle.format_mib(memory['rss'])}, "
+    f"starting {args.workers} worker(s) on {args.host}:{args.port}"
+  )
+
+  sock = bind_socket(args.host, args.port, args.backlog)
+  if args.workers == 1:
+    serve(app, sock, args)
+  elif hasattr(os, "fork"):
+    supervise(app, sock, args)
+  else:
+    # No fork (Windows): uvicorn spawns workers that each import the app.
+    sock.close()
+    uvicorn.run(
+      "run:app",
+      host=args.host,
+      port=args.port,
+      workers=args.workers,
+      backlog=args.backlog,
+      timeout_graceful_shutdown=args.graceful_timeout,
+      log_level=args.log_level,
+    )
@@ -0,0 +1,111 @@
+from fastapi import HTTPException
+from sqlalchemy.future import select
+from sqlalchemy import and_, or_
+from typing import NamedTuple, Optional
+import src.models as models
+import base64
+import datetime
+import json
+import os
+
+DEFAULT_LIMIT = 200
+MAX_LIMIT = 500
+
+# Changes younger than this are held back until the next sync. A slower
+# transaction could still commit a row stamped before the newest one
+# already handed out, and keyset tokens would skip it.
+SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "2"))
+# Tokens issued longer ago than this answer 410, so tombstones older than
+# it can be pruned.
+TOKEN_MAX_AGE = datetime.timedelta(days=int(os.getenv("SYNC_TOKEN_MAX_AGE_DAYS", "30")))
+
+class SyncToken(NamedTuple):
+  # Position in both change streams: the last (updated_at, id) product
+  # and the last (deleted_at, id) tombstone the client has seen, plus when
+  # the token was issued.
+  updated_at: datetime.datetime
+  product_id: int
+  deleted_at: datetime.datetime
+  tombstone_id: int
+  issued_at: datetime.datetime
+
+def encode_token(token: SyncToken) -> str:
+  payload = json.dumps(
+    [
+      token.updated_at.isoformat(),
+      token.product_id,
+      token.deleted_at.isoformat(),
+      token.tombstone_id,
+      token.issued_at.isoformat(),
+    ],
+    separators=(",", ":"),
+  )
+  return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_token(token: str) -> SyncToken:
+  try:
+    padded = token + "=" * (-len(token) % 4)
+    updated_at, product_id, deleted_at, tombstone_id, issued_at = json.loads(
+      base64.urlsafe_b64decode(padded.encode())
+    )
+    return SyncToken(
+      datetime.datetime.fromisoformat(updated_at),
+      int(product_id),
+      datetime.datetime.fromisoformat(deleted_at),
+      int(tombstone_id),
+      datetime.datetime.fromisoformat(issued_at),
+    )
+  except (ValueError, TypeError):
+    raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def start_token(token: Optional[str], horizon: datetime.datetime) -> SyncToken:
+  # Without a token the client has nothing cached: every product is sent
+  # and tombstones from before now are irrelevant.
+  if not token:
+    return SyncToken(datetime.datetime.min, 0, horizon, 0, horizon)
+  since = decode_token(token)
+  if since.issued_at < horizon - TOKEN_MAX_AGE:
+    raise HTTPException(status_code=410, detail="Sync token expired, sync again without a token")
+  return since
+
+def sync_horizon() -> datetime.datetime:
+  return datetime.datetime.now() - datetime.timedelta(seconds=SETTLE_SECONDS)
+
+def changed_products(query, since: SyncToken, horizon: datetime.datetime, limit: int):
+  # Oldest change first, so the token can advance past what was sent.
+  return query.where(
+    or_(
+      models.Products.updated_at > since.updated_at,
+      and_(
+        models.Products.updated_at == since.updated_at,
+        models.Products.id > since.product_id,
+      ),
+    ),
+    models.Products.updated_at <= horizon,
+  ).order_by(models.Products.updated_at, models.Products.id).limit(limit + 1)
+
+def deleted_products(since: SyncToken, horizon: datetime.datetime, limit: int):
+  return select(
+    models.ProductTombstone.id,
+    models.ProductTombstone.product_id,
+    models.ProductTombstone.deleted_at,
+  ).where(
+    or_(
+      models.ProductTombstone.deleted_at > since.deleted_at,
+      and_(
+        models.ProductTombstone.deleted_at == since.deleted_at,
+        models.ProductTombstone.id > since.tombstone_id,
+      ),
+    ),
+    models.ProductTombstone.deleted_at <= horizon,
+  ).order_by(models.ProductTombstone.deleted_at, models.ProductTombstone.id).limit(limit + 1)
+
+def next_token(since: SyncToken, products: list, tombstones: list, limit: int, horizon: datetime.datetime) -> SyncToken:
+  token = since._replace(issued_at=horizon)
+  if products:
+    last = products[min(len(products), limit) - 1]
+    token = token._replace(updated_at=last.updated_at, product_id=last.id)
+  if tombstones:
+    last = tombstones[min(len(tombstones), limit) - 1]
+    token = token._replace(deleted_at=last.deleted_at, tombstone_id=last.id)
+  return token
@@ -0,0 +1,116 @@
+from typing import Awaitable, Callable
+import src.metrics as metrics
+import asyncio
+import logging
+import os
+import time
+
+log = logging.getLogger("shizuko.tasks")
+
+class TaskQueue:
+  # Post-commit side effects (file cleanup and the like) run here so the
+  # handler can answer as soon as its commit lands. Bounded: when the queue
+  # is full the job is dropped and logged, so submitters never block; every
+  # job put here must be safe to lose, e.g. because a periodic sweep redoes
+  # it. Failed jobs are retried with exponential backoff.
+  def __init__(self, workers: int = 4, maxsize: int = 10000, retries: int = 3, backoff: float = 0.5):
+    self.workers = workers
+    self.maxsize = maxsize
+    self.retries = retries
+    self.backoff = backoff
+    self.submitted = 0
+    self.completed = 0
+    self.retried = 0
+    self.failed = 0
+    self.dropped = 0
+    self.running = 0
+    self._queue = None
+    self._workers = []
+
+  def submit(self, job: Callable[..., Awaitable], *args) -> bool:
+    if self._queue is None:
+      self._start()
+    try:
+      self._queue.put_nowait((job, args))
+    except asyncio.QueueFull:
+      self.dropped += 1
+      log.warning(f"Task queue full, dropped {job.__name__}")
+      return False
+    self.submitted += 1
+    return True
+
+  def _start(self):
+    # Lazily, on the loop of the first submitter.
+    self._queue = asyncio.Queue(self.maxsize)
+    self._workers = [asyncio.get_running_loop().create_task(self._work()) for _ in range(self.workers)]
+
+  async def _work(self):
+    while True:
+      job, args = await self._queue.get()
+      self.running += 1
+      try:
+        await self._run(job, args)
+      finally:
+        self.running -= 1
+        self._queue.task_done()
+
+  async def _run(self, job, args):
+    for attempt in range(self.retries + 1):
+      try:
+        await job(*args)
+        self.completed += 1
+        return
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        if attempt == self.retries:
+          self.failed += 1
+          log.error(f"Task {job.__name__} failed after {attempt + 1} attempts: {str(e)}")
+          return
+        self.retried += 1
+        await asyncio.sleep(self.backoff * 2 ** attempt)
+
+  async def drain(self, timeout: float) -> int:
+    # Waits for queued jobs up to timeout, then stops the workers. Returns
+    # how many jobs were left undone.
+    if self._queue is None:
+      return 0
+    started = time.monotonic()
+    try:
+      await asyncio.wait_for(self._queue.join(), timeout)
+    except asyncio.TimeoutError:
+      pass
+    left = self._queue.qsize() + self.running
+    for worker in self._workers:
+      worker.cancel()
+    await asyncio.gather(*self._workers, return_exceptions=True)
+    self._queue = None
+    self._workers = []
+    if left:
+      log.warning(f"Task queue drain gave up after {time.monotonic() - started:.1f}s with {left} jobs left")
+    return left
+
+  def stats(self) -> dict:
+    return {
+      "queued": self._queue.qsize() if self._queue is not None else 0,
+      "running": self.running,
+      "maxsize": self.maxsize,
+      "submitted": self.submitted,
+      "completed": self.completed,
+      "retried": self.retried,
+      "failed": self.failed,
+      "dropped": self.dropped,
+    }
+
+queue = TaskQueue(
+  workers=int(os.getenv("TASK_WORKERS", "4")),
+  maxsize=int(os.getenv("TASK_QUEUE_SIZE", "10000")),
+  retries=int(os.getenv("TASK_RETRIES", "3")),
+)
+
+metrics.register_cache(
+  "task_queue",
+  queue.stats,
+  counters=("submitted", "completed", "retried", "failed", "dropped"),
+  gauges=("queued", "running", "maxsize"),
+)
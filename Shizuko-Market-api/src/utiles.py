@@ -1,58 +1,111 @@
-from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, UploadFile
-from sqlalchemy.exc import SQLAlchemyError
-import src.models as models
+from sqlalchemy.exc import IntegrityError
+import src.config as config
+import src.images as images
+import src.metrics as metrics
 import secrets
-from sqlalchemy.future import select
+from typing import Optional
 import uuid
 import aiofiles
+import hashlib
+import os
+import re
+import time
 from pathlib import Path
 
 UPLOAD_DIR = Path('./assets/product_images/')
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 UPLOAD_DIR_PROFILE = Path('./assets/image_photos/')
 UPLOAD_DIR_PROFILE.mkdir(parents=True, exist_ok=True)
+CHUNK_SIZE = 64 * 1024
 
-async def save_image(file: UploadFile, number: int) -> str:
-  if number == 1:
-    unique_filename = f"{uuid.uuid4()}_product_image_{file.filename}"
-    file_location = UPLOAD_DIR / unique_filename
-    async with aiofiles.open(file_location, 'wb') as f:
-      content = await file.read()
-      await f.write(content)
-  elif number == 2:
-    unique_filename = f"{uuid.uuid4()}_users_image_{file.filename}"
-    file_location = UPLOAD_DIR_PROFILE / unique_filename
-    async with aiofiles.open(file_location, 'wb') as f:
-      content = await file.read()
-      await f.write(content)
+def _image_suffix(filename: Optional[str]) -> str:
+  suffix = Path(filename or "").suffix.lower()
+  if len(suffix) > 6 or not suffix[1:].isalnum():
+    return ""
+  return suffix
 
-  return str(file_location)
+def pending_marker(file_location: Path) -> Path:
+  # Dot files like the .part ones, so the image sweep removes stale markers.
+  return file_location.with_name(f".{file_location.name}.pending")
 
-def generateTokens(length: int = 35) -> str:
-  characters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
-  token = ""
-  for i in range(length):
-    random_index = secrets.randbelow(len(characters))
-    token += characters[random_index]
-  return token
+async def save_image(file: UploadFile, number: int) -> str:
+  # Images are stored under the sha256 of their bytes, so re-uploading the
+  # same picture reuses the file already on disk. Rows written before this
+  # keep pointing at their "<uuid>_..._<filename>" paths, which stay valid.
+  upload_dir = UPLOAD_DIR if number == 1 else UPLOAD_DIR_PROFILE
+  kind = "product" if number == 1 else "profile"
+  max_size = config.max_upload_bytes
+  if file.size is not None and file.size > max_size:
+    metrics.UPLOAD_REJECTED.inc(kind=kind)
+    raise HTTPException(status_code=413, detail=f"Image is larger than {max_size} bytes")
 
-async def checkTokenExist(db: AsyncSession) -> str:
-  randomToken = generateTokens()
+  temp_location = upload_dir / f".{uuid.uuid4()}.part"
+  digest = hashlib.sha256()
+  size = 0
+  started = time.perf_counter()
   try:
-    result = await db.execute(
-      select(models.User).filter(models.User.token == randomToken)
-    )
-    user = result.scalars().first()
-
-    if user:
-      print("Token exists, generating new one...")
-      return await checkTokenExist(db)
+    async with aiofiles.open(temp_location, 'wb') as f:
+      while chunk := await file.read(CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_size:
+          metrics.UPLOAD_REJECTED.inc(kind=kind)
+          raise HTTPException(status_code=413, detail=f"Image is larger than {max_size} bytes")
+        digest.update(chunk)
+        await f.write(chunk)
+
+    file_location = upload_dir / f"{digest.hexdigest()}{_image_suffix(file.filename)}"
+    if file_location.exists():
+      temp_location.unlink()
+      # The served file keeps its mtime, which its ETag and Last-Modified
+      # come from. A fresh marker keeps the image cleanup off it until the
+      # row that now uses it has committed.
+      pending_marker(file_location).touch()
     else:
-      print("Token does not exist, returning token.")
-      return randomToken
-  except SQLAlchemyError as e:
-    print(f"Error checking token existence: {str(e)}")
-    raise HTTPException(
-      status_code=500, detail="Database error while checking token"
-    )
+      os.replace(temp_location, file_location)
+  except BaseException:
+    temp_location.unlink(missing_ok=True)
+    raise
+
+  metrics.UPLOAD_BYTES.observe(size, kind=kind)
+  metrics.UPLOAD_SECONDS.observe(time.perf_counter() - started, kind=kind)
+  images.schedule_variants(str(file_location))
+  return str(file_location)
+
+# 32 random bytes: a collision is not a practical concern, so signups
+# insert the token without checking for it first. The unique index on
+# users.token still backs that up.
+TOKEN_BYTES = 32
+
+def generateTokens(nbytes: int = TOKEN_BYTES) -> str:
+  return secrets.token_urlsafe(nbytes)
+
+# The unique key an INSERT/UPDATE collided on, as each driver reports it.
+# Only the key name is looked at: the messages also quote the duplicate
+# value, which may itself contain a column name.
+DUPLICATE_KEY_PATTERNS = (
+  re.compile(r"for key '([^']+)'"),  # MySQL: 'username' or 'users.username'
+  re.compile(r"UNIQUE constraint failed: ([\w.]+)"),  # SQLite: users.username
+  re.compile(r'unique constraint "([^"]+)"'),  # PostgreSQL: users_username_key
+)
+
+def duplicate_key(error: IntegrityError) -> Optional[str]:
+  args = getattr(error.orig, "args", None) or (str(error.orig),)
+  for message in args:
+    if not isinstance(message, str):
+      continue
+    for pattern in DUPLICATE_KEY_PATTERNS:
+      match = pattern.search(message)
+      if match:
+        return match.group(1).rsplit(".", 1)[-1]
+  return None
+
+def duplicate_column(error: IntegrityError, columns) -> Optional[str]:
+  # Key names default to the column, or end with it (ix_users_token).
+  key = duplicate_key(error)
+  if key is None:
+    return None
+  for column in columns:
+    if key == column or key.endswith(f"_{column}") or key.endswith(f"_{column}_key"):
+      return column
+  return None
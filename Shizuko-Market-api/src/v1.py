@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, File, Form, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, File, Form, UploadFile, Query, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import delete
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import IntegrityError
+import datetime
 import logging
 from typing import Optional
 
@@ -11,76 +13,121 @@ import src.models as models
 import src.schemas as schemas
 import src.config as config
 import src.utiles as utiles 
-from src.encryption import SPE
+import src.pagination as pagination
+import src.admission as admission
+import src.aggregates as aggregates
+import src.auth as auth
+import src.cache as cache
+import src.archive as archive
+import src.bulk as bulk
+import src.export as export
+import src.responses as responses
+import src.search as search
+import src.sync as sync
+import src.tasks as tasks
+import src.cleanup as cleanup
+from src.encryption import keyring
 # #############################################################
 
 # ###################### INIT ENCRYPTION #######################
-spe = SPE(config.encryption_password)
+spe = keyring(
+  config.encryption_password,
+  config.encryption_derived_key,
+  config.encryption_previous_password,
+  config.encryption_previous_derived_key,
+)
+
+PRODUCT_COLUMNS = (
+  models.Products.id,
+  models.Products.user_id,
+  models.Products.title,
+  models.Products.description,
+  models.Products.price,
+  models.Products.image,
+  models.Products.available,
+  models.Products.created_at,
+)
+
+FEED_COLUMNS = (
+  models.Products.id,
+  models.Products.title,
+  models.Products.description,
+  models.Products.price,
+  models.Products.image,
+  models.Products.available,
+  models.Products.created_at,
+  models.User.full_name,
+  models.User.username,
+  models.User.profile_img,
+)
+
+# Unique columns of users, in the order the duplicate is reported.
+DUPLICATE_USER_MESSAGES = {
+  "phone_number": "Phone number already registered",
+  "username": "Username already used",
+}
 
 class APIV1:
   def __init__(self):
-    self.router = APIRouter(prefix="/api/v1")
+    self.router = APIRouter(prefix="/api/v1", default_response_class=responses.FastJSONResponse)
 
     # #################################
-    @self.router.post("/adduser/")
+    @self.router.post("/adduser/", response_model=schemas.UserOut)
     async def add_user(
       info: schemas.UserCreate, db: AsyncSession = Depends(config.get_db)
     ):
+      # One INSERT and the commit: the unique indexes on username and
+      # phone_number do the duplicate checks, and the token needs none.
       try:
-        db_user = await db.execute(select(models.User).filter(models.User.username == info.username))
-        db_user = db_user.scalars().first()
-        db_phone_number = await db.execute(select(models.User).filter(models.User.phone_number == info.phone_number))
-        db_phone_number = db_phone_number.scalars().first()
-        if db_phone_number:
-          raise HTTPException(status_code=400, detail="Phone number already registered")
-        if db_user:
-          raise HTTPException(status_code=400, detail="Username already used")
-        token = await utiles.checkTokenExist(db)
-        encryption_password = spe.encrypt(info.password)
-        
         db_user = models.User(
           full_name=info.full_name,
           username=info.username,
-          password=encryption_password,
-          phone_number=info.phone_number,
-          token=token
+          password=await spe.encrypt_async(info.password),
+          phone_number=int(info.phone_number),
+          token=utiles.generateTokens(),
+          profile_img=models.DEFAULT_PROFILE_IMG,
         )
         db.add(db_user)
         await db.commit()
-        await db.refresh(db_user)
-        await db.close()
-        return db_user
+        return responses.FastJSONResponse(schemas.UserOut.from_row(db_user))
 
+      except IntegrityError as e:
+        await db.rollback()
+        column = utiles.duplicate_column(e, DUPLICATE_USER_MESSAGES)
+        if column is None:
+          raise HTTPException(status_code=500, detail=f"An unexpected error occurred while adding user: {str(e)}")
+        raise HTTPException(status_code=400, detail=DUPLICATE_USER_MESSAGES[column])
       except HTTPException as e: raise e
       except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred while adding user: {str(e)}")
 
-    @self.router.post("/checkuser/")
+    @self.router.post("/checkuser/", response_model=schemas.UserLogin)
     async def check_user(
       info: schemas.UserCheck, db: AsyncSession = Depends(config.get_db)
     ):
       try:
         phone_number = int(info.phone_number)
         db_user = await db.execute(
-          select(models.User).filter(models.User.phone_number == phone_number)
+          select(
+            models.User.full_name,
+            models.User.username,
+            models.User.phone_number,
+            models.User.password,
+            models.User.token,
+            models.User.profile_img,
+          ).filter(models.User.phone_number == phone_number)
         )
-        db_user = db_user.scalars().first()
+        db_user = db_user.first()
 
         if not db_user:
             raise HTTPException(status_code=404, detail="User not found")
         encrypted_password = db_user.password
         try:
-          decrypted_password = spe.decrypt(encrypted_password)
+          decrypted_password = await spe.decrypt_async(encrypted_password)
         except ValueError:
           raise HTTPException(status_code=500, detail="Error decrypting password")
         if decrypted_password == info.password:
-          return {
-            "full_name": db_user.full_name,
-            "username": db_user.username,
-            "phone_number": db_user.phone_number,
-            "token": db_user.token,
-            "profile_img": db_user.profile_img
-          }
+          return responses.FastJSONResponse(schemas.UserLogin.from_row(db_user))
         else:
           raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -92,47 +139,20 @@ class APIV1:
     @self.router.delete("/deleteuser/")
     async def delete_user(info: schemas.UserDelete, db: AsyncSession = Depends(config.get_db)): 
       try:
-        result = await db.execute(
-            select(models.User).filter(models.User.token == info.token)
-        )
-        db_user = result.scalars().first()
-        if not db_user: 
+        admission.check_token(info.token)
+        auth_user = await auth.resolve_user(db, info.token)
+        if not auth_user:
+          raise HTTPException(status_code=404, detail="User not found")
+        archived = await archive.archive_users(db, [auth_user.id])
+        if not archived["users"]:
+          await db.rollback()
+          auth.token_cache.invalidate(info.token)
           raise HTTPException(status_code=404, detail="User not found")
-        result_products = await db.execute(
-          select(models.Products).filter(models.Products.user_id == db_user.id)
-        )
-        db_products = result_products.scalars().all()
-        db_user_d = models.UserD(
-          full_name=db_user.full_name,
-          username=db_user.username,
-          phone_number=db_user.phone_number,
-          password=db_user.password,
-          token=db_user.token,
-          profile_img=db_user.profile_img
-        )
-        db.add(db_user_d)
-        await db.commit()
-        await db.refresh(db_user_d)
-
-        for product in db_products:
-          db_product_d = models.ProductsD(
-            user_id=db_user_d.id,
-            title=product.title,
-            description=product.description,
-            price=product.price,
-            image=product.image,
-            available=product.available
-          )
-          db.add(db_product_d)
-        await db.commit()
-        for product in db_products:
-          await db.execute(
-            delete(models.Products).where(models.Products.id == product.id)
-          )
-        await db.execute(
-          delete(models.User).where(models.User.id == db_user.id)
-        )
         await db.commit()
+        auth.token_cache.invalidate(info.token)
+        # Product detail entries are tagged with their seller as well.
+        cache.response_cache.invalidate("products", f"seller:{auth_user.id}")
+        search.index.remove_seller(auth_user.id)
         return {"message": "User and associated products deleted successfully", "status_code": 202}
 
       except HTTPException as e: raise e
@@ -145,36 +165,59 @@ class APIV1:
       token: str = Form(..., description="token"),
       full_name: Optional[str] = Form(None, description="Full name of the user"),
       username: Optional[str] = Form(None, description="Unique username"),
-      password: Optional[str] = Form(None, description="Password with at least 8 characters"),
+      password: Optional[str] = Form(
+        None, min_length=8, max_length=schemas.PASSWORD_MAX_LENGTH, description="Password with at least 8 characters"
+      ),
       image: Optional[UploadFile] = File(None),
       db: AsyncSession = Depends(config.get_db)
     ):
       try:
-        result = await db.execute(
-          select(models.User).filter(models.User.token == token)
-        )
-        db_user = result.scalars().first()
-        if not db_user:
+        admission.check_token(token)
+        auth_user = await auth.resolve_user(db, token)
+        if not auth_user:
           raise HTTPException(status_code=404, detail="User not found")
+        values = {}
         if full_name:
-          db_user.full_name = full_name
+          values["full_name"] = full_name
         if username:
-          db_user.username = username
+          values["username"] = username
         if password:
-          encryption_password = spe.encrypt(password)
-          db_user.password = encryption_password
+          if not schemas.password_fits(password):
+            raise HTTPException(status_code=400, detail=f"Password must be at most {schemas.PASSWORD_MAX_LENGTH} bytes")
+          values["password"] = await spe.encrypt_async(password)
         if image:
-          image_path = await utiles.save_image(image, 2)
-          db_user.profile_img = image_path
+          values["profile_img"] = await utiles.save_image(image, 2)
 
-        db.add(db_user)
-        await db.commit()
+        if values:
+          await db.execute(
+            update(models.User).where(models.User.id == auth_user.id).values(**values)
+          )
+          if values.keys() - {"password"}:
+            # Synced products embed the seller's name and picture.
+            await db.execute(
+              update(models.Products)
+              .where(models.Products.user_id == auth_user.id)
+              .values(updated_at=datetime.datetime.now())
+            )
+          await db.commit()
+          # The feed and batch lookups embed the seller's name and profile
+          # image.
+          cache.response_cache.invalidate("products", f"seller:{auth_user.id}")
+          if "profile_img" in values and values["profile_img"] != auth_user.profile_img:
+            tasks.queue.submit(cleanup.release_images, [auth_user.profile_img])
+        auth.token_cache.invalidate(token)
 
         return JSONResponse(
           status_code=200,
           content={"message": "User updated successfully"}
         )
 
+      except IntegrityError as e:
+        await db.rollback()
+        if utiles.duplicate_column(e, ["username"]) is None:
+          raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+        raise HTTPException(status_code=400, detail=DUPLICATE_USER_MESSAGES["username"])
+
       except HTTPException as e:
         logging.error(f"HTTP Error: {e.detail}")
         raise e
@@ -184,7 +227,7 @@ class APIV1:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
     # ###################### CREATE PRODUCT WITH IMAGE #######################
-    @self.router.post("/create-product/")
+    @self.router.post("/create-product/", response_model=schemas.ProductOut)
     async def create_product(
       token: str = Form(...),
       title: str = Form(...),
@@ -195,13 +238,12 @@ class APIV1:
       db: AsyncSession = Depends(config.get_db)
     ):
       try:
-        db_user = await db.execute(
-          select(models.User).filter(models.User.token == token)
-        )
-        db_user = db_user.scalars().first()
+        admission.check_token(token)
+        db_user = await auth.resolve_user(db, token)
         if not db_user:
             raise HTTPException(status_code=404, detail="User not found")
         image_path = await utiles.save_image(image, 1)
+        now = datetime.datetime.now()
         new_product = models.Products(
           user_id=db_user.id,
           title=title,
@@ -209,98 +251,351 @@ class APIV1:
           price=price,
           image=image_path,
           available=available,
+          created_at=now,
+          updated_at=now,
         )
         db.add(new_product)
+        await aggregates.add_products(db, db_user.id, aggregates.delta([(price, available, now)]))
+        # The id comes back with the INSERT and created_at is set client
+        # side, so the response needs no refresh.
         await db.commit()
-        await db.refresh(new_product)
+        cache.response_cache.invalidate("products", f"seller:{db_user.id}")
+        search.index.add(new_product.id, db_user.id, title, description, price, available)
 
-        return new_product
+        return responses.FastJSONResponse(schemas.ProductOut.from_row(new_product))
       except HTTPException as e: raise e
 
       except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
       
-    @self.router.get("/products/")
-    async def view_products(db: AsyncSession = Depends(config.get_db)):
+    # ###################### BULK IMPORT #######################
+    @self.router.post("/products/import/")
+    async def import_products(
+      token: str = Form(...),
+      file: UploadFile = File(..., description="NDJSON or CSV with title, description, price, available, image"),
+      images: Optional[UploadFile] = File(None, description="Zip archive with the images referenced by the rows"),
+      format: Optional[str] = Form(None, description="ndjson or csv, detected from the file when omitted"),
+      batch_size: int = Form(bulk.DEFAULT_BATCH_SIZE, ge=1, le=bulk.MAX_BATCH_SIZE),
+      db: AsyncSession = Depends(config.get_db)
+    ):
       try:
-        result = await db.execute(select(models.Products))
-        products = result.scalars().all()
+        admission.check_token(token)
+        db_user = await auth.resolve_user(db, token)
+        if not db_user:
+          raise HTTPException(status_code=404, detail="User not found")
+        return await bulk.import_products(
+          db, db_user.id, file, bulk.detect_format(file, format), images, batch_size
+        )
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
-        if not products:
+    # ###################### STREAMING EXPORT #######################
+    @self.router.get("/products/export/")
+    async def export_products(
+      request: Request,
+      min_price: Optional[float] = None,
+      max_price: Optional[float] = None,
+      available: Optional[bool] = None,
+      user_id: Optional[int] = None,
+    ):
+      return export.export_response(request, min_price, max_price, available, user_id)
+
+    @self.router.get("/products/", response_model=list[schemas.FeedProduct])
+    async def view_products(
+      request: Request,
+      cursor: Optional[str] = None,
+      limit: int = Query(pagination.DEFAULT_LIMIT, ge=1, le=pagination.MAX_LIMIT),
+      min_price: Optional[float] = None,
+      max_price: Optional[float] = None,
+      available: Optional[bool] = None,
+      user_id: Optional[int] = None,
+      db: AsyncSession = Depends(config.get_read_db)
+    ):
+      async def build():
+        query = select(*FEED_COLUMNS).join(models.User, models.User.id == models.Products.user_id)
+        query = pagination.filter_products(query, min_price, max_price, available, user_id)
+        result = await db.execute(pagination.paginate_products(query, cursor, limit))
+        rows = result.all()
+
+        if not rows and not cursor:
           raise HTTPException(status_code=404, detail="No products found")
 
-        product_with_user_info = []
-        for product in products:
-          user_result = await db.execute(
-            select(models.User).filter(models.User.id == product.user_id)
-          )
-          user = user_result.scalars().first()
-          if user:
-            product_with_user_info.append({
-              "product_id": product.id,
-              "title": product.title,
-              "description": product.description,
-              "price": product.price,
-              "image": product.image,
-              "available": product.available,
-              "time": product.created_at,
-              "user": {
-                "full_name": user.full_name,
-                "username": user.username,
-                "profile_img": user.profile_img,
-                }
-              })
-
-        return product_with_user_info
+        headers = {}
+        next_cursor = pagination.next_cursor(rows, limit)
+        if next_cursor:
+          headers["X-Next-Cursor"] = next_cursor
+
+        product_with_user_info = [schemas.FeedProduct.from_row(row) for row in rows[:limit]]
+
+        return product_with_user_info, headers
+
+      try:
+        return await cache.cached_response(request, ["products"], build)
       
       except HTTPException as e: raise e
 
       except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-    @self.router.get("/products/{product_id}/")
-    async def view_product_by_id(product_id: int, db: AsyncSession = Depends(config.get_db)):
+    # ###################### SEARCH #######################
+    # Registered before /products/{product_id}/ so "search" is not taken
+    # for a product id.
+    @self.router.get("/products/search/", response_model=list[schemas.FeedProduct])
+    async def search_products(
+      request: Request,
+      q: str = Query(..., min_length=1, max_length=200),
+      limit: int = Query(20, ge=1, le=pagination.MAX_LIMIT),
+      offset: int = Query(0, ge=0, le=search.MAX_MATCHES),
+      prefix: bool = Query(True, description="Match the last word as a prefix, for typeahead"),
+      min_price: Optional[float] = None,
+      max_price: Optional[float] = None,
+      available: Optional[bool] = None,
+      db: AsyncSession = Depends(config.get_read_db)
+    ):
+      if not search.index.ready:
+        raise HTTPException(status_code=503, detail="Search index is warming up", headers={"Retry-After": "5"})
+
+      async def build():
+        product_ids = search.index.search(q, limit, offset, min_price, max_price, available, prefix)
+        if not product_ids:
+          return [], {}
+        result = await db.execute(
+          select(*FEED_COLUMNS)
+          .join(models.User, models.User.id == models.Products.user_id)
+          .where(models.Products.id.in_(product_ids))
+        )
+        rows = {row.id: row for row in result.all()}
+        # Deleted by another worker since it was indexed here, or not on the
+        # replica yet; either way it is left out of this response.
+        await search.index.forget_missing(db, [product_id for product_id in product_ids if product_id not in rows])
+        return [schemas.FeedProduct.from_row(rows[product_id]) for product_id in product_ids if product_id in rows], {}
+
+      try:
+        if search.index.needs_refresh():
+          await search.index.refresh()
+        return await cache.cached_response(request, ["products"], build)
+
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    # ###################### AGGREGATES #######################
+    @self.router.get("/products/stats/", response_model=schemas.CatalogStats)
+    async def catalog_stats(request: Request, db: AsyncSession = Depends(config.get_read_db)):
+      async def build():
+        return schemas.CatalogStats.from_row(await aggregates.read(db)), {}
+
+      try:
+        return await cache.cached_response(request, ["products"], build)
+
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    @self.router.get("/products/bytoken/{token}/stats/", response_model=schemas.CatalogStats)
+    async def seller_stats(request: Request, token: str, db: AsyncSession = Depends(config.get_read_db)):
+      # A seller dashboard in one row read, however many products it has.
+      try:
+        user_info = await auth.resolve_user(db, token)
+        if not user_info:
+          raise HTTPException(status_code=404, detail="User not found")
+
+        async def build():
+          return schemas.CatalogStats.from_row(await aggregates.read(db, user_info.id)), {}
+
+        return await cache.cached_response(request, [f"seller:{user_info.id}"], build)
+
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    # ###################### DELTA SYNC #######################
+    @self.router.get("/products/sync/", response_model=schemas.SyncOut)
+    async def sync_products(
+      token: Optional[str] = Query(None, description="sync_token from the previous response; omit for a full sync"),
+      limit: int = Query(sync.DEFAULT_LIMIT, ge=1, le=sync.MAX_LIMIT),
+      db: AsyncSession = Depends(config.get_read_db)
+    ):
+      # Products created or changed since the token, plus the ids deleted
+      # since then. Call again with the new token while has_more is true.
+      horizon = sync.sync_horizon()
+      since = sync.start_token(token, horizon)
       try:
-        result = await db.execute(select(models.Products).filter(models.Products.id == product_id))
-        product = result.scalars().first()
+        query = select(*FEED_COLUMNS, models.Products.updated_at).join(
+          models.User, models.User.id == models.Products.user_id
+        )
+        result = await db.execute(sync.changed_products(query, since, horizon, limit))
+        products = result.all()
+        result = await db.execute(sync.deleted_products(since, horizon, limit))
+        tombstones = result.all()
+
+        return responses.FastJSONResponse(schemas.SyncOut.model_construct(
+          products=[schemas.FeedProduct.from_row(row) for row in products[:limit]],
+          deleted=[row.product_id for row in tombstones[:limit]],
+          sync_token=sync.encode_token(sync.next_token(since, products, tombstones, limit, horizon)),
+          has_more=len(products) > limit or len(tombstones) > limit,
+        ))
+
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    # ###################### BATCH LOOKUP #######################
+    @self.router.post("/products/batch/", response_model=schemas.ProductBatchOut)
+    async def view_products_batch(
+      request: Request,
+      info: schemas.ProductBatchIn,
+      db: AsyncSession = Depends(config.get_read_db)
+    ):
+      # Favourites and carts in one round trip: every id missing from the
+      # cache is loaded with a single IN query, and each product is cached
+      # on its own so overlapping lists share entries.
+      async def build(product_ids):
+        result = await db.execute(
+          select(*FEED_COLUMNS, models.Products.user_id)
+          .join(models.User, models.User.id == models.Products.user_id)
+          .where(models.Products.id.in_(product_ids))
+        )
+        return {
+          row.id: (schemas.FeedProduct.from_row(row), [f"product:{row.id}", f"seller:{row.user_id}"])
+          for row in result.all()
+        }
+
+      try:
+        bodies = await cache.cached_items(
+          request, {product_id: f"feed-product:{product_id}" for product_id in info.ids}, build
+        )
+        missing = [product_id for product_id in info.ids if product_id not in bodies]
+        # Assembled from the cached bodies, in request order.
+        body = b"".join((
+          b'{"products":[',
+          b",".join(bodies.get(product_id, b"null") for product_id in info.ids),
+          b'],"missing":',
+          responses.dumps(missing),
+          b"}",
+        ))
+        return cache.body_response(request, body)
+
+      except HTTPException as e: raise e
+
+      except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    @self.router.get("/products/{product_id}/", response_model=schemas.ProductOut)
+    async def view_product_by_id(request: Request, product_id: int, db: AsyncSession = Depends(config.get_read_db)):
+      async def build():
+        result = await db.execute(
+          select(*PRODUCT_COLUMNS).filter(models.Products.id == product_id)
+        )
+        product = result.first()
         if not product:
           raise HTTPException(status_code=404, detail="Product not found")
 
-        return product
+        return schemas.ProductOut.from_row(product), {}
+
+      try:
+        return await cache.cached_response(
+          request,
+          lambda product: [f"product:{product.id}", f"seller:{product.user_id}"],
+          build,
+          key=f"product:{product_id}",
+        )
       
       except HTTPException as e: raise e
 
       except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-    @self.router.get("/products/bytoken/{token}/")
-    async def view_product_by_token(token: str, db: AsyncSession = Depends(config.get_db)):
+    @self.router.get("/products/bytoken/{token}/", response_model=list[schemas.ProductOut])
+    async def view_product_by_token(
+      request: Request,
+      token: str,
+      cursor: Optional[str] = None,
+      limit: int = Query(pagination.DEFAULT_LIMIT, ge=1, le=pagination.MAX_LIMIT),
+      min_price: Optional[float] = None,
+      max_price: Optional[float] = None,
+      available: Optional[bool] = None,
+      db: AsyncSession = Depends(config.get_read_db)
+    ):
       try:
-        result = await db.execute(select(models.User).filter(models.User.token == token))
-        user_info = result.scalars().first()
+        user_info = await auth.resolve_user(db, token)
         if not user_info:
           raise HTTPException(status_code=404, detail="User not found")
-        result_products = await db.execute(select(models.Products).filter(models.Products.user_id == user_info.id))
-        products = result_products.scalars().all()
-        if not products:
-          raise HTTPException(status_code=404, detail="No products found")
-        return products
+
+        async def build():
+          query = pagination.filter_products(
+            select(*PRODUCT_COLUMNS), min_price, max_price, available, user_info.id
+          )
+          result_products = await db.execute(pagination.paginate_products(query, cursor, limit))
+          products = result_products.all()
+          if not products and not cursor:
+            raise HTTPException(status_code=404, detail="No products found")
+          headers = {}
+          next_cursor = pagination.next_cursor(products, limit)
+          if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+          return [schemas.ProductOut.from_row(row) for row in products[:limit]], headers
+
+        return await cache.cached_response(request, [f"seller:{user_info.id}"], build)
     
       except HTTPException as e: raise e
 
       except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+    @self.router.get("/cache/stats/")
+    async def cache_stats():
+      return {
+        "responses": cache.response_cache.stats(),
+        "tokens": auth.token_cache.stats(),
+        "search": search.index.stats(),
+        "admission": admission.stats(),
+        "tasks": tasks.queue.stats(),
+      }
+
     @self.router.delete("/products/delete/{product_id}")
     async def delete_product(product_id: int, db: AsyncSession = Depends(config.get_db)):
       try:
-        result = await db.execute(select(models.Products).filter(models.Products.id == product_id))
-        product_info = result.scalars().first()
+        result = await db.execute(
+          select(
+            models.Products.user_id,
+            models.Products.image,
+            models.Products.price,
+            models.Products.available,
+            models.Products.created_at,
+          ).filter(models.Products.id == product_id)
+        )
+        product_info = result.first()
         if not product_info:
-          raise HTTPException(status_code=404, detail=f"Product not found: {str(e)}")
-        await db.execute(delete(models.Products).where(models.Products.id == product_id))
+          raise HTTPException(status_code=404, detail="Product not found")
+        deleted = await db.execute(delete(models.Products).where(models.Products.id == product_id))
+        if not deleted.rowcount:
+          # A concurrent delete got there first: it updates the aggregates
+          # and writes the tombstone.
+          await db.rollback()
+          raise HTTPException(status_code=404, detail="Product not found")
+        await aggregates.remove_products(
+          db,
+          product_info.user_id,
+          aggregates.delta([(product_info.price, product_info.available, product_info.created_at)]),
+        )
+        await db.execute(
+          insert(models.ProductTombstone).values(product_id=product_id, user_id=product_info.user_id)
+        )
         await db.commit()
+        cache.response_cache.invalidate(
+          "products", f"product:{product_id}", f"seller:{product_info.user_id}"
+        )
+        search.index.remove(product_id)
+        tasks.queue.submit(cleanup.release_images, [product_info.image])
         return {"message": "Product deleted successfully"}
       except HTTPException as e: raise e
       except Exception as e:
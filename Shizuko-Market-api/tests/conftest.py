@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session", autouse=True)
+def workdir(tmp_path_factory):
+  # The app reads its configuration at import: point it at a throwaway
+  # SQLite database and working directory (see benchmarks/common.py) before
+  # any test imports src, and go back to the original cwd afterwards.
+  directory = tmp_path_factory.mktemp("shizuko")
+  cwd = os.getcwd()
+  with pytest.MonkeyPatch.context() as patch:
+    patch.setenv("BENCH_DIR", str(directory))
+    patch.setenv("DATABASE_URL", os.getenv("DATABASE_URL") or f"sqlite+aiosqlite:///{directory / 'test.db'}")
+    from benchmarks.common import prepare_workdir
+    import src.config as config
+
+    prepare_workdir()
+    try:
+      yield directory
+    finally:
+      asyncio.run(config.dispose_engines())
+      os.chdir(cwd)
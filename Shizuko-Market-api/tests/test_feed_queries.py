@@ -0,0 +1,54 @@
+from sqlalchemy import insert
+import asyncio
+import datetime
+import httpx
+
+# src and benchmarks.common are imported inside the tests: the workdir
+# fixture in conftest.py has to configure them first.
+
+async def seed(products: int):
+  from benchmarks.common import create_schema
+  import src.config as config
+  import src.models as models
+
+  await create_schema()
+  now = datetime.datetime.now()
+  async with config.SessionLocal() as db:
+    await db.execute(insert(models.User), [
+      {"full_name": f"Seller {n}", "username": f"seller{n}", "phone_number": 1_000_000_000 + n, "password": "x", "token": f"token-{n}"}
+      for n in range(10)
+    ])
+    await db.execute(insert(models.Products), [
+      {
+        "user_id": n % 10 + 1,
+        "title": f"Product {n}",
+        "description": "Item",
+        "price": n + 0.99,
+        "available": True,
+        "created_at": now - datetime.timedelta(seconds=n),
+      }
+      for n in range(products)
+    ])
+    await db.commit()
+
+async def feed_statements(products: int) -> int:
+  from benchmarks.common import StatementCounter
+  import src.config as config
+  import src.cache as cache
+  from run import app
+
+  await seed(products)
+  cache.response_cache.clear()
+  counter = StatementCounter(config.engine)
+  async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+    response = await client.get("/api/v1/products/", params={"limit": 50})
+  assert response.status_code == 200
+  assert len(response.json()) == min(products, 50)
+  await config.dispose_engines()
+  return counter.count
+
+def test_feed_statement_count_does_not_grow_with_the_catalog():
+  # The feed used to run one users SELECT per product.
+  small = asyncio.run(feed_statements(10))
+  large = asyncio.run(feed_statements(1000))
+  assert small == large